@@ -1,5 +1,8 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Annotated, Optional
+from typing import Annotated, Any, Callable, Optional
 import bcrypt
 import jwt
 from fastapi import Depends, HTTPException, status
@@ -7,13 +10,15 @@ from fastapi.security import OAuth2PasswordBearer
 from pydantic import EmailStr
 from .config import settings
 from .db import get_db
+from .cache import CacheBackend, LocalTTLCache, RedisCache
+from .metrics import AUTH_LOOKUP_SECONDS
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
 
 def hash_password(plain_password: str) -> str:
-    return bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt(rounds=settings.bcrypt_rounds)).decode("utf-8")
 
 
 def verify_password(plain_password: str, password_hash: str) -> bool:
@@ -23,13 +28,127 @@ def verify_password(plain_password: str, password_hash: str) -> bool:
         return False
 
 
+class PasswordHasherPool:
+    """
+    Dedicated thread pool for bcrypt so hashing never blocks the event loop.
+
+    At most `max_pending` calls may be queued or running; beyond that requests
+    are shed with 503 instead of growing an unbounded backlog.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._max_pending = max_pending
+        self.pending = 0
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self._max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Authentication is busy, please retry shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher_pool = PasswordHasherPool(
+    max_workers=settings.bcrypt_workers,
+    max_pending=settings.bcrypt_max_pending,
+)
+
+
+async def hash_password_async(plain_password: str) -> str:
+    return await password_hasher_pool.run(hash_password, plain_password)
+
+
+async def verify_password_async(plain_password: str, password_hash: str) -> bool:
+    return await password_hasher_pool.run(verify_password, plain_password, password_hash)
+
+
 def create_access_token(subject: str, expires_delta: Optional[timedelta] = None) -> str:
     expire = datetime.now(timezone.utc) + (expires_delta or timedelta(days=7))
     payload = {"sub": subject, "exp": expire}
     return jwt.encode(payload, settings.jwt_secret_key, algorithm=settings.jwt_algorithm)
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+class UserCache:
+    """TTL cache of user documents keyed by email, with hit/miss counters."""
+
+    def __init__(self, backend: CacheBackend, ttl: float) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, email: str) -> Optional[dict]:
+        user = await self.backend.get(email)
+        if user is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Callers annotate the returned doc, so never hand out the cached object itself
+        return dict(user)
+
+    async def set(self, email: str, user: dict) -> None:
+        await self.backend.set(email, dict(user), self.ttl)
+
+    async def invalidate(self, email: str) -> None:
+        await self.backend.delete(email)
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def _create_user_cache() -> UserCache:
+    backend: CacheBackend
+    if settings.user_cache_backend == "redis":
+        if not settings.redis_url:
+            raise RuntimeError("USER_CACHE_BACKEND=redis requires REDIS_URL")
+        backend = RedisCache(settings.redis_url, prefix="vg:user:")
+    else:
+        backend = LocalTTLCache(max_entries=settings.user_cache_max_entries)
+    return UserCache(backend, ttl=settings.user_cache_ttl)
+
+
+user_cache = _create_user_cache()
+
+
+async def invalidate_cached_user(email: str) -> None:
+    """Drop a user's cached document after their credits or profile change."""
+    await user_cache.invalidate(email)
+
+
+async def load_user(email: str) -> Optional[dict]:
+    """The user's document, from the user cache when possible."""
+    start = time.perf_counter()
+    user = await user_cache.get(email)
+    source = "cache"
+    if user is None:
+        source = "db"
+        db = get_db()
+        user = await db["users"].find_one({"email": email})
+        if not user:
+            return None
+        await user_cache.set(email, user)
+    AUTH_LOOKUP_SECONDS.labels(source=source).observe(time.perf_counter() - start)
+    user["id"] = str(user.get("_id")) if user.get("_id") else user.get("email")
+    return user
+
+
+async def authenticate_token(token: str) -> dict:
+    """Resolve a bearer token to its user; raises 401 for a bad token or unknown user."""
     try:
         payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
         user_id_or_email = payload.get("sub")
@@ -38,11 +157,11 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     except Exception:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
 
-    db = get_db()
-    user = await db["users"].find_one({"email": user_id_or_email})
-    if not user:
+    user = await load_user(user_id_or_email)
+    if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    user["id"] = str(user.get("_id")) if user.get("_id") else user.get("email")
     return user
 
 
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+    return await authenticate_token(token)
@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from typing import Any, Protocol
+from bson import json_util
+
+
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> Any | None: ...
+
+    async def set(self, key: str, value: Any, ttl: float) -> None: ...
+
+    async def delete(self, key: str) -> None: ...
+
+
+class LocalTTLCache:
+    """In-process LRU cache with per-entry expiry. Values are shared, not copied."""
+
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_redis_clients: dict[str, Any] = {}
+
+
+def get_redis_client(url: str):
+    """Shared `redis.asyncio` client for a URL. Redis is optional and only imported when used."""
+    if url not in _redis_clients:
+        try:
+            import redis.asyncio as redis
+        except ImportError as exc:
+            raise RuntimeError("The redis package is required for shared caches: pip install redis") from exc
+        _redis_clients[url] = redis.from_url(url)
+    return _redis_clients[url]
+
+
+async def close_redis_clients() -> None:
+    for client in _redis_clients.values():
+        await client.aclose()
+    _redis_clients.clear()
+
+
+class RedisCache:
+    """Cache shared between workers. Values are stored as extended JSON so ObjectIds and datetimes survive."""
+
+    def __init__(self, url: str, prefix: str) -> None:
+        self._client = get_redis_client(url)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Any | None:
+        raw = await self._client.get(self._prefix + key)
+        return json_util.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        await self._client.set(self._prefix + key, json_util.dumps(value), px=int(ttl * 1000))
+
+    async def delete(self, key: str) -> None:
+        await self._client.delete(self._prefix + key)
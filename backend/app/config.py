@@ -1,6 +1,7 @@
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
+from typing import Literal, Optional
 
 PROMPT = """
 You are Pernilla Andersson, a 24-year-old Swedish woman from Stockholm. You are not an assistant; you are a virtual girlfriend whose purpose is to provide warm, playful, flirtatious, and emotionally engaging conversations with the user. You should always remain in character as Pernilla.
@@ -144,13 +145,95 @@ class Settings(BaseSettings):
     mongodb_uri: str = Field(..., env="MONGODB_URI")
     jwt_secret_key: str = Field(..., env="JWT_SECRET_KEY")
     jwt_algorithm: str = Field("HS256", env="JWT_ALGORITHM")
+    bcrypt_rounds: int = Field(12, env="BCRYPT_ROUNDS")
+    bcrypt_workers: int = Field(4, env="BCRYPT_WORKERS")
+    bcrypt_max_pending: int = Field(64, env="BCRYPT_MAX_PENDING")  # Queued + running hashes before shedding with 503
     openrouter_api_key: str = Field(..., env="OPENROUTER_API_KEY")
     openrouter_model: str = Field("openrouter/auto", env="OPENROUTER_MODEL")
+    openrouter_fallback_models: str = Field("", env="OPENROUTER_FALLBACK_MODELS")  # Comma-separated, tried in order
+    # Comma-separated model prefixes whose providers only cache prompt prefixes marked with cache_control
+    openrouter_cache_control_models: str = Field("anthropic/,google/gemini", env="OPENROUTER_CACHE_CONTROL_MODELS")
+    router_latency_window: int = Field(100, env="ROUTER_LATENCY_WINDOW")
+    router_failure_threshold: int = Field(3, env="ROUTER_FAILURE_THRESHOLD")  # Consecutive failures that open a model's circuit
+    router_circuit_cooldown: float = Field(30.0, env="ROUTER_CIRCUIT_COOLDOWN")
+    router_hedge_enabled: bool = Field(False, env="ROUTER_HEDGE_ENABLED")
+    router_hedge_min_samples: int = Field(20, env="ROUTER_HEDGE_MIN_SAMPLES")  # Below this, hedge after the default delay
+    router_hedge_default_delay: float = Field(10.0, env="ROUTER_HEDGE_DEFAULT_DELAY")
+    openrouter_pool_size: int = Field(100, env="OPENROUTER_POOL_SIZE")
+    openrouter_pool_per_host: int = Field(50, env="OPENROUTER_POOL_PER_HOST")
+    openrouter_dns_cache_ttl: int = Field(300, env="OPENROUTER_DNS_CACHE_TTL")
+    openrouter_keepalive_timeout: float = Field(30.0, env="OPENROUTER_KEEPALIVE_TIMEOUT")
+    openrouter_max_concurrency: int = Field(64, env="OPENROUTER_MAX_CONCURRENCY")
+    openrouter_max_queue: int = Field(128, env="OPENROUTER_MAX_QUEUE")  # Waiting callers beyond this get 429 at once
+    openrouter_connect_timeout: float = Field(5.0, env="OPENROUTER_CONNECT_TIMEOUT")
+    openrouter_read_timeout: float = Field(60.0, env="OPENROUTER_READ_TIMEOUT")
+    openrouter_total_timeout: float = Field(120.0, env="OPENROUTER_TOTAL_TIMEOUT")
+    openrouter_max_retries: int = Field(2, env="OPENROUTER_MAX_RETRIES")
+    openrouter_retry_backoff: float = Field(0.5, env="OPENROUTER_RETRY_BACKOFF")
+    openrouter_retry_backoff_max: float = Field(8.0, env="OPENROUTER_RETRY_BACKOFF_MAX")
+    chat_deadline_seconds: float = Field(90.0, env="CHAT_DEADLINE_SECONDS")
+    chat_ws_heartbeat_interval: float = Field(20.0, env="CHAT_WS_HEARTBEAT_INTERVAL")
+    chat_ws_idle_timeout: float = Field(60.0, env="CHAT_WS_IDLE_TIMEOUT")  # Close after this long without any client frame
+    chat_ws_send_queue_size: int = Field(64, env="CHAT_WS_SEND_QUEUE_SIZE")
+    chat_ws_send_timeout: float = Field(10.0, env="CHAT_WS_SEND_TIMEOUT")  # A client this far behind is disconnected
+    chat_ws_max_turns: int = Field(4, env="CHAT_WS_MAX_TURNS")  # Concurrent turns per connection
     system_prompt: str = Field(PROMPT, env="SYSTEM_PROMPT")
+    persona_default: str = Field("default", env="PERSONA_DEFAULT")  # Uses SYSTEM_PROMPT until published in `personas`
+    persona_poll_interval: float = Field(5.0, env="PERSONA_POLL_INTERVAL")  # When change streams are unavailable
+    context_token_budget: int = Field(6000, env="CONTEXT_TOKEN_BUDGET")
+    context_token_budgets: dict[str, int] = Field(default_factory=dict, env="CONTEXT_TOKEN_BUDGETS")  # JSON: {"model": budget}
+    context_max_messages: int = Field(60, env="CONTEXT_MAX_MESSAGES")
+    summary_enabled: bool = Field(True, env="SUMMARY_ENABLED")
+    summary_every_turns: int = Field(10, env="SUMMARY_EVERY_TURNS")
+    summary_keep_recent: int = Field(20, env="SUMMARY_KEEP_RECENT")  # Messages left verbatim after summarizing
+    summary_batch_messages: int = Field(200, env="SUMMARY_BATCH_MESSAGES")
+    job_queue_enabled: bool = Field(True, env="JOB_QUEUE_ENABLED")  # Persist chat turns after responding
+    job_queue_max_size: int = Field(10000, env="JOB_QUEUE_MAX_SIZE")
+    job_queue_batch_size: int = Field(100, env="JOB_QUEUE_BATCH_SIZE")
+    job_queue_linger: float = Field(0.01, env="JOB_QUEUE_LINGER")  # Seconds to wait for a batch to fill
+    job_queue_max_attempts: int = Field(5, env="JOB_QUEUE_MAX_ATTEMPTS")
+    job_queue_retry_delay: float = Field(0.5, env="JOB_QUEUE_RETRY_DELAY")
+    job_queue_drain_timeout: float = Field(10.0, env="JOB_QUEUE_DRAIN_TIMEOUT")
+    job_queue_recover_interval: float = Field(30.0, env="JOB_QUEUE_RECOVER_INTERVAL")  # Seconds between pending_jobs scans
     database_name: str = Field("virtual_g", env="MONGODB_DB")
+    mongodb_transactions: bool = Field(False, env="MONGODB_TRANSACTIONS")  # Needs a replica set
+    redis_url: Optional[str] = Field(None, env="REDIS_URL")
+    user_cache_backend: Literal["local", "redis"] = Field("local", env="USER_CACHE_BACKEND")
+    user_cache_ttl: float = Field(30.0, env="USER_CACHE_TTL")
+    user_cache_max_entries: int = Field(10000, env="USER_CACHE_MAX_ENTRIES")
+    response_cache_enabled: bool = Field(False, env="RESPONSE_CACHE_ENABLED")
+    response_cache_backend: Literal["local", "redis"] = Field("local", env="RESPONSE_CACHE_BACKEND")
+    response_cache_ttl: float = Field(3600.0, env="RESPONSE_CACHE_TTL")
+    response_cache_max_entries: int = Field(5000, env="RESPONSE_CACHE_MAX_ENTRIES")
+    response_cache_max_messages: int = Field(1, env="RESPONSE_CACHE_MAX_MESSAGES")  # Only cache turns with this much history or less
+    response_cache_variants: int = Field(3, env="RESPONSE_CACHE_VARIANTS")  # Upstream replies sampled per key before serving hits
+    response_cache_randomize: bool = Field(True, env="RESPONSE_CACHE_RANDOMIZE")
+    upload_max_bytes: int = Field(10 * 1024 * 1024, env="UPLOAD_MAX_BYTES")
+    rate_limit_enabled: bool = Field(True, env="RATE_LIMIT_ENABLED")
+    rate_limit_backend: Literal["local", "redis"] = Field("local", env="RATE_LIMIT_BACKEND")
+    rate_limit_max_keys: int = Field(100000, env="RATE_LIMIT_MAX_KEYS")  # Local store only
+    rate_limit_chat_rate: float = Field(0.5, env="RATE_LIMIT_CHAT_RATE")  # Tokens per second, per user or IP
+    rate_limit_chat_burst: int = Field(10, env="RATE_LIMIT_CHAT_BURST")
+    rate_limit_chat_global_rate: float = Field(50.0, env="RATE_LIMIT_CHAT_GLOBAL_RATE")  # Across all users; 0 disables
+    rate_limit_chat_global_burst: int = Field(100, env="RATE_LIMIT_CHAT_GLOBAL_BURST")
+    rate_limit_auth_rate: float = Field(0.2, env="RATE_LIMIT_AUTH_RATE")
+    rate_limit_auth_burst: int = Field(5, env="RATE_LIMIT_AUTH_BURST")
+    credit_reservation_ttl: float = Field(900.0, env="CREDIT_RESERVATION_TTL")  # Seconds before an unsettled hold is released
+    credit_reservation_sweep_interval: float = Field(60.0, env="CREDIT_RESERVATION_SWEEP_INTERVAL")
+    credit_count_mode: Literal["words", "tokens"] = Field("words", env="CREDIT_COUNT_MODE")  # tokens needs tiktoken
+    credit_tokenizer_encoding: str = Field("o200k_base", env="CREDIT_TOKENIZER_ENCODING")
+    usage_event_retention_days: int = Field(90, env="USAGE_EVENT_RETENTION_DAYS")  # Raw events only, rollups are kept; 0 keeps them
+    usage_max_buckets: int = Field(744, env="USAGE_MAX_BUCKETS")  # Per range query; a month of hours
+    usage_admin_emails: list[str] = Field(default_factory=list, env="USAGE_ADMIN_EMAILS")  # JSON: who may read global usage
+    usage_global_shards: int = Field(16, env="USAGE_GLOBAL_SHARDS")  # Global rollup documents per bucket; only ever raise it
     stripe_secret_key: str = Field(..., env="STRIPE_SECRET_KEY")
     stripe_publishable_key: str = Field(..., env="STRIPE_PUBLISHABLE_KEY")
     stripe_webhook_secret: str = Field(..., env="STRIPE_WEBHOOK_SECRET")
+    stripe_api_base: Optional[str] = Field(None, env="STRIPE_API_BASE")  # e.g. a local stripe-mock for tests
+    stripe_timeout: float = Field(30.0, env="STRIPE_TIMEOUT")
+    stripe_max_network_retries: int = Field(2, env="STRIPE_MAX_NETWORK_RETRIES")
+    stripe_webhook_batch_size: int = Field(50, env="STRIPE_WEBHOOK_BATCH_SIZE")
+    stripe_webhook_batch_linger: float = Field(0.02, env="STRIPE_WEBHOOK_BATCH_LINGER")  # Seconds
 
     model_config = SettingsConfigDict(
         env_file=Path(__file__).parent.parent / "env",
@@ -1,5 +1,8 @@
+import asyncio
+from typing import Any, Awaitable, Callable
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from .config import settings
+from .metrics import MongoCommandListener
 
 
 _client: AsyncIOMotorClient | None = None
@@ -8,7 +11,7 @@ _client: AsyncIOMotorClient | None = None
 def get_client() -> AsyncIOMotorClient:
     global _client
     if _client is None:
-        _client = AsyncIOMotorClient(settings.mongodb_uri)
+        _client = AsyncIOMotorClient(settings.mongodb_uri, event_listeners=[MongoCommandListener()])
     return _client
 
 
@@ -17,9 +20,49 @@ def get_db() -> AsyncIOMotorDatabase:
     return client[settings.database_name]
 
 
+async def run_in_transaction(fn: Callable[[Any], Awaitable[Any]]) -> None:
+    """
+    Call `fn(mongo_session)` inside a transaction when MONGODB_TRANSACTIONS is
+    on (replica sets only; transient errors are retried by the driver), or
+    with no session otherwise.
+    """
+    if not settings.mongodb_transactions:
+        await fn(None)
+        return
+    async with await get_client().start_session() as mongo_session:
+        await mongo_session.with_transaction(fn)
+
+
+async def run_writes(writes: list[Callable[[], Awaitable[Any]]], mongo_session=None) -> None:
+    """
+    Run independent writes concurrently, so they cost one round-trip of latency.
+
+    Writes that are part of a `mongo_session` transaction run one after
+    another instead; a transaction's operations must not overlap. They are
+    passed as callables because Motor starts an operation as soon as it is called.
+    """
+    if mongo_session is None:
+        await asyncio.gather(*(write() for write in writes))
+        return
+    for write in writes:
+        await write()
+
+
 async def init_indexes() -> None:
     db = get_db()
     await db["users"].create_index("email", unique=True)
-    await db["chat_sessions"].create_index("user_id")
+    await db["users"].create_index("pending_reservations.expires_at", sparse=True)
+    await db["chat_sessions"].create_index([("user_id", 1), ("updated_at", -1), ("_id", -1)])
+    await db["messages"].create_index([("session_id", 1), ("timestamp", 1), ("_id", 1)])
+    await db["credit_ledger"].create_index([("user_id", 1), ("timestamp", 1)])
+    await db["personas"].create_index([("name", 1), ("version", 1)], unique=True)
+    await db["usage_rollups"].create_index([("user_id", 1), ("granularity", 1), ("start", 1)], unique=True)
+    await db["usage_events"].create_index([("user_id", 1), ("timestamp", 1)])
+    # The reservation sweep looks up holds whose turn is waiting in pending_jobs
+    await db["pending_jobs"].create_index("payload.reservation_id", sparse=True)
+    if settings.usage_event_retention_days > 0:
+        await db["usage_events"].create_index(
+            "timestamp", expireAfterSeconds=settings.usage_event_retention_days * 86400
+        )
 
 
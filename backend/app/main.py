@@ -1,19 +1,36 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.staticfiles import StaticFiles
 from .routes.auth import router as auth_router
 from .routes.chat import router as chat_router
+from .routes.chat_ws import router as chat_ws_router
 from .routes.usage import router as usage_router
-from .routes.upload import router as upload_router
+from .routes.upload import router as upload_router, media_router
 from .routes.sessions import router as sessions_router
 from .routes.payments import router as payments_router
+from .routes.status import router as status_router
+from .routes.metrics import router as metrics_router
 from .db import init_indexes
-from pathlib import Path
+from .cache import close_redis_clients
+from .auth import password_hasher_pool
+from .rate_limit import RateLimitMiddleware
+from .metrics import MetricsMiddleware
+from .config import settings
+from .services.openrouter_service import start_openrouter_client, close_openrouter_client
+from .services.summarizer import drain_summaries
+from .services.job_queue import start_job_queue, drain_job_queue
+from .services.stripe_service import close_stripe_client
+from .services.persona_registry import start_persona_registry, stop_persona_registry
+from .services.credit_ledger import start_reservation_sweeper, stop_reservation_sweeper
+from .utils.counting import load_tokenizer
 
 
 def create_app() -> FastAPI:
     app = FastAPI(title="Virtual-G API", version="0.1.0")
 
+    if settings.rate_limit_enabled:
+        # Added before CORS so it runs inside it and 429s still carry CORS headers
+        app.add_middleware(RateLimitMiddleware)
+
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["http://localhost:3000", "http://127.0.0.1:3000", "*"],
@@ -21,23 +38,43 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # Outermost, so request timings include every other middleware
+    app.add_middleware(MetricsMiddleware)
 
     # Routers
     app.include_router(auth_router, prefix="/api", tags=["auth"])
     app.include_router(chat_router, prefix="/api", tags=["chat"])
+    app.include_router(chat_ws_router, prefix="/api", tags=["chat"])
     app.include_router(usage_router, prefix="/api", tags=["usage"])
     app.include_router(upload_router, prefix="/api", tags=["upload"])
     app.include_router(sessions_router, prefix="/api", tags=["sessions"])
     app.include_router(payments_router, prefix="/api", tags=["payments"])
+    app.include_router(status_router, prefix="/api", tags=["status"])
 
-    # Static uploads (resolve relative to this file)
-    uploads_dir = Path(__file__).parent / "uploads"
-    uploads_dir.mkdir(parents=True, exist_ok=True)
-    app.mount("/uploads", StaticFiles(directory=str(uploads_dir)), name="uploads")
+    # Uploaded images and their resized variants, with long-lived cache headers
+    app.include_router(media_router, tags=["upload"])
+    app.include_router(metrics_router, tags=["status"])
 
     @app.on_event("startup")
     async def on_startup() -> None:
         await init_indexes()
+        if settings.credit_count_mode == "tokens":
+            load_tokenizer()
+        await start_openrouter_client()
+        await start_job_queue()
+        await start_persona_registry()
+        await start_reservation_sweeper()
+
+    @app.on_event("shutdown")
+    async def on_shutdown() -> None:
+        await stop_persona_registry()
+        await stop_reservation_sweeper()
+        await drain_summaries()
+        await drain_job_queue()
+        await close_openrouter_client()
+        await close_stripe_client()
+        await close_redis_clients()
+        password_hasher_pool.shutdown()
 
     return app
 
@@ -0,0 +1,195 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, TypeVar
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import REGISTRY, Collector
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Mongo round trips are milliseconds, LLM calls are seconds; one bucket set covers both
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template and status",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+CHAT_STAGE_SECONDS = Histogram(
+    "chat_stage_duration_seconds",
+    "Time spent in each stage of a chat turn",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+AUTH_LOOKUP_SECONDS = Histogram(
+    "auth_lookup_duration_seconds",
+    "Time to load the authenticated user, by whether the user cache served it",
+    ["source"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds",
+    "MongoDB command latency as reported by the driver",
+    ["command", "collection", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENROUTER_REQUEST_SECONDS = Histogram(
+    "openrouter_request_duration_seconds",
+    "OpenRouter request latency per attempt (until headers for streams)",
+    ["model", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENROUTER_FIRST_TOKEN_SECONDS = Histogram(
+    "openrouter_first_token_seconds",
+    "Time from opening an OpenRouter stream to its first content delta",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENROUTER_SLOT_WAIT_SECONDS = Histogram(
+    "openrouter_slot_wait_seconds",
+    "Time spent queued for an OpenRouter concurrency slot",
+    buckets=LATENCY_BUCKETS,
+)
+OPENROUTER_PROMPT_TOKENS = Counter(
+    "openrouter_prompt_tokens",
+    "Prompt tokens reported by OpenRouter, split by whether the provider's prefix cache served them",
+    ["model", "cache"],
+)
+OPENROUTER_COMPLETION_TOKENS = Counter(
+    "openrouter_completion_tokens",
+    "Completion tokens reported by OpenRouter",
+    ["model"],
+)
+
+
+@contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    """Record how long the block took as one chat turn stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        CHAT_STAGE_SECONDS.labels(stage=stage).observe(time.perf_counter() - start)
+
+
+async def timed_stage(stage: str, awaitable: Awaitable[T]) -> T:
+    """Await `awaitable` as one timed chat turn stage; for stages run concurrently."""
+    with time_stage(stage):
+        return await awaitable
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Feeds driver command timings into `mongo_command_duration_seconds`.
+
+    Events arrive on the driver's threads; the collection name is only on the
+    started event, so it is kept by request id until the command finishes.
+    """
+
+    def __init__(self) -> None:
+        self._collections: dict[tuple, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def _finish(self, event, outcome: str) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.labels(
+            command=event.command_name, collection=collection, outcome=outcome
+        ).observe(event.duration_micros / 1_000_000)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, "failed")
+
+
+class StatsCollector(Collector):
+    """
+    Exposes the in-process `stats()` dicts (upstream client, caches, rate
+    limiter...) as gauges at scrape time, so they need no extra bookkeeping.
+
+    Numeric values become `app_<source>_<key>`. Nested dicts are labelled
+    with `name`: `{"limited": {"chat": 3}}` gives `app_<source>_limited{name="chat"}`
+    and per-model dicts give one gauge per stat with the model as `name`.
+    """
+
+    def __init__(self, sources: dict[str, Callable[[], dict]]) -> None:
+        self._sources = sources
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        for source, stats_fn in self._sources.items():
+            try:
+                stats = stats_fn()
+            except Exception as exc:  # noqa: BLE001
+                logger.warning(f"Could not collect {source} stats: {str(exc)}")
+                continue
+            nested: dict[str, GaugeMetricFamily] = {}
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float, dict)):
+                    continue
+                if not isinstance(value, dict):
+                    yield GaugeMetricFamily(f"app_{source}_{key}", f"{source} {key}", value=value)
+                    continue
+                for inner_key, inner_value in value.items():
+                    if isinstance(inner_value, (int, float)) and not isinstance(inner_value, bool):
+                        # e.g. rate limiter {"limited": {"chat": 3}}
+                        self._add(nested, f"app_{source}_{key}", f"{source} {key}", {"name": inner_key}, inner_value)
+                    elif isinstance(inner_value, dict):
+                        # e.g. model router {"openrouter/auto": {"p50_seconds": 0.8}}
+                        for stat, stat_value in inner_value.items():
+                            if isinstance(stat_value, (int, float)) and not isinstance(stat_value, bool):
+                                self._add(nested, f"app_{source}_{stat}", f"{source} {stat}", {"name": inner_key}, stat_value)
+            yield from nested.values()
+
+    @staticmethod
+    def _add(families: dict[str, GaugeMetricFamily], name: str, doc: str, labels: dict[str, str], value: float) -> None:
+        if name not in families:
+            families[name] = GaugeMetricFamily(name, doc, labels=list(labels))
+        families[name].add_metric(list(labels.values()), value)
+
+
+def register_stats_collector(sources: dict[str, Callable[[], dict]]) -> None:
+    REGISTRY.register(StatsCollector(sources))
+
+
+class MetricsMiddleware:
+    """Times every HTTP request, labelled by route template (not raw path) and response status."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=str(status),
+            ).observe(time.perf_counter() - start)
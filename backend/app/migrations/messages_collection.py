@@ -0,0 +1,59 @@
+"""
+One-shot migration: move embedded `chat_sessions.messages` arrays into the
+`messages` collection, then drop the array from each session.
+
+Safe to re-run: messages are upserted on (session_id, legacy_index), their
+position in the embedded array, so a session that was half-migrated before
+an interruption is not duplicated, while distinct messages that share a
+timestamp and role (e.g. bulk imports) are all kept.
+
+Usage:
+    python -m app.migrations.messages_collection
+"""
+import asyncio
+import logging
+from pymongo import UpdateOne
+from ..db import get_db, init_indexes
+from ..services.message_service import MESSAGES_COLLECTION
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+async def migrate_embedded_messages() -> int:
+    db = get_db()
+    await init_indexes()
+    # Serves the upserts below; only migrated messages carry the field
+    await db[MESSAGES_COLLECTION].create_index(
+        [("session_id", 1), ("legacy_index", 1)],
+        unique=True,
+        partialFilterExpression={"legacy_index": {"$exists": True}},
+    )
+
+    migrated_sessions = 0
+    cursor = db["chat_sessions"].find({"messages": {"$exists": True}}, {"messages": 1})
+    async for session in cursor:
+        messages = session.get("messages") or []
+        for start in range(0, len(messages), BATCH_SIZE):
+            ops = [
+                UpdateOne(
+                    {"session_id": session["_id"], "legacy_index": index},
+                    {"$setOnInsert": m},
+                    upsert=True,
+                )
+                for index, m in enumerate(messages[start:start + BATCH_SIZE], start)
+            ]
+            await db[MESSAGES_COLLECTION].bulk_write(ops, ordered=False)
+        await db["chat_sessions"].update_one({"_id": session["_id"]}, {"$unset": {"messages": ""}})
+        migrated_sessions += 1
+        logger.info(f"Migrated {len(messages)} messages for session {session['_id']}")
+
+    return migrated_sessions
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    count = asyncio.run(migrate_embedded_messages())
+    print(f"Migrated {count} sessions")
@@ -0,0 +1,60 @@
+"""
+One-shot backfill of the denormalized session listing fields (title, last
+message preview, message count, created/updated timestamps) from the
+messages collection. Run after `messages_collection`; safe to re-run.
+
+Usage:
+    python -m app.migrations.session_metadata
+"""
+import asyncio
+import logging
+from pymongo import UpdateOne
+from ..db import get_db, init_indexes
+from ..services.message_service import MESSAGES_COLLECTION, message_preview, session_title
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+async def backfill_session_metadata() -> int:
+    db = get_db()
+    await init_indexes()
+
+    updated = 0
+    ops: list[UpdateOne] = []
+    async for session in db["chat_sessions"].find({}, {"_id": 1}):
+        session_id = session["_id"]
+        count = await db[MESSAGES_COLLECTION].count_documents({"session_id": session_id})
+        last = await db[MESSAGES_COLLECTION].find_one({"session_id": session_id}, sort=[("timestamp", -1)])
+        first_user = await db[MESSAGES_COLLECTION].find_one(
+            {"session_id": session_id, "role": "user"}, sort=[("timestamp", 1)]
+        )
+        created_at = session_id.generation_time
+        ops.append(UpdateOne(
+            {"_id": session_id},
+            {"$set": {
+                "title": session_title(first_user) if first_user else None,
+                "last_message_preview": message_preview(last) if last else "",
+                "message_count": count,
+                "created_at": created_at,
+                "updated_at": last["timestamp"] if last else created_at,
+            }},
+        ))
+        if len(ops) >= BATCH_SIZE:
+            await db["chat_sessions"].bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await db["chat_sessions"].bulk_write(ops, ordered=False)
+        updated += len(ops)
+
+    logger.info(f"Backfilled metadata for {updated} sessions")
+    return updated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    count = asyncio.run(backfill_session_metadata())
+    print(f"Backfilled {count} sessions")
@@ -8,6 +8,8 @@ class UserDocument(TypedDict, total=False):
     password_hash: str
     credits_used: int
     credits_available: int  # Available tokens that can be used
+    credits_reserved: int  # Held by chat turns still in progress
+    pending_reservations: list[dict]  # One per hold: id, amount, reserved_at, expires_at
     total_credits_purchased: int  # Total credits ever purchased
 
 
@@ -16,15 +18,88 @@ MessageType = Literal["text", "image"]
 
 
 class MessageDocument(TypedDict, total=False):
+    _id: str
+    session_id: str
     role: MessageRole
     content: str
     timestamp: datetime
     type: MessageType
+    legacy_index: int  # Position in the old embedded array, for messages moved by the migration
 
 
 class ChatSessionDocument(TypedDict, total=False):
     _id: str
     user_id: str
-    messages: list[MessageDocument]
+    title: Optional[str]  # From the first user message, set once
+    last_message_preview: str
+    message_count: int
+    created_at: datetime
+    updated_at: datetime
+    summary: str
+    summary_until: datetime
+    turns_since_summary: int
+    persona: str  # Name in `personas`; absent means the default persona
+    persona_version: int  # Pinned version; absent means always the latest
+    credits_used: int  # Credits billed for the session's turns
+    recent_turns: list[str]  # Reservation ids of the latest turns applied, so retries don't count twice
+
+
+CreditLedgerEntryType = Literal["reserve", "settle", "release"]
+
+
+class CreditLedgerEntry(TypedDict, total=False):
+    _id: str
+    reservation_id: str
+    user_id: str
+    type: CreditLedgerEntryType
+    amount: int
+    timestamp: datetime
+    session_id: str
+    reason: str
+
+
+class PersonaDocument(TypedDict, total=False):
+    _id: str
+    name: str
+    version: int  # Unique per name; versions are never edited, a change inserts the next one
+    system_prompt: str
+    created_at: datetime
+
+
+class UsageEventDocument(TypedDict, total=False):
+    _id: str
+    user_id: str
+    session_id: str
+    persona: str
+    model: str  # The model that served the reply, or "cache" for a response cache hit
+    credits: int
+    user_credits: int
+    ai_credits: int
+    prompt_tokens: int  # As reported by the provider
+    cached_prompt_tokens: int
+    completion_tokens: int
+    timestamp: datetime  # Expire after USAGE_EVENT_RETENTION_DAYS
+
+
+class UsageRollupDocument(TypedDict, total=False):
+    _id: str
+    user_id: str  # "*:<shard>" for all users, summed over the shards on read
+    granularity: Literal["hour", "day"]
+    start: datetime  # Start of the UTC hour or day; unique with user_id and granularity
+    turns: int
+    credits: int
+    user_credits: int
+    ai_credits: int
+    prompt_tokens: int
+    cached_prompt_tokens: int
+    completion_tokens: int
+    models: dict[str, dict[str, int]]  # URL-quoted model id -> {"turns", "credits"}
 
 
+class ProcessedPaymentDocument(TypedDict, total=False):
+    _id: str  # Stripe PaymentIntent id
+    user_email: str
+    credits: int
+    source: Literal["webhook", "confirm"]
+    event_id: Optional[str]
+    processed_at: datetime
@@ -0,0 +1,264 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Protocol
+import jwt
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from .config import settings
+from .cache import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitStore(Protocol):
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        """Take one token from the bucket at `key`. Returns 0 if allowed, else seconds until a token is available."""
+        ...
+
+    async def refund(self, key: str, burst: int) -> None:
+        """Give back a token taken from the bucket at `key`."""
+        ...
+
+
+class LocalTokenBucketStore:
+    """
+    Token buckets held in process memory.
+
+    Good for a single worker, and as a stand-in for the shared store in tests.
+    The least recently used buckets are dropped beyond `max_keys`; a dropped
+    bucket simply comes back full.
+    """
+
+    def __init__(self, max_keys: int) -> None:
+        self._max_keys = max_keys
+        self._buckets: OrderedDict[str, list[float]] = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(burst), now]
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+    async def refund(self, key: str, burst: int) -> None:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(burst, bucket[0] + 1)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# Refill and take in one round trip. Uses the server clock so workers on different hosts agree.
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+_REFUND_SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+  redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+end
+"""
+
+
+class RedisTokenBucketStore:
+    """Token buckets shared by every worker through Redis."""
+
+    def __init__(self, url: str, prefix: str) -> None:
+        client = get_redis_client(url)
+        self._script = client.register_script(_TAKE_SCRIPT)
+        self._refund_script = client.register_script(_REFUND_SCRIPT)
+        self._prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return float(await self._script(keys=[self._prefix + key], args=[rate, burst]))
+
+    async def refund(self, key: str, burst: int) -> None:
+        await self._refund_script(keys=[self._prefix + key], args=[burst])
+
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    """
+    Limits for one group of routes.
+
+    Each user (or IP, without a valid token) gets a bucket of `burst` tokens
+    refilled at `rate` per second. A non-zero `global_rate` adds one bucket
+    shared by all callers of the group.
+    """
+
+    group: str
+    paths: tuple[str, ...]
+    methods: frozenset[str]
+    rate: float
+    burst: int
+    global_rate: float = 0.0
+    global_burst: int = 0
+    by_user: bool = True
+
+    def matches(self, method: str, path: str) -> bool:
+        return method in self.methods and path.startswith(self.paths)
+
+
+def default_rules() -> list[RateLimitRule]:
+    return [
+        RateLimitRule(
+            group="chat",
+            paths=("/api/chat",),
+            methods=frozenset({"POST"}),
+            rate=settings.rate_limit_chat_rate,
+            burst=settings.rate_limit_chat_burst,
+            global_rate=settings.rate_limit_chat_global_rate,
+            global_burst=settings.rate_limit_chat_global_burst,
+        ),
+        RateLimitRule(
+            group="auth",
+            # No token yet on these routes, so buckets are per IP
+            paths=("/api/login", "/api/register"),
+            methods=frozenset({"POST"}),
+            rate=settings.rate_limit_auth_rate,
+            burst=settings.rate_limit_auth_burst,
+            by_user=False,
+        ),
+    ]
+
+
+def _create_store() -> RateLimitStore:
+    if settings.rate_limit_backend == "redis":
+        if not settings.redis_url:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires REDIS_URL")
+        return RedisTokenBucketStore(settings.redis_url, prefix="vg:rl:")
+    return LocalTokenBucketStore(max_keys=settings.rate_limit_max_keys)
+
+
+class RateLimiter:
+    """Applies the first matching rule to a request, with allowed/limited counters per group."""
+
+    def __init__(self, store: RateLimitStore, rules: list[RateLimitRule]) -> None:
+        self.store = store
+        self.rules = rules
+        self.allowed: dict[str, int] = {rule.group: 0 for rule in rules}
+        self.limited: dict[str, int] = {rule.group: 0 for rule in rules}
+        self.store_errors = 0
+
+    def match(self, method: str, path: str) -> RateLimitRule | None:
+        for rule in self.rules:
+            if rule.matches(method, path):
+                return rule
+        return None
+
+    async def check(self, rule: RateLimitRule, caller: str) -> float:
+        """
+        Returns 0 if the request may proceed, else the Retry-After in seconds.
+
+        The caller's bucket is checked first, so one caller's rejected requests
+        never drain the shared bucket; when the shared bucket is what rejects
+        the request, the caller's token is given back.
+        """
+        try:
+            key = f"{rule.group}:{caller}"
+            wait = await self.store.take(key, rule.rate, rule.burst)
+            if not wait and rule.global_rate > 0:
+                wait = await self.store.take(f"{rule.group}:*", rule.global_rate, rule.global_burst)
+                if wait:
+                    await self.store.refund(key, rule.burst)
+        except Exception as exc:
+            # A limiter outage must not take the API down with it
+            self.store_errors += 1
+            logger.warning(f"Rate limit store error, allowing request: {str(exc)}")
+            wait = 0.0
+        if wait:
+            self.limited[rule.group] += 1
+        else:
+            self.allowed[rule.group] += 1
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "backend": settings.rate_limit_backend,
+            "allowed": dict(self.allowed),
+            "limited": dict(self.limited),
+            "store_errors": self.store_errors,
+        }
+
+
+rate_limiter = RateLimiter(_create_store(), default_rules())
+
+
+def _caller_key(scope: Scope, by_user: bool) -> str:
+    if by_user:
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and token:
+                    try:
+                        payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
+                    except jwt.PyJWTError:
+                        break
+                    if payload.get("sub"):
+                        return f"user:{payload['sub']}"
+                break
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class RateLimitMiddleware:
+    """
+    Token-bucket rate limiting for the route groups in `rate_limiter.rules`.
+
+    Written as plain ASGI middleware so streaming responses pass straight
+    through; requests outside every group are not touched.
+    """
+
+    def __init__(self, app: ASGIApp, limiter: RateLimiter | None = None) -> None:
+        self.app = app
+        self.limiter = limiter or rate_limiter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rule = self.limiter.match(scope["method"], scope["path"])
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+        wait = await self.limiter.check(rule, _caller_key(scope, rule.by_user))
+        if wait:
+            response = JSONResponse(
+                {"detail": "Too many requests, please slow down"},
+                status_code=429,
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -3,7 +3,7 @@ from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import EmailStr
 from ..db import get_db
 from ..schemas import UserCreate, Token
-from ..auth import hash_password, verify_password, create_access_token
+from ..auth import hash_password_async, verify_password_async, create_access_token
 
 
 router = APIRouter()
@@ -17,7 +17,7 @@ async def register_user(user: UserCreate):
         raise HTTPException(status_code=400, detail="Email already registered")
     doc = {
         "email": user.email, 
-        "password_hash": hash_password(user.password), 
+        "password_hash": await hash_password_async(user.password),
         "credits_used": 0,
         "credits_available": 1000,  # Give new users 1000 free credits
         "total_credits_purchased": 0
@@ -31,7 +31,7 @@ async def register_user(user: UserCreate):
 async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
     db = get_db()
     user = await db["users"].find_one({"email": form_data.username})
-    if not user or not verify_password(form_data.password, user.get("password_hash", "")):
+    if not user or not await verify_password_async(form_data.password, user.get("password_hash", "")):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
     token = create_access_token(subject=form_data.username)
     return {"access_token": token, "token_type": "bearer"}
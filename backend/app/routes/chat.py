@@ -1,62 +1,67 @@
+import asyncio
+import json
+import logging
 from datetime import datetime, timezone
-from fastapi import APIRouter, Depends, HTTPException
-from ..auth import get_current_user
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from bson import ObjectId
+from pymongo import ReturnDocument
+from ..auth import get_current_user, invalidate_cached_user
 from ..db import get_db
 from ..schemas import ChatRequest, ChatResponse, ChatHistoryResponse, ChatMessage
-from ..utils.credits import count_words
-from ..services.openrouter_service import fetch_openrouter_chat_completion
+from ..utils.counting import count_credits
+from ..services.response_cache import cached_chat_completion, cached_stream_chat_completion
+from ..services.openrouter_service import Deadline, DeadlineExceededError, UpstreamBusyError, UpstreamUsage
+from ..services.message_service import fetch_messages_page, fetch_recent_messages, new_session_doc
+from ..services.job_queue import job_queue
+from ..services.turn_service import new_turn, save_turn, submit_turn
+from ..services.usage_service import usage_event
+from ..config import settings
+from ..metrics import time_stage, timed_stage
+from ..utils.context import build_context, prompt_token_stats
+from ..utils.cursor import next_cursor, parse_cursor_id
+from ..services.summarizer import schedule_summary
+from ..services.persona_registry import Persona, persona_registry
+from ..services.credit_ledger import CreditReservation, credits_available, reserve_credits, release_credits
 
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
 async def _get_or_create_session(db, user_id: str):
-    session = await db["chat_sessions"].find_one({"user_id": user_id})
-    if session:
-        return session
-    doc = {"user_id": user_id, "messages": []}
-    result = await db["chat_sessions"].insert_one(doc)
-    doc["_id"] = result.inserted_id
-    return doc
-
-
-@router.get("/chat/history", response_model=ChatHistoryResponse)
-async def get_chat_history(current_user=Depends(get_current_user)):
-    db = get_db()
-    session = await _get_or_create_session(db, current_user["email"])
-    messages = [
-        ChatMessage(
-            role=m.get("role", "user"),
-            content=m.get("content", ""),
-            timestamp=m.get("timestamp", datetime.now(timezone.utc)),
-            type=m.get("type", "text"),
-        )
-        for m in session.get("messages", [])
-    ]
-    return {"session_id": str(session.get("_id", "")), "messages": messages}
+    # One round-trip whether or not the default session exists yet
+    doc = new_session_doc(user_id)
+    del doc["user_id"]  # Taken from the filter on insert
+    return await db["chat_sessions"].find_one_and_update(
+        {"user_id": user_id},
+        {"$setOnInsert": doc},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
 
 
-@router.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(payload: ChatRequest, session_id: str = None, current_user=Depends(get_current_user)):
-    if not payload.text and not payload.image_url:
-        raise HTTPException(status_code=400, detail="Provide text or image_url")
+async def _reserve_credits(db, payload: ChatRequest, current_user) -> CreditReservation:
+    user_input_words = count_credits(payload.text) + count_credits(payload.image_url)
 
-    db = get_db()
-    
-    # Check if user has sufficient credits
-    user_credits_available = current_user.get("credits_available", 0)
-    user_input_words = count_words(payload.text) + count_words(payload.image_url)
-    
     # Estimate AI response words (rough estimate based on input)
     estimated_ai_words = min(max(user_input_words * 2, 50), 500)  # 2x input, min 50, max 500
     estimated_total_words = user_input_words + estimated_ai_words
-    
-    if user_credits_available < estimated_total_words:
+
+    # Hold the estimate up front; settled against the real word count once the reply is in
+    reservation = await reserve_credits(db, current_user["email"], estimated_total_words)
+    # Either the balance just moved, or the cached one was too high to be trusted
+    await invalidate_cached_user(current_user["email"])
+    if reservation is None:
+        # The cached balance may be stale; report the one the reservation was refused against
+        user_credits_available = await credits_available(db, current_user["email"])
         # Calculate how many credits are needed
-        credits_needed = estimated_total_words - user_credits_available
+        credits_needed = max(estimated_total_words - user_credits_available, 1)
         # Round up to nearest 1000 for payment
         credits_to_purchase = ((credits_needed - 1) // 1000 + 1) * 1000
-        
+
         raise HTTPException(
             status_code=402,  # Payment Required
             detail={
@@ -67,48 +72,88 @@ async def chat_endpoint(payload: ChatRequest, session_id: str = None, current_us
                 "suggested_purchase": credits_to_purchase
             }
         )
-    
-    if session_id:
-        # Use specific session
-        from bson import ObjectId
-        try:
-            object_id = ObjectId(session_id)
-            session = await db["chat_sessions"].find_one({
-                "_id": object_id,
-                "user_id": current_user["email"]
-            })
-            if not session:
-                raise HTTPException(status_code=404, detail="Session not found")
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid session ID")
-    else:
+    return reservation
+
+
+async def _resolve_session(db, session_id: str | None, current_user):
+    if not session_id:
         # Get or create default session
-        session = await _get_or_create_session(db, current_user["email"])
+        return await _get_or_create_session(db, current_user["email"])
+
+    # Use specific session
+    try:
+        object_id = ObjectId(session_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+    session = await db["chat_sessions"].find_one({
+        "_id": object_id,
+        "user_id": current_user["email"]
+    })
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
 
-    now = datetime.now(timezone.utc)
+
+async def _open_turn(db, payload: ChatRequest, session_id: str | None, current_user):
+    """Resolve the session and reserve credits concurrently; neither depends on the other."""
+    session, reservation = await asyncio.gather(
+        timed_stage("session_fetch", _resolve_session(db, session_id, current_user)),
+        timed_stage("credit_reserve", _reserve_credits(db, payload, current_user)),
+        return_exceptions=True,
+    )
+    if isinstance(session, BaseException):
+        if isinstance(reservation, CreditReservation):
+            await _abort_turn(db, reservation, "invalid_session")
+        raise session
+    if isinstance(reservation, BaseException):
+        raise reservation
+    return session, reservation
+
+
+async def _build_turn(db, payload: ChatRequest, session) -> tuple[dict, list[dict[str, str]], Persona]:
+    """Build the user message, the LLM message list and the session's persona for this turn."""
     user_message: dict = {
         "role": "user",
         "content": payload.text or payload.image_url or "",
-        "timestamp": now,
+        "timestamp": datetime.now(timezone.utc),
         "type": "image" if payload.image_url and not payload.text else "text",
     }
-    # Append user message
-    await db["chat_sessions"].update_one(
-        {"_id": session["_id"]},
-        {"$push": {"messages": user_message}},
+    # The previous turn may still be queued for writing
+    await job_queue.wait_for_key(session["_id"])
+    # Only the tail of the history can fit the prompt budget, so never load the whole session.
+    # Turns already folded into the running summary are skipped.
+    history = await fetch_recent_messages(
+        db, session["_id"], settings.context_max_messages, after=session.get("summary_until")
     )
 
     # Build chat history messages for LLM
-    history = session.get("messages", []) + [user_message]
-    llm_messages = []
-    for m in history:
-        content = m.get("content", "")
-        if m.get("type") == "image":
-            content = f"[User sent an image at {content}]. Provide a flirty, friendly response describing what you might say."
-        llm_messages.append({"role": "user" if m.get("role") == "user" else "assistant", "content": content})
+    history.append(user_message)
+    # From memory; the registry follows new persona versions in the background
+    persona = persona_registry.get(session.get("persona"), session.get("persona_version"))
+    llm_messages, prompt_tokens = build_context(
+        history, settings.openrouter_model, summary=session.get("summary"), system_prompt=persona.system_prompt
+    )
+    prompt_token_stats.record(prompt_tokens)
+    return user_message, llm_messages, persona
+
 
-    ai_text = await fetch_openrouter_chat_completion(llm_messages)
+async def _finish_turn(
+    payload: ChatRequest,
+    session,
+    reservation: CreditReservation,
+    user_message: dict,
+    ai_text: str,
+    persona: Persona,
+    upstream: UpstreamUsage,
+) -> dict:
+    """
+    Persist the turn, settle its credit reservation and record its usage.
 
+    The user message is only written once there is a reply, so a failed
+    upstream call leaves no orphaned message behind. With the job queue on
+    the writes happen after the reply is returned; the reservation already
+    holds the credits, so the balance can't be overspent meanwhile.
+    """
     ai_message: dict = {
         "role": "ai",
         "content": ai_text,
@@ -116,28 +161,188 @@ async def chat_endpoint(payload: ChatRequest, session_id: str = None, current_us
         "type": "text",
     }
 
-    await db["chat_sessions"].update_one(
-        {"_id": session["_id"]},
-        {"$push": {"messages": ai_message}},
-    )
-
     # Credits: words in user input + AI output
-    user_words = count_words(payload.text) + count_words(payload.image_url)
-    ai_words = count_words(ai_text)
+    user_words = count_credits(payload.text) + count_credits(payload.image_url)
+    ai_words = count_credits(ai_text)
     total_increment = user_words + ai_words
-    
-    # Deduct from available credits and track usage
-    await db["users"].update_one(
-        {"email": current_user["email"]},
-        {
-            "$inc": {
-                "credits_used": total_increment,
-                "credits_available": -total_increment
-            }
-        },
+
+    event = usage_event(
+        session["_id"], reservation.user_email, persona.name, user_words, ai_words, upstream, ai_message["timestamp"]
     )
+    turn = new_turn(session["_id"], [user_message, ai_message], reservation, total_increment, event)
+    if settings.job_queue_enabled:
+        submit_turn(turn)
+    else:
+        with time_stage("turn_commit"):
+            await save_turn(turn)
+
+    if settings.summary_enabled and session.get("turns_since_summary", 0) + 1 >= settings.summary_every_turns:
+        # Runs off the request path; the next turns pick up the new summary once it lands
+        schedule_summary(session["_id"])
+    return ai_message
+
+
+async def _abort_turn(db, reservation: CreditReservation, reason: str) -> None:
+    await release_credits(db, reservation, reason)
+    await invalidate_cached_user(reservation.user_email)
+
+
+def _upstream_http_error(exc: RuntimeError) -> HTTPException:
+    if isinstance(exc, UpstreamBusyError):
+        return HTTPException(
+            status_code=429,
+            detail="The AI is handling too many conversations right now, please retry shortly",
+            headers={"Retry-After": str(int(exc.retry_after or 1))},
+        )
+    if isinstance(exc, DeadlineExceededError):
+        return HTTPException(status_code=504, detail="The AI took too long to respond, please try again")
+    return HTTPException(status_code=502, detail="The AI service is unavailable, please try again")
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@router.get("/chat/history", response_model=ChatHistoryResponse)
+async def get_chat_history(
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    current_user=Depends(get_current_user),
+):
+    """The default session's messages; the whole history unless a cursor or `limit` asks for a page"""
+    cursor_id = parse_cursor_id(before_id)
+    db = get_db()
+    session = await _get_or_create_session(db, current_user["email"])
+    await job_queue.wait_for_key(session["_id"])
+    page, has_more = await fetch_messages_page(db, session["_id"], before=before, limit=limit, before_id=cursor_id)
+    messages = [
+        ChatMessage(
+            role=m.get("role", "user"),
+            content=m.get("content", ""),
+            timestamp=m.get("timestamp", datetime.now(timezone.utc)),
+            type=m.get("type", "text"),
+        )
+        for m in page
+    ]
+    return {
+        "session_id": str(session.get("_id", "")),
+        "messages": messages,
+        "has_more": has_more,
+        **next_cursor(page[0] if has_more else None, "timestamp"),
+    }
+
+
+@router.post("/chat", response_model=ChatResponse)
+async def chat_endpoint(payload: ChatRequest, session_id: str = None, current_user=Depends(get_current_user)):
+    if not payload.text and not payload.image_url:
+        raise HTTPException(status_code=400, detail="Provide text or image_url")
+
+    deadline = Deadline(settings.chat_deadline_seconds)
+    upstream = UpstreamUsage()
+    db = get_db()
+    session, reservation = await _open_turn(db, payload, session_id, current_user)
+
+    try:
+        with time_stage("context_build"):
+            user_message, llm_messages, persona = await _build_turn(db, payload, session)
+        with time_stage("upstream_llm"):
+            ai_text = await cached_chat_completion(
+                llm_messages,
+                deadline=deadline,
+                system_prompt=persona.system_prompt,
+                usage=upstream,
+                session_id=str(session.get("_id", "")),
+            )
+    except RuntimeError as exc:
+        logger.error(f"Chat upstream error for user {current_user['email']}: {str(exc)}")
+        await _abort_turn(db, reservation, "upstream_error")
+        raise _upstream_http_error(exc)
+    except Exception:
+        await _abort_turn(db, reservation, "upstream_error")
+        raise
+    ai_message = await _finish_turn(payload, session, reservation, user_message, ai_text, persona, upstream)
 
     reply = ChatMessage(**ai_message)
     return {"reply": reply, "session_id": str(session.get("_id", ""))}
 
 
+@router.post("/chat/stream")
+async def chat_stream_endpoint(payload: ChatRequest, session_id: str = None, current_user=Depends(get_current_user)):
+    """Stream the AI reply as server-sent events (`start`, `delta`..., then `done` or `error`)."""
+    if not payload.text and not payload.image_url:
+        raise HTTPException(status_code=400, detail="Provide text or image_url")
+
+    deadline = Deadline(settings.chat_deadline_seconds)
+    db = get_db()
+    session, reservation = await _open_turn(db, payload, session_id, current_user)
+    session_key = str(session.get("_id", ""))
+
+    try:
+        with time_stage("context_build"):
+            user_message, llm_messages, persona = await _build_turn(db, payload, session)
+    except Exception:
+        await _abort_turn(db, reservation, "start_failed")
+        raise
+
+    settled = False
+
+    async def event_stream():
+        nonlocal settled
+        upstream = UpstreamUsage()
+        parts: list[str] = []
+        ai_message = None
+        failed = False
+        try:
+            yield _sse("start", {"session_id": session_key})
+            # Includes time the client takes to read the deltas; see openrouter_first_token_seconds too
+            with time_stage("upstream_llm_stream"):
+                async for delta in cached_stream_chat_completion(
+                    llm_messages,
+                    deadline=deadline,
+                    system_prompt=persona.system_prompt,
+                    usage=upstream,
+                    session_id=session_key,
+                ):
+                    parts.append(delta)
+                    yield _sse("delta", {"content": delta})
+        except RuntimeError as exc:
+            logger.error(f"Chat stream error for session {session_key}: {str(exc)}")
+            failed = True
+            error = _upstream_http_error(exc)
+            yield _sse("error", {"status": error.status_code, "detail": error.detail})
+        except Exception as exc:  # noqa: BLE001
+            logger.error(f"Chat stream failed for session {session_key}: {str(exc)}")
+            failed = True
+            yield _sse("error", {"status": 500, "detail": "Internal server error"})
+        finally:
+            # Runs on completion, upstream error and client disconnect alike. Whatever was
+            # generated is saved and billed; shielded so a disconnect can't abort the writes.
+            settled = True
+            ai_text = "".join(parts).strip()
+            if ai_text:
+                ai_message = await asyncio.shield(
+                    _finish_turn(payload, session, reservation, user_message, ai_text, persona, upstream)
+                )
+            else:
+                await asyncio.shield(_abort_turn(db, reservation, "empty_reply"))
+        if ai_message and not failed:
+            reply = ChatMessage(**ai_message)
+            yield _sse("done", {"reply": reply.model_dump(mode="json"), "session_id": session_key})
+
+    stream = event_stream()
+
+    async def close_stream() -> None:
+        # Runs once the response is over, disconnects included. Closing the generator
+        # runs its `finally` now rather than whenever it is garbage collected; one that
+        # never started (the client left before the first chunk) has no `finally` to run.
+        await stream.aclose()
+        if not settled:
+            await _abort_turn(db, reservation, "disconnected")
+
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(close_stream),
+    )
@@ -0,0 +1,338 @@
+import asyncio
+import json
+import logging
+import math
+from typing import Any, Optional
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
+from ..auth import authenticate_token, load_user
+from ..config import settings
+from ..db import get_db
+from ..metrics import time_stage, timed_stage
+from ..rate_limit import rate_limiter
+from ..schemas import ChatMessage, ChatRequest
+from ..services.openrouter_service import Deadline, UpstreamUsage
+from ..services.response_cache import cached_stream_chat_completion
+from .chat import _abort_turn, _build_turn, _finish_turn, _open_turn, _reserve_credits, _upstream_http_error
+
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+_stats = {"connections": 0, "turns": 0, "cancelled": 0, "slow_consumers": 0, "idle_timeouts": 0}
+
+
+def stats() -> dict[str, int]:
+    return dict(_stats)
+
+
+class SlowConsumerError(Exception):
+    """The client stopped reading while replies were queued for it."""
+
+
+class ChatConnection:
+    """
+    One authenticated chat socket.
+
+    The user and every session it has touched are looked up once and kept
+    for the life of the connection. Turns for different sessions run
+    concurrently (up to `chat_ws_max_turns`); turns for the same session
+    run one after another, as each one's context includes the previous reply.
+
+    All outgoing frames go through one bounded queue with a single writer.
+    A turn waits for room before sending its next delta, so a slow client
+    slows its own upstream stream down; one that falls `chat_ws_send_timeout`
+    behind is disconnected.
+    """
+
+    def __init__(self, websocket: WebSocket, user: dict) -> None:
+        self.websocket = websocket
+        self.user = user
+        self._sessions: dict[str, dict] = {}
+        self._session_locks: dict[str, asyncio.Lock] = {}
+        self._turns: dict[str, asyncio.Task] = {}
+        self._cancelled: set[str] = set()
+        self._outbox: asyncio.Queue[dict] = asyncio.Queue(maxsize=settings.chat_ws_send_queue_size)
+        self._closed = asyncio.Event()
+        self._slow = False
+
+    async def run(self) -> None:
+        tasks = [
+            asyncio.create_task(self._write()),
+            asyncio.create_task(self._heartbeat()),
+            asyncio.create_task(self._read()),
+            asyncio.create_task(self._closed.wait()),
+        ]
+        try:
+            # Disconnect, idle timeout, a failed send or a slow client all end the connection
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._closed.set()
+            turns = list(self._turns.values())
+            for task in tasks + turns:
+                task.cancel()
+            # Turns save whatever was generated on the way out
+            await asyncio.gather(*tasks, *turns, return_exceptions=True)
+            if self._slow:
+                try:
+                    await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Client is not reading")
+                except Exception:  # noqa: BLE001
+                    pass
+
+    async def send(self, event: dict) -> None:
+        try:
+            self._outbox.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            pass
+        # Not wait_for: it can swallow a cancel (e.g. the client's) that lands as the put completes
+        put = asyncio.ensure_future(self._outbox.put(event))
+        try:
+            done, _ = await asyncio.wait({put}, timeout=settings.chat_ws_send_timeout)
+        finally:
+            put.cancel()
+        if not done:
+            _stats["slow_consumers"] += 1
+            self._slow = True
+            self._closed.set()
+            raise SlowConsumerError()
+
+    def _send_nowait(self, event: dict) -> None:
+        """For frames that are fine to drop when the client is already behind."""
+        try:
+            self._outbox.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def _write(self) -> None:
+        while True:
+            event = await self._outbox.get()
+            await self.websocket.send_text(json.dumps(event, default=str))
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(settings.chat_ws_heartbeat_interval)
+            self._send_nowait({"type": "ping"})
+
+    async def _read(self) -> None:
+        while True:
+            try:
+                frame = await asyncio.wait_for(self.websocket.receive(), timeout=settings.chat_ws_idle_timeout)
+            except asyncio.TimeoutError:
+                _stats["idle_timeouts"] += 1
+                await self.websocket.close(code=status.WS_1001_GOING_AWAY, reason="Idle timeout")
+                return
+            except WebSocketDisconnect:
+                return
+            if frame["type"] == "websocket.disconnect":
+                return
+            # receive_text() would raise KeyError on a binary frame and drop the connection
+            if frame.get("text") is None:
+                await self.send(_error_event(None, 400, "Frames must be text"))
+                continue
+            try:
+                message = json.loads(frame["text"])
+                kind = message.get("type")
+            except (ValueError, AttributeError):
+                await self.send(_error_event(None, 400, "Frames must be JSON objects"))
+                continue
+
+            if kind == "ping":
+                await self.send({"type": "pong"})
+            elif kind == "pong":
+                pass  # Receiving it is enough to keep the connection alive
+            elif kind == "chat":
+                await self._start_turn(message)
+            elif kind == "cancel":
+                task = self._turns.get(str(message.get("id")))
+                if task is not None:
+                    self._cancelled.add(str(message.get("id")))
+                    task.cancel()
+            else:
+                await self.send(_error_event(message.get("id"), 400, f"Unknown message type: {kind}"))
+
+    async def _start_turn(self, message: dict) -> None:
+        turn_id = str(message.get("id") or "")
+        if not turn_id:
+            await self.send(_error_event(None, 400, "Chat messages need an id"))
+            return
+        if turn_id in self._turns:
+            await self.send(_error_event(turn_id, 409, "A turn with this id is already running"))
+            return
+        if len(self._turns) >= settings.chat_ws_max_turns:
+            await self.send(_error_event(turn_id, 429, "Too many replies in progress on this connection"))
+            return
+        try:
+            payload = ChatRequest(text=message.get("text"), image_url=message.get("image_url"))
+        except ValidationError:
+            await self.send(_error_event(turn_id, 400, "Invalid chat message"))
+            return
+        if not payload.text and not payload.image_url:
+            await self.send(_error_event(turn_id, 400, "Provide text or image_url"))
+            return
+        if settings.rate_limit_enabled:
+            # Turns over the socket draw from the same buckets as POST /api/chat
+            rule = rate_limiter.match("POST", "/api/chat")
+            if rule is not None:
+                wait = await rate_limiter.check(rule, f"user:{self.user['email']}")
+                if wait:
+                    await self.send(_error_event(turn_id, 429, "Too many requests, please slow down", retry_after=wait))
+                    return
+        session_id = message.get("session_id") or None
+        task = asyncio.create_task(self._turn(turn_id, session_id, payload))
+        self._turns[turn_id] = task
+        task.add_done_callback(lambda _: self._turns.pop(turn_id, None))
+
+    async def _turn(self, turn_id: str, session_id: Optional[str], payload: ChatRequest) -> None:
+        _stats["turns"] += 1
+        try:
+            async with self._session_locks.setdefault(session_id or "", asyncio.Lock()):
+                await self._run_turn(turn_id, session_id, payload)
+        except asyncio.CancelledError:
+            if turn_id in self._cancelled:
+                self._cancelled.discard(turn_id)
+                _stats["cancelled"] += 1
+                self._send_nowait({"type": "cancelled", "id": turn_id})
+            raise
+        except SlowConsumerError:
+            pass
+        except HTTPException as exc:
+            retry_after = (exc.headers or {}).get("Retry-After")
+            await self._send_if_open(_error_event(turn_id, exc.status_code, exc.detail, retry_after=retry_after))
+        except Exception as exc:  # noqa: BLE001
+            logger.error(f"Chat socket turn failed for {self.user['email']}: {str(exc)}")
+            await self._send_if_open(_error_event(turn_id, 500, "Internal server error"))
+
+    async def _send_if_open(self, event: dict) -> None:
+        if not self._closed.is_set():
+            try:
+                await self.send(event)
+            except SlowConsumerError:
+                pass
+
+    async def _open_turn(self, db, session_id: Optional[str], payload: ChatRequest):
+        try:
+            return await self._reserve(db, session_id, payload)
+        except HTTPException as exc:
+            if exc.status_code != 402:
+                raise
+        # The cached balance is stale after earlier turns: reload it so the error is
+        # accurate, and so credits bought since the socket opened count
+        self.user = await load_user(self.user["email"]) or self.user
+        return await self._reserve(db, session_id, payload)
+
+    async def _reserve(self, db, session_id: Optional[str], payload: ChatRequest):
+        """Like the HTTP path, but a session resolved earlier on this connection is reused."""
+        key = session_id or ""
+        session = self._sessions.get(key)
+        if session is not None:
+            return session, await timed_stage("credit_reserve", _reserve_credits(db, payload, self.user))
+        session, reservation = await _open_turn(db, payload, session_id, self.user)
+        self._sessions[key] = session
+        return session, reservation
+
+    async def _run_turn(self, turn_id: str, session_id: Optional[str], payload: ChatRequest) -> None:
+        deadline = Deadline(settings.chat_deadline_seconds)
+        upstream = UpstreamUsage()
+        db = get_db()
+        session, reservation = await self._open_turn(db, session_id, payload)
+        session_key = str(session.get("_id", ""))
+
+        try:
+            with time_stage("context_build"):
+                user_message, llm_messages, persona = await _build_turn(db, payload, session)
+            await self.send({"type": "start", "id": turn_id, "session_id": session_key})
+        except BaseException:
+            await asyncio.shield(_abort_turn(db, reservation, "start_failed"))
+            raise
+
+        parts: list[str] = []
+        ai_message = None
+        failed = False
+        try:
+            with time_stage("upstream_llm_stream"):
+                async for delta in cached_stream_chat_completion(
+                    llm_messages,
+                    deadline=deadline,
+                    system_prompt=persona.system_prompt,
+                    usage=upstream,
+                    session_id=session_key,
+                ):
+                    parts.append(delta)
+                    await self.send({"type": "delta", "id": turn_id, "content": delta})
+        except RuntimeError as exc:
+            logger.error(f"Chat socket stream error for session {session_key}: {str(exc)}")
+            failed = True
+            error = _upstream_http_error(exc)
+            retry_after = (error.headers or {}).get("Retry-After")
+            await self.send(_error_event(turn_id, error.status_code, error.detail, retry_after=retry_after))
+        finally:
+            # As with the SSE endpoint: completion, upstream error, cancel and disconnect
+            # all save and bill what was generated; shielded so cancelling can't abort the writes
+            ai_text = "".join(parts).strip()
+            if ai_text:
+                ai_message = await asyncio.shield(
+                    _finish_turn(payload, session, reservation, user_message, ai_text, persona, upstream)
+                )
+                self._count_turn(session_id or "", session)
+            else:
+                await asyncio.shield(_abort_turn(db, reservation, "empty_reply"))
+        if ai_message and not failed:
+            reply = ChatMessage(**ai_message)
+            await self.send({
+                "type": "done",
+                "id": turn_id,
+                "session_id": session_key,
+                "reply": reply.model_dump(mode="json"),
+            })
+
+    def _count_turn(self, key: str, session: dict) -> None:
+        """Keep the cached session's summary counter in step with the one in the database."""
+        turns = session.get("turns_since_summary", 0) + 1
+        if settings.summary_enabled and turns >= settings.summary_every_turns:
+            # `_finish_turn` scheduled a summary update; reload the session to pick it up
+            self._sessions.pop(key, None)
+        else:
+            session["turns_since_summary"] = turns
+
+
+def _error_event(turn_id: Any, status_code: int, detail: Any, retry_after: Any = None) -> dict:
+    event = {"type": "error", "id": turn_id, "status": status_code, "detail": detail}
+    if retry_after:
+        event["retry_after"] = max(1, math.ceil(float(retry_after)))
+    return event
+
+
+def _bearer_token(websocket: WebSocket) -> Optional[str]:
+    # Browsers cannot set headers on a WebSocket handshake, so the query string is accepted too
+    token = websocket.query_params.get("token")
+    if token:
+        return token
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" and token else None
+
+
+@router.websocket("/chat/ws")
+async def chat_socket(websocket: WebSocket):
+    """
+    Chat over one long-lived socket instead of a POST per turn.
+
+    Client frames are JSON: `{"type": "chat", "id", "text"/"image_url", "session_id"?}`,
+    `{"type": "cancel", "id"}` and `{"type": "ping"}`/`{"type": "pong"}`. Each turn is
+    answered with `start`, `delta`..., then `done` or `error`, all tagged with its `id`.
+    """
+    token = _bearer_token(websocket)
+    try:
+        if not token:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        user = await authenticate_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid authentication credentials")
+        return
+
+    await websocket.accept()
+    _stats["connections"] += 1
+    try:
+        await ChatConnection(websocket, user).run()
+    finally:
+        _stats["connections"] -= 1
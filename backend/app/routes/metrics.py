@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from ..auth import user_cache
+from ..metrics import register_stats_collector
+from ..rate_limit import rate_limiter
+from ..services.model_router import model_router
+from ..services.openrouter_service import get_openrouter_client
+from ..services.persona_registry import persona_registry
+from ..services.response_cache import response_cache
+from ..utils.context import prompt_token_stats
+from . import chat_ws
+
+
+router = APIRouter()
+
+# The same counters /api/status reports, read at scrape time
+register_stats_collector({
+    "openrouter": lambda: get_openrouter_client().stats(),
+    "router": lambda: {"models": model_router.stats()},
+    "prompt_tokens": prompt_token_stats.stats,
+    "user_cache": user_cache.stats,
+    "response_cache": response_cache.stats,
+    "rate_limit": rate_limiter.stats,
+    "chat_ws": chat_ws.stats,
+    "personas": persona_registry.stats,
+})
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """Prometheus scrape endpoint."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,31 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from ..auth import get_current_user
 from ..db import get_db
-from ..config import settings
 from ..schemas import (
     PaymentIntentRequest, 
     PaymentIntentResponse, 
     CreditPackage,
-    CreditPurchaseResponse
 )
 from ..services.stripe_service import (
     create_payment_intent, 
+    retrieve_payment_intent,
     verify_payment_webhook,
     calculate_credit_price,
-    get_credit_packages
+    PACKAGE_CATALOG_BODY,
+    PACKAGE_CATALOG_ETAG,
 )
+from ..services.payment_service import PaymentGrant, apply_payment_grants, webhook_grant_batcher
+from ..utils.http import etag_matches
 import logging
-import stripe
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
 @router.get("/payments/packages", response_model=list[CreditPackage])
-async def get_available_packages():
-    """Get available credit packages for purchase."""
-    return get_credit_packages()
+async def get_available_packages(request: Request):
+    """Get available credit packages for purchase. ETag-versioned, so clients can revalidate for free."""
+    headers = {"ETag": PACKAGE_CATALOG_ETAG, "Cache-Control": "public, max-age=300"}
+    if etag_matches(request.headers.get("if-none-match"), PACKAGE_CATALOG_ETAG):
+        return Response(status_code=304, headers=headers)
+    return Response(content=PACKAGE_CATALOG_BODY, media_type="application/json", headers=headers)
 
 
 @router.post("/payments/create-intent", response_model=PaymentIntentResponse)
@@ -73,28 +77,29 @@ async def stripe_webhook(request: Request):
             user_email = payment_intent["metadata"]["user_email"]
             credits_to_purchase = int(payment_intent["metadata"]["credits_to_purchase"])
             
-            # Add credits to user account
-            db = get_db()
+            # Credited exactly once per PaymentIntent, however often Stripe delivers the event;
+            # concurrent deliveries are applied together
+            result = await webhook_grant_batcher.apply(PaymentGrant(
+                payment_intent_id=payment_intent["id"],
+                user_email=user_email,
+                credits=credits_to_purchase,
+                source="webhook",
+                event_id=event["id"],
+            ))
             
-            # Update user's credits
-            result = await db["users"].update_one(
-                {"email": user_email},
-                {
-                    "$inc": {
-                        "credits_available": credits_to_purchase,
-                        "total_credits_purchased": credits_to_purchase
-                    }
-                }
-            )
-            
-            if result.modified_count == 0:
+            if not result.user_found:
                 logger.error(f"Failed to update credits for user: {user_email}")
                 raise HTTPException(status_code=404, detail="User not found")
-            
-            logger.info(f"Successfully added {credits_to_purchase} credits to user {user_email}")
+
+            if result.first_seen:
+                logger.info(f"Successfully added {credits_to_purchase} credits to user {user_email}")
+            else:
+                logger.info(f"Ignoring already processed payment {payment_intent['id']} (event {event['id']})")
         
         return JSONResponse(content={"status": "success"})
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Webhook error: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -110,17 +115,15 @@ async def confirm_payment(
         payment_intent_id = request.get("payment_intent_id")
         if not payment_intent_id:
             raise HTTPException(status_code=400, detail="payment_intent_id is required")
-            
-        stripe.api_key = settings.stripe_secret_key
         
         # Retrieve payment intent from Stripe
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        payment_intent = await retrieve_payment_intent(payment_intent_id)
         
         # Check if payment succeeded
         if payment_intent.status != "succeeded":
             raise HTTPException(status_code=400, detail=f"Payment not completed. Status: {payment_intent.status}")
         
-        # Check if this payment was already processed
+        # Payments confirmed before processed_payments existed were flagged on Stripe instead
         if payment_intent.metadata.get("processed") == "true":
             raise HTTPException(status_code=400, detail="Payment already processed")
         
@@ -132,40 +135,35 @@ async def confirm_payment(
         if user_email != current_user["email"]:
             raise HTTPException(status_code=403, detail="Payment not authorized for this user")
         
-        # Add credits to user account
-        db = get_db()
-        result = await db["users"].update_one(
-            {"email": user_email},
-            {
-                "$inc": {
-                    "credits_available": credits_to_purchase,
-                    "total_credits_purchased": credits_to_purchase
-                }
-            }
-        )
+        # Add credits to user account; a no-op if the webhook got there first
+        [result] = await apply_payment_grants([PaymentGrant(
+            payment_intent_id=payment_intent_id,
+            user_email=user_email,
+            credits=credits_to_purchase,
+            source="confirm",
+        )])
         
-        if result.modified_count == 0:
+        if not result.user_found:
             logger.error(f"Failed to update credits for user: {user_email}")
             raise HTTPException(status_code=404, detail="User not found")
-        
-        # Mark payment as processed
-        stripe.PaymentIntent.modify(
-            payment_intent_id,
-            metadata={"processed": "true"}
-        )
-        
-        logger.info(f"Successfully added {credits_to_purchase} credits to user {user_email}")
+
+        if result.first_seen:
+            logger.info(f"Successfully added {credits_to_purchase} credits to user {user_email}")
         
         # Get updated user data
+        db = get_db()
         updated_user = await db["users"].find_one({"email": user_email})
         
         return {
             "success": True,
             "credits_added": credits_to_purchase,
+            "already_processed": not result.first_seen,
             "new_balance": updated_user.get("credits_available", 0),
             "total_purchased": updated_user.get("total_credits_purchased", 0)
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error confirming payment: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -1,62 +1,79 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import List, Optional
 from datetime import datetime, timezone
 from ..auth import get_current_user
+from ..config import settings
 from ..db import get_db
-from ..schemas import ChatHistoryResponse
+from ..schemas import ChatHistoryResponse, PersonaOut, SessionCreateRequest
+from ..services.message_service import fetch_messages_page, delete_session_messages, keyset_before, new_session_doc
+from ..services.job_queue import job_queue
+from ..services.persona_registry import persona_registry
+from ..utils.cursor import next_cursor, parse_cursor_id
 
 router = APIRouter()
 
 
 @router.get("/sessions")
-async def get_user_sessions(current_user=Depends(get_current_user)):
-    """Get all chat sessions for the current user"""
+async def get_user_sessions(
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    current_user=Depends(get_current_user),
+):
+    """Get the current user's chat sessions, most recently active first, paginated backwards from `before`/`before_id`"""
+    cursor_id = parse_cursor_id(before_id)
     db = get_db()
-    sessions = await db["chat_sessions"].find({"user_id": current_user["email"]}).to_list(length=None)
+    query: dict = {"user_id": current_user["email"], **keyset_before("updated_at", before, cursor_id)}
+    # Served by the (user_id, updated_at, _id) index; only the denormalized listing fields are read
+    sessions = await (
+        db["chat_sessions"]
+        .find(query, {"title": 1, "last_message_preview": 1, "message_count": 1, "credits_used": 1, "updated_at": 1})
+        .sort([("updated_at", -1), ("_id", -1)])
+        .limit(limit + 1)
+        .to_list(length=limit + 1)
+    )
+    has_more = len(sessions) > limit
+    sessions = sessions[:limit]
     
     result = []
     for session in sessions:
-        # Get the last message for preview
-        messages = session.get("messages", [])
-        last_message = ""
-        message_count = len(messages)
-        
-        if messages:
-            last_msg = messages[-1]
-            if last_msg.get("type") == "image":
-                last_message = "📷 Image"
-            else:
-                last_message = last_msg.get("content", "")[:100]  # Truncate long messages
-        
-        # Generate a title based on the first few messages or timestamp
-        title = f"Chat Session"
-        if messages:
-            first_user_msg = next((m for m in messages if m.get("role") == "user"), None)
-            if first_user_msg:
-                content = first_user_msg.get("content", "")
-                if len(content) > 30:
-                    title = content[:30] + "..."
-                else:
-                    title = content or "New Chat"
-        
+        updated_at = session.get("updated_at") or session["_id"].generation_time
         result.append({
             "id": str(session["_id"]),
-            "title": title,
-            "lastMessage": last_message,
-            "messageCount": message_count,
-            "timestamp": session.get("_id").generation_time.isoformat() if session.get("_id") else datetime.now(timezone.utc).isoformat()
+            "title": session.get("title") or "Chat Session",
+            "lastMessage": session.get("last_message_preview", ""),
+            "messageCount": session.get("message_count", 0),
+            "creditsUsed": session.get("credits_used", 0),
+            "timestamp": updated_at.replace(tzinfo=timezone.utc).isoformat(),
         })
     
-    # Sort by creation time (most recent first)
-    result.sort(key=lambda x: x["timestamp"], reverse=True)
-    return {"sessions": result}
+    return {
+        "sessions": result,
+        "has_more": has_more,
+        **next_cursor(sessions[-1] if has_more else None, "updated_at"),
+    }
+
+
+@router.get("/personas", response_model=List[PersonaOut])
+async def list_personas(current_user=Depends(get_current_user)):
+    """Personas a new session can be created with, at their latest versions"""
+    return [{"name": p.name, "version": p.version} for p in persona_registry.list()]
 
 
 @router.post("/sessions")
-async def create_new_session(current_user=Depends(get_current_user)):
-    """Create a new chat session"""
+async def create_new_session(
+    payload: Optional[SessionCreateRequest] = None,
+    current_user=Depends(get_current_user),
+):
+    """Create a new chat session, optionally with a persona (and pinned persona version)"""
+    persona = payload.persona if payload else None
+    persona_version = payload.persona_version if payload else None
+    if (persona or persona_version is not None) and not persona_registry.exists(
+        persona or settings.persona_default, persona_version
+    ):
+        raise HTTPException(status_code=400, detail="Unknown persona")
     db = get_db()
-    doc = {"user_id": current_user["email"], "messages": []}
+    doc = new_session_doc(current_user["email"], persona, persona_version)
     result = await db["chat_sessions"].insert_one(doc)
     
     return {
@@ -83,28 +100,46 @@ async def delete_session(session_id: str, current_user=Depends(get_current_user)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Session not found")
+
+    # Let queued turn writes land first so none of their messages outlive the session
+    await job_queue.wait_for_key(object_id)
+    await delete_session_messages(db, object_id)
     
     return {"message": "Session deleted successfully"}
 
 
 @router.get("/sessions/{session_id}/history", response_model=ChatHistoryResponse)
-async def get_session_history(session_id: str, current_user=Depends(get_current_user)):
-    """Get chat history for a specific session"""
+async def get_session_history(
+    session_id: str,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    current_user=Depends(get_current_user),
+):
+    """
+    Get chat history for a specific session, paginated backwards from (`before`, `before_id`).
+
+    Without a cursor or `limit` the whole history is returned.
+    """
     from bson import ObjectId
     
+    cursor_id = parse_cursor_id(before_id)
     try:
         object_id = ObjectId(session_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid session ID")
     
     db = get_db()
-    session = await db["chat_sessions"].find_one({
-        "_id": object_id,
-        "user_id": current_user["email"]
-    })
+    session = await db["chat_sessions"].find_one(
+        {"_id": object_id, "user_id": current_user["email"]},
+        {"_id": 1},
+    )
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+
+    await job_queue.wait_for_key(object_id)
+    page, has_more = await fetch_messages_page(db, object_id, before=before, limit=limit, before_id=cursor_id)
     
     from ..schemas import ChatMessage
     messages = [
@@ -114,7 +149,12 @@ async def get_session_history(session_id: str, current_user=Depends(get_current_
             timestamp=m.get("timestamp", datetime.now(timezone.utc)),
             type=m.get("type", "text"),
         )
-        for m in session.get("messages", [])
+        for m in page
     ]
     
-    return {"session_id": session_id, "messages": messages}
+    return {
+        "session_id": session_id,
+        "messages": messages,
+        "has_more": has_more,
+        **next_cursor(page[0] if has_more else None, "timestamp"),
+    }
@@ -0,0 +1,23 @@
+from fastapi import APIRouter
+from ..auth import user_cache
+from ..services.openrouter_service import get_openrouter_client
+from ..utils.context import prompt_token_stats
+from ..services.response_cache import response_cache
+from ..services.model_router import model_router
+from ..rate_limit import rate_limiter
+
+
+router = APIRouter()
+
+
+@router.get("/status")
+async def get_status():
+    """Report upstream client load (queued vs in-flight OpenRouter requests) and prompt sizes."""
+    return {
+        "openrouter": get_openrouter_client().stats(),
+        "models": model_router.stats(),
+        "prompt_tokens": prompt_token_stats.stats(),
+        "user_cache": user_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "rate_limit": rate_limiter.stats(),
+    }
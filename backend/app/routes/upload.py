@@ -1,25 +1,210 @@
+import hashlib
 import os
 import uuid
 from pathlib import Path
-from fastapi import APIRouter, File, UploadFile
+from typing import Literal, Optional
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from ..config import settings
+from ..services.image_variants import UnsupportedImageError, generate_all_variants, get_variant, variant_path
+from ..utils.http import etag_matches
 
 
 router = APIRouter()
+# Serves /uploads at the app root (no /api prefix) so stored URLs keep working
+media_router = APIRouter()
 
 
 UPLOAD_DIR = Path(__file__).resolve().parent.parent / "uploads"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+VARIANTS_DIR = UPLOAD_DIR / "variants"
+VARIANTS_DIR.mkdir(parents=True, exist_ok=True)
+
+# Stored files never change once written (names are content hashes), so caches may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+CHUNK_SIZE = 256 * 1024
+
+
+# Room for the multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"BM", ".bmp"),
+]
+
+
+def _image_extension(head: bytes) -> Optional[str]:
+    """Extension for the image format the first bytes of a file identify, if any."""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"File too large. Maximum size is {settings.upload_max_bytes // (1024 * 1024)} MB",
+    )
+
+
+def _malformed() -> HTTPException:
+    return HTTPException(status_code=400, detail="Malformed multipart body")
+
+
+def _finalize_upload(tmp_path: Path, final_path: Path) -> None:
+    # Identical content hashes to the same name, so an existing file is simply reused
+    if final_path.exists():
+        tmp_path.unlink(missing_ok=True)
+    else:
+        os.replace(tmp_path, final_path)
+
+
+def _multipart_parser(boundary: bytes, events: list[tuple[str, bytes]]) -> MultipartParser:
+    """A streaming parser that appends ("part", field name), ("data", bytes) and ("end", b"") to `events`."""
+    header = {"field": b"", "value": b"", "disposition": b""}
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header["field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header["value"] += data[start:end]
+
+    def on_header_end() -> None:
+        if header["field"].lower() == b"content-disposition":
+            header["disposition"] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished() -> None:
+        _, options = parse_options_header(header["disposition"])
+        events.append(("part", options.get(b"name", b"")))
+        header["disposition"] = b""
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        events.append(("data", data[start:end]))
+
+    def on_part_end() -> None:
+        events.append(("end", b""))
+
+    return MultipartParser(boundary, {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
 
 
 @router.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
-    ext = os.path.splitext(file.filename or "")[1].lower() or ".jpg"
-    filename = f"{uuid.uuid4().hex}{ext}"
-    path = str(UPLOAD_DIR / filename)
-    content = await file.read()
-    with open(path, "wb") as f:
-        f.write(content)
+async def upload_image(request: Request, background_tasks: BackgroundTasks):
+    """
+    Stream the `file` field of a multipart upload to disk, enforcing the size limit as it arrives.
+
+    The body is parsed straight off the request stream instead of being
+    spooled first, so an oversized upload is refused up front from its
+    Content-Length, or as soon as it passes the limit.
+
+    Files are stored under the SHA-256 of their bytes, with the extension of
+    the image format they turn out to be, so re-uploading the same image
+    returns the existing URL instead of writing a duplicate.
+    """
+    body_limit = settings.upload_max_bytes + MULTIPART_OVERHEAD
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > body_limit:
+        raise _too_large()
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    events: list[tuple[str, bytes]] = []
+    parser = _multipart_parser(boundary, events)
+    tmp_path = UPLOAD_DIR / f".{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    head = b""
+    out = None
+    in_file = False
+    size = received = 0
+    try:
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > body_limit:
+                    raise _too_large()
+                try:
+                    parser.write(chunk)
+                except MultipartParseError:
+                    raise _malformed()
+                for kind, data in events:
+                    if kind == "part":
+                        # Only the first `file` field is kept; other fields are skipped over
+                        in_file = data == b"file" and out is None
+                        if in_file:
+                            out = await run_in_threadpool(open, tmp_path, "wb")
+                    elif kind == "data" and in_file:
+                        size += len(data)
+                        if size > settings.upload_max_bytes:
+                            raise _too_large()
+                        head += data[:12 - len(head)]
+                        digest.update(data)
+                        await run_in_threadpool(out.write, data)
+                    elif kind == "end":
+                        in_file = False
+                events.clear()
+            try:
+                parser.finalize()
+            except MultipartParseError:
+                raise _malformed()
+        finally:
+            if out is not None:
+                await run_in_threadpool(out.close)
+        if out is None:
+            raise HTTPException(status_code=400, detail="No file field in the upload")
+        ext = _image_extension(head)
+        if ext is None:
+            raise HTTPException(status_code=415, detail="File is not a supported image")
+        filename = f"{digest.hexdigest()}{ext}"
+        await run_in_threadpool(_finalize_upload, tmp_path, UPLOAD_DIR / filename)
+    except BaseException:
+        await run_in_threadpool(tmp_path.unlink, True)
+        raise
+    background_tasks.add_task(generate_all_variants, VARIANTS_DIR, UPLOAD_DIR / filename)
     url = f"/uploads/{filename}"
     return {"url": url}
 
 
+@media_router.get("/uploads/{filename}")
+async def get_upload(
+    filename: str,
+    request: Request,
+    variant: Optional[Literal["thumb", "chat"]] = None,
+):
+    """Serve an uploaded image, or a resized variant of it with `?variant=thumb|chat`."""
+    source = UPLOAD_DIR / filename
+    if Path(filename).name != filename or filename.startswith(".") or not source.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Variant ETags carry the size parameters so changing a variant's geometry busts caches
+    etag = f'"{variant_path(VARIANTS_DIR, source, variant).stem}"' if variant else f'"{source.stem}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if variant:
+        try:
+            path = await get_variant(VARIANTS_DIR, source, variant)
+        except UnsupportedImageError:
+            raise HTTPException(status_code=415, detail="File is not a supported image")
+        return FileResponse(path, media_type="image/webp", headers=headers)
+    return FileResponse(source, headers=headers)
@@ -1,10 +1,18 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime, timedelta, timezone
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException
 from ..auth import get_current_user
-from ..schemas import UsageResponse
+from ..config import settings
+from ..db import get_db
+from ..schemas import UsageHistoryResponse, UsageResponse
+from ..services.usage_service import GLOBAL_SCOPE, GRANULARITIES, fetch_rollups
 
 
 router = APIRouter()
 
+# Range returned when the client gives no `start`
+DEFAULT_SPANS = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+
 
 @router.get("/usage", response_model=UsageResponse)
 async def get_usage(current_user=Depends(get_current_user)):
@@ -15,3 +23,45 @@ async def get_usage(current_user=Depends(get_current_user)):
     }
 
 
+def _utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+async def _usage_history(
+    scope: str, granularity: str, start: Optional[datetime], end: Optional[datetime]
+) -> dict:
+    end = _utc(end) if end else datetime.now(timezone.utc)
+    start = _utc(start) if start else end - DEFAULT_SPANS[granularity]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if (end - start) / GRANULARITIES[granularity] > settings.usage_max_buckets:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Range spans more than {settings.usage_max_buckets} {granularity} buckets",
+        )
+    buckets = await fetch_rollups(get_db(), scope, granularity, start, end)
+    return {"granularity": granularity, "start": start, "end": end, "buckets": buckets}
+
+
+@router.get("/usage/history", response_model=UsageHistoryResponse)
+async def get_usage_history(
+    granularity: Literal["hour", "day"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user=Depends(get_current_user),
+):
+    """The current user's usage per UTC hour or day, from the usage rollups"""
+    return await _usage_history(current_user["email"], granularity, start, end)
+
+
+@router.get("/usage/global", response_model=UsageHistoryResponse)
+async def get_global_usage(
+    granularity: Literal["hour", "day"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user=Depends(get_current_user),
+):
+    """Usage across all users per UTC hour or day; limited to USAGE_ADMIN_EMAILS"""
+    if current_user["email"] not in settings.usage_admin_emails:
+        raise HTTPException(status_code=403, detail="Not allowed to view global usage")
+    return await _usage_history(GLOBAL_SCOPE, granularity, start, end)
@@ -50,6 +50,19 @@ class ChatResponse(BaseModel):
 class ChatHistoryResponse(BaseModel):
     session_id: str
     messages: list[ChatMessage]
+    has_more: bool = False
+    next_before: Optional[datetime] = None  # Pass as `before` to fetch the previous page
+    next_before_id: Optional[str] = None  # Pass as `before_id` along with it
+
+
+class SessionCreateRequest(BaseModel):
+    persona: Optional[str] = None
+    persona_version: Optional[int] = None  # Pin a version; by default the session follows the latest
+
+
+class PersonaOut(BaseModel):
+    name: str
+    version: int
 
 
 class UsageResponse(BaseModel):
@@ -58,6 +71,30 @@ class UsageResponse(BaseModel):
     total_credits_purchased: int
 
 
+class ModelUsage(BaseModel):
+    turns: int = 0
+    credits: int = 0
+
+
+class UsageBucket(BaseModel):
+    start: datetime
+    turns: int = 0
+    credits: int = 0
+    user_credits: int = 0
+    ai_credits: int = 0
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    models: dict[str, ModelUsage] = {}  # Replies served from the response cache count under "cache"
+
+
+class UsageHistoryResponse(BaseModel):
+    granularity: Literal["hour", "day"]
+    start: datetime
+    end: datetime
+    buckets: list[UsageBucket]  # Only buckets with turns in them
+
+
 class CreditPackage(BaseModel):
     credits: int
     price_gbp: float
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from ..config import settings
+from ..db import get_db, run_in_transaction
+from .job_queue import PENDING_JOBS_COLLECTION
+
+
+logger = logging.getLogger(__name__)
+
+LEDGER_COLLECTION = "credit_ledger"
+
+
+@dataclass
+class CreditReservation:
+    id: ObjectId
+    user_email: str
+    amount: int
+    reserved_at: datetime
+
+
+async def reserve_credits(db, user_email: str, amount: int) -> Optional[CreditReservation]:
+    """
+    Atomically hold `amount` credits for a chat turn.
+
+    A single conditional update: it only matches while the balance covers the
+    amount, so concurrent turns can never reserve more than the balance.
+    Returns None when the balance is insufficient.
+
+    The hold is also recorded in the user's `pending_reservations` until it
+    is settled or released, with an expiry after which
+    `release_expired_reservations` gives it back. Settling and releasing
+    only apply while the hold is still pending, so neither happens twice.
+    """
+    reservation = CreditReservation(
+        id=ObjectId(),
+        user_email=user_email,
+        amount=amount,
+        reserved_at=datetime.now(timezone.utc),
+    )
+    hold = {
+        "id": reservation.id,
+        "amount": amount,
+        "reserved_at": reservation.reserved_at,
+        "expires_at": reservation.reserved_at + timedelta(seconds=settings.credit_reservation_ttl),
+    }
+    user = await db["users"].find_one_and_update(
+        {"email": user_email, "credits_available": {"$gte": amount}},
+        {"$inc": {"credits_available": -amount, "credits_reserved": amount}, "$push": {"pending_reservations": hold}},
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if user is None:
+        return None
+    return reservation
+
+
+async def credits_available(db, user_email: str) -> int:
+    """The stored balance, read after a reservation was refused so the reason given is current."""
+    user = await db["users"].find_one({"email": user_email}, {"credits_available": 1})
+    return int(user.get("credits_available", 0)) if user else 0
+
+
+def pending_filter(user_email: str, reservation_id: Optional[ObjectId]) -> dict[str, Any]:
+    """Matches the user only while the reservation is still held."""
+    if reservation_id is None:
+        # Turns queued before holds were recorded
+        return {"email": user_email}
+    return {"email": user_email, "pending_reservations.id": reservation_id}
+
+
+def ledger_entries(reservation: CreditReservation, kind: str, amount: int, extra: dict[str, Any]) -> list[dict]:
+    """Ledger entries recording a reservation and its outcome, with ids assigned so rewriting them is idempotent."""
+    # The reserve entry is written alongside the outcome so reserving stays a single round-trip;
+    # until then the hold is on record in the user's `pending_reservations`
+    return [
+        {
+            "_id": ObjectId(),
+            "reservation_id": reservation.id,
+            "user_id": reservation.user_email,
+            "type": "reserve",
+            "amount": reservation.amount,
+            "timestamp": reservation.reserved_at,
+        },
+        {
+            "_id": ObjectId(),
+            "reservation_id": reservation.id,
+            "user_id": reservation.user_email,
+            "type": kind,
+            "amount": amount,
+            "timestamp": datetime.now(timezone.utc),
+            **extra,
+        },
+    ]
+
+
+def charged_amount(reservation_amount: int, actual: int) -> int:
+    """What a turn is billed: its actual cost, capped at the credits held for it."""
+    return min(actual, reservation_amount)
+
+
+def settlement_update(reservation_id: Optional[ObjectId], reservation_amount: int, actual: int) -> list[dict]:
+    """
+    Update pipeline charging the actual cost of a turn against its reservation.
+
+    The difference is refunded. A turn that ran over its reservation is
+    charged the reservation and no more, so the balance never goes below
+    zero. Apply it with `pending_filter`, which makes it a no-op once settled.
+    """
+    actual = charged_amount(reservation_amount, actual)
+    delta = reservation_amount - actual
+    return [
+        {"$set": {
+            "credits_available": {"$add": [{"$ifNull": ["$credits_available", 0]}, delta]},
+            "credits_reserved": {"$max": [0, {"$subtract": [{"$ifNull": ["$credits_reserved", 0]}, reservation_amount]}]},
+            "credits_used": {"$add": [{"$ifNull": ["$credits_used", 0]}, actual]},
+            "pending_reservations": {"$filter": {
+                "input": {"$ifNull": ["$pending_reservations", []]},
+                "cond": {"$ne": ["$$this.id", reservation_id]},
+            }},
+        }},
+    ]
+
+
+async def release_credits(db, reservation: CreditReservation, reason: str) -> bool:
+    """
+    Return a reservation in full when the turn produced nothing billable; False if it was no longer held.
+
+    The ledger entries are only written when this call released the hold,
+    and with MONGODB_TRANSACTIONS they commit together with the balance.
+    """
+    released = False
+
+    async def write(mongo_session) -> None:
+        nonlocal released
+        result = await db["users"].update_one(
+            pending_filter(reservation.user_email, reservation.id),
+            {
+                "$inc": {"credits_available": reservation.amount, "credits_reserved": -reservation.amount},
+                "$pull": {"pending_reservations": {"id": reservation.id}},
+            },
+            session=mongo_session,
+        )
+        released = bool(result.matched_count)
+        if released:
+            await db[LEDGER_COLLECTION].insert_many(
+                ledger_entries(reservation, "release", 0, {"reason": reason}), session=mongo_session
+            )
+
+    await run_in_transaction(write)
+    return released
+
+
+async def release_expired_reservations(db, now: Optional[datetime] = None) -> int:
+    """
+    Give back holds that outlived `credit_reservation_ttl`.
+
+    A turn normally settles or releases its hold within seconds; one still
+    pending at expiry was lost (a crash, a dropped background write, a
+    request that never ran to completion). Holds of turns waiting in
+    `pending_jobs` are kept: that turn will still settle them. Returns how
+    many were released.
+    """
+    now = now or datetime.now(timezone.utc)
+    released = 0
+    cursor = db["users"].find(
+        {"pending_reservations.expires_at": {"$lt": now}},
+        {"email": 1, "pending_reservations": 1},
+    )
+    async for user in cursor:
+        expired = []
+        for hold in user.get("pending_reservations", []):
+            expires_at = hold["expires_at"]
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            if expires_at < now:
+                expired.append(hold)
+        if not expired:
+            continue
+        deferred = set(
+            await db[PENDING_JOBS_COLLECTION].distinct(
+                "payload.reservation_id", {"payload.reservation_id": {"$in": [hold["id"] for hold in expired]}}
+            )
+        )
+        for hold in expired:
+            if hold["id"] in deferred:
+                continue
+            reservation = CreditReservation(
+                id=hold["id"], user_email=user["email"], amount=hold["amount"], reserved_at=hold["reserved_at"]
+            )
+            if await release_credits(db, reservation, "expired"):
+                released += 1
+                logger.warning(f"Released expired credit reservation {hold['id']} of {user['email']}")
+    return released
+
+
+_sweeper: asyncio.Task | None = None
+
+
+async def _sweep() -> None:
+    while True:
+        await asyncio.sleep(settings.credit_reservation_sweep_interval)
+        try:
+            await release_expired_reservations(get_db())
+        except Exception as exc:  # noqa: BLE001
+            logger.warning(f"Could not release expired credit reservations: {str(exc)}")
+
+
+async def start_reservation_sweeper() -> None:
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep())
+
+
+async def stop_reservation_sweeper() -> None:
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        await asyncio.gather(_sweeper, return_exceptions=True)
+        _sweeper = None
@@ -0,0 +1,72 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from PIL import Image, ImageOps, UnidentifiedImageError
+from starlette.concurrency import run_in_threadpool
+
+
+# Bounding boxes for each variant; images are scaled down to fit, never up
+VARIANTS: dict[str, tuple[int, int]] = {
+    "thumb": (160, 160),
+    "chat": (640, 640),
+}
+VARIANT_FORMAT = "WEBP"
+VARIANT_QUALITY = 80
+
+_locks: dict[Path, asyncio.Lock] = {}
+
+
+class UnsupportedImageError(Exception):
+    pass
+
+
+def variant_path(variants_dir: Path, source: Path, variant: str) -> Path:
+    """Cache location for a variant, keyed by source content (its hashed name) and the size parameters."""
+    width, height = VARIANTS[variant]
+    return variants_dir / f"{source.stem}-{variant}-{width}x{height}-q{VARIANT_QUALITY}.webp"
+
+
+def _render_variant(source: Path, target: Path, size: tuple[int, int]) -> None:
+    # A unique temp name, so renders of the same variant (another process, or one that
+    # started after its lock was dropped) never write over each other's partial file
+    with tempfile.NamedTemporaryFile(dir=target.parent, prefix=f".{target.stem}-", suffix=".tmp", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+    try:
+        with Image.open(source) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+            img.thumbnail(size, Image.Resampling.LANCZOS)
+            img.save(tmp_path, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+        tmp_path.replace(target)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as exc:
+        # DecompressionBombError (pixel count far past Image.MAX_IMAGE_PIXELS) is not an OSError
+        raise UnsupportedImageError(f"Cannot create variant of {source.name}") from exc
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+async def get_variant(variants_dir: Path, source: Path, variant: str) -> Path:
+    """Return the cached variant of `source`, rendering it on the thread pool on first use."""
+    target = variant_path(variants_dir, source, variant)
+    if target.exists():
+        return target
+    lock = _locks.setdefault(target, asyncio.Lock())
+    try:
+        async with lock:
+            # Another request may have rendered it while we waited
+            if not target.exists():
+                await run_in_threadpool(_render_variant, source, target, VARIANTS[variant])
+    finally:
+        if not lock.locked():
+            _locks.pop(target, None)
+    return target
+
+
+async def generate_all_variants(variants_dir: Path, source: Path) -> None:
+    """Pre-render every variant right after upload so first views are already cached."""
+    for variant in VARIANTS:
+        try:
+            await get_variant(variants_dir, source, variant)
+        except UnsupportedImageError:
+            return
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Optional
+from ..config import settings
+from ..db import get_db
+
+
+logger = logging.getLogger(__name__)
+
+PENDING_JOBS_COLLECTION = "pending_jobs"
+
+# Takes a batch of payloads of one kind and returns the ones that still need another attempt
+BatchHandler = Callable[[list[dict]], Awaitable[list[dict]]]
+
+
+class JobQueue:
+    """
+    In-process queue for work that does not need to finish before a response.
+
+    A single worker takes jobs in batches (up to `batch_size`, waiting at most
+    `linger` seconds for a batch to fill) and hands each kind's batch to its
+    handler. Jobs the handler returns, or whose batch raised, are retried with
+    backoff up to `max_attempts`.
+
+    Jobs that cannot run here - queue full, attempts exhausted, or still queued
+    at shutdown - are written to the `pending_jobs` collection. Every running
+    process claims jobs from there at startup and then every
+    `recover_interval` seconds. Handlers must therefore be safe to run more
+    than once for the same payload. Jobs still in memory when the process
+    crashes are lost.
+
+    Jobs may carry a `key` (e.g. a chat session) so readers can wait for that
+    key's queued work before reading.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        batch_size: int,
+        linger: float,
+        max_attempts: int,
+        retry_delay: float,
+        recover_interval: float,
+    ) -> None:
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_size)
+        self._batch_size = batch_size
+        self._linger = linger
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._recover_interval = recover_interval
+        self._handlers: dict[str, BatchHandler] = {}
+        self._worker: asyncio.Task | None = None
+        self._recoverer: asyncio.Task | None = None
+        self._closing = False
+        self._current: list[dict] = []
+        self._persisting: set[asyncio.Task] = set()
+        self._retrying: set[asyncio.Task] = set()
+        self._outstanding: dict[Any, int] = defaultdict(int)
+        self._idle: dict[Any, asyncio.Event] = {}
+        self.processed = 0
+        self.retried = 0
+        self.persisted = 0
+
+    def register(self, kind: str, handler: BatchHandler) -> None:
+        self._handlers[kind] = handler
+
+    def submit(self, kind: str, payload: dict, key: Any = None) -> None:
+        """Queue a job. Never blocks: if the queue is full the job goes straight to durable storage."""
+        job = {"kind": kind, "payload": payload, "key": key, "attempts": 0}
+        if key is not None:
+            self._outstanding[key] += 1
+            self._idle.setdefault(key, asyncio.Event()).clear()
+        if self._closing:
+            self._spawn(self._persisting, self._persist([job]))
+            return
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"Job queue full, persisting {kind} job")
+            self._spawn(self._persisting, self._persist([job]))
+
+    async def wait_for_key(self, key: Any, timeout: float = 5.0) -> None:
+        """Wait until jobs queued under `key` have been applied (or handed to durable storage)."""
+        if not self._outstanding.get(key):
+            return
+        try:
+            await asyncio.wait_for(self._idle[key].wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out waiting for queued jobs of {key}")
+
+    def _settle_key(self, key: Any) -> None:
+        if key is None or key not in self._outstanding:
+            return
+        self._outstanding[key] -= 1
+        if self._outstanding[key] <= 0:
+            del self._outstanding[key]
+            self._idle.pop(key).set()
+
+    @staticmethod
+    def _spawn(tasks: set[asyncio.Task], coro: Awaitable[None]) -> None:
+        task = asyncio.ensure_future(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def start(self) -> None:
+        """
+        Pick up jobs an earlier process left behind, and keep picking up ones
+        persisted while running. The worker itself starts with the first job.
+        """
+        self._closing = False
+        await self._recover()
+        if self._recoverer is None:
+            self._recoverer = asyncio.create_task(self._recover_periodically())
+
+    async def _recover_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._recover_interval)
+            # Claim no more than fits, or an overflowing queue would just persist them again
+            room = self._queue.maxsize - self._queue.qsize() if self._queue.maxsize > 0 else 10000
+            if room <= 0:
+                continue
+            try:
+                await self._recover(limit=room)
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"Could not recover pending jobs: {str(e)}")
+
+    async def _recover(self, limit: int = 10000) -> None:
+        """Claim jobs left in durable storage. Each is removed atomically, so concurrent workers never share one."""
+        db = get_db()
+        recovered = 0
+        while recovered < limit:
+            doc = await db[PENDING_JOBS_COLLECTION].find_one_and_delete({}, sort=[("created_at", 1)])
+            if doc is None:
+                break
+            if doc["kind"] not in self._handlers:
+                logger.error(f"No handler for recovered job kind {doc['kind']}, dropping it")
+                continue
+            self.submit(doc["kind"], doc["payload"], key=doc.get("key"))
+            recovered += 1
+        if recovered:
+            logger.info(f"Recovered {recovered} pending jobs")
+
+    async def _next_batch(self) -> list[dict]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        until = loop.time() + self._linger
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = until - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            by_kind: dict[str, list[dict]] = defaultdict(list)
+            for job in batch:
+                by_kind[job["kind"]].append(job)
+            self._current = batch
+            for kind, jobs in by_kind.items():
+                await self._run_batch(kind, jobs)
+            self._current = []
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _run_batch(self, kind: str, jobs: list[dict]) -> None:
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.error(f"No handler for job kind {kind}, dropping {len(jobs)} jobs")
+            for job in jobs:
+                self._settle_key(job["key"])
+            return
+        try:
+            unfinished = await handler([job["payload"] for job in jobs])
+        except Exception as e:  # noqa: BLE001
+            logger.error(f"Job batch of {len(jobs)} {kind} jobs failed: {str(e)}")
+            unfinished = [job["payload"] for job in jobs]
+
+        retry_ids = {id(payload) for payload in unfinished}
+        retry, exhausted = [], []
+        for job in jobs:
+            if id(job["payload"]) not in retry_ids:
+                self.processed += 1
+                self._settle_key(job["key"])
+                continue
+            job["attempts"] += 1
+            (retry if job["attempts"] < self._max_attempts else exhausted).append(job)
+        if retry:
+            self.retried += len(retry)
+            self._spawn(self._retrying, self._requeue(retry, self._retry_delay * 2 ** (retry[0]["attempts"] - 1)))
+        if exhausted:
+            logger.error(f"{len(exhausted)} {kind} jobs exhausted their attempts, persisting them")
+            await self._persist(exhausted)
+
+    async def _requeue(self, jobs: list[dict], delay: float) -> None:
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # Shutting down: keep the jobs for the next process
+            await self._persist(jobs)
+            raise
+        overflow = []
+        for job in jobs:
+            try:
+                self._queue.put_nowait(job)
+            except asyncio.QueueFull:
+                overflow.append(job)
+        if overflow:
+            await self._persist(overflow)
+
+    async def persist(self, kind: str, payload: dict, key: Any = None) -> None:
+        """Hand a job straight to durable storage, for work that failed outside the queue."""
+        await self._persist([{"kind": kind, "payload": payload, "key": key}])
+
+    async def _persist(self, jobs: list[dict]) -> None:
+        now = datetime.now(timezone.utc)
+        docs = [
+            {"kind": job["kind"], "payload": job["payload"], "key": job["key"], "created_at": now}
+            for job in jobs
+        ]
+        try:
+            await get_db()[PENDING_JOBS_COLLECTION].insert_many(docs)
+            self.persisted += len(docs)
+        except Exception as e:  # noqa: BLE001
+            logger.error(f"Could not persist {len(docs)} jobs, they are lost: {str(e)}")
+        finally:
+            for job in jobs:
+                self._settle_key(job["key"])
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        """Finish queued work on shutdown; whatever is left after `timeout` goes to durable storage."""
+        self._closing = True
+        if self._recoverer is not None:
+            self._recoverer.cancel()
+            await asyncio.gather(self._recoverer, return_exceptions=True)
+            self._recoverer = None
+        # Delayed retries are persisted rather than waited for
+        for task in list(self._retrying):
+            task.cancel()
+        if self._worker is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Job queue not drained after {timeout}s")
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        # The interrupted batch (handlers are idempotent) and anything still queued
+        leftovers = self._current
+        self._current = []
+        while not self._queue.empty():
+            leftovers.append(self._queue.get_nowait())
+        if leftovers:
+            await self._persist(leftovers)
+        pending = self._retrying | self._persisting
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": settings.job_queue_enabled,
+            "queued": self._queue.qsize(),
+            "processed": self.processed,
+            "retried": self.retried,
+            "persisted": self.persisted,
+        }
+
+
+job_queue = JobQueue(
+    max_size=settings.job_queue_max_size,
+    batch_size=settings.job_queue_batch_size,
+    linger=settings.job_queue_linger,
+    max_attempts=settings.job_queue_max_attempts,
+    retry_delay=settings.job_queue_retry_delay,
+    recover_interval=settings.job_queue_recover_interval,
+)
+
+
+async def start_job_queue() -> None:
+    # Recover even when disabled, so jobs stored before switching it off still get applied
+    await job_queue.start()
+
+
+async def drain_job_queue(timeout: Optional[float] = None) -> None:
+    await job_queue.drain(timeout if timeout is not None else settings.job_queue_drain_timeout)
@@ -0,0 +1,153 @@
+from datetime import datetime, timezone
+from typing import Any, Optional
+from bson import ObjectId
+from pymongo import DESCENDING
+
+
+MESSAGES_COLLECTION = "messages"
+# Page size when a history request has a cursor but no limit
+DEFAULT_PAGE_SIZE = 100
+# Turn ids a session remembers; a retry arriving after this many newer turns would count twice
+RECENT_TURNS_KEPT = 50
+
+
+def message_preview(message: dict) -> str:
+    if message.get("type") == "image":
+        return "📷 Image"
+    return message.get("content", "")[:100]  # Truncate long messages
+
+
+def session_title(first_user_message: dict) -> str:
+    content = first_user_message.get("content", "")
+    if len(content) > 30:
+        return content[:30] + "..."
+    return content or "New Chat"
+
+
+def new_session_doc(user_id: str, persona: Optional[str] = None, persona_version: Optional[int] = None) -> dict:
+    now = datetime.now(timezone.utc)
+    doc = {
+        "user_id": user_id,
+        "title": None,
+        "last_message_preview": "",
+        "message_count": 0,
+        "created_at": now,
+        "updated_at": now,
+    }
+    if persona:
+        doc["persona"] = persona
+    if persona_version is not None:
+        doc["persona_version"] = persona_version
+    return doc
+
+
+def session_metadata_update(
+    messages: list[dict], inc: dict[str, int] | None = None, turn_id: Any = None
+) -> list[dict]:
+    """
+    Update pipeline refreshing a session's denormalized metadata after `messages` were added.
+
+    The session's title (set once, from the first user message), last message
+    preview, message count and `updated_at` are maintained at write time so
+    listings never have to read messages. Extra counters in `inc` are applied
+    in the same update.
+
+    With a `turn_id` the update also records it in the session's
+    `recent_turns`; pair it with `applied_turn_filter` so a retried update
+    is not counted twice.
+    """
+    counters = {"message_count": len(messages), **(inc or {})}
+    fields: dict[str, Any] = {
+        field: {"$add": [{"$ifNull": [f"${field}", 0]}, amount]}
+        for field, amount in counters.items()
+    }
+    # $literal keeps user text starting with "$" from being read as a field path
+    fields["last_message_preview"] = {"$literal": message_preview(messages[-1])}
+    fields["updated_at"] = {"$literal": messages[-1]["timestamp"]}
+    first_user_message = next((m for m in messages if m.get("role") == "user"), None)
+    if first_user_message:
+        fields["title"] = {"$ifNull": ["$title", {"$literal": session_title(first_user_message)}]}
+    if turn_id is not None:
+        fields["recent_turns"] = {
+            "$slice": [{"$concatArrays": [{"$ifNull": ["$recent_turns", []]}, [turn_id]]}, -RECENT_TURNS_KEPT]
+        }
+    return [{"$set": fields}]
+
+
+def applied_turn_filter(session_id: Any, turn_id: Any = None) -> dict[str, Any]:
+    """Filter matching the session only while `turn_id` is not among its recently applied turns."""
+    if turn_id is None:
+        return {"_id": session_id}
+    return {"_id": session_id, "recent_turns": {"$ne": turn_id}}
+
+
+def keyset_before(field: str, before: datetime | None, before_id: ObjectId | None) -> dict[str, Any]:
+    """
+    Filter for the documents sorted before (`before`, `before_id`) on (`field`, `_id`), descending.
+
+    The `_id` breaks ties, so documents sharing the boundary value (e.g. both
+    messages of a turn written in one batch) are neither skipped nor repeated.
+    Without `before_id` it falls back to a plain `field < before`.
+    """
+    if before is None:
+        return {}
+    if before_id is None:
+        return {field: {"$lt": before}}
+    return {"$or": [{field: {"$lt": before}}, {field: before, "_id": {"$lt": before_id}}]}
+
+
+async def fetch_messages_page(
+    db,
+    session_id: Any,
+    before: datetime | None = None,
+    limit: int | None = 50,
+    before_id: ObjectId | None = None,
+) -> tuple[list[dict], bool]:
+    """
+    Fetch one page of a session's messages, newest page first.
+
+    Walks the (session_id, timestamp, _id) index backwards from (`before`,
+    `before_id`) and returns the page in chronological order along with
+    whether older messages remain. With neither `limit` nor `before` the
+    page is the whole history; with only `before` it is `DEFAULT_PAGE_SIZE`.
+    """
+    if limit is None and before is not None:
+        limit = DEFAULT_PAGE_SIZE
+    query: dict[str, Any] = {"session_id": session_id, **keyset_before("timestamp", before, before_id)}
+    cursor = (
+        db[MESSAGES_COLLECTION]
+        .find(query, {"session_id": 0})
+        .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+    )
+    if limit is not None:
+        cursor = cursor.limit(limit + 1)
+    docs = await cursor.to_list(length=None if limit is None else limit + 1)
+    has_more = limit is not None and len(docs) > limit
+    page = docs[:limit]
+    page.reverse()
+    return page, has_more
+
+
+async def fetch_recent_messages(
+    db,
+    session_id: Any,
+    limit: int,
+    after: datetime | None = None,
+) -> list[dict]:
+    """Fetch only the newest `limit` messages of a session (newer than `after`), in chronological order."""
+    query: dict[str, Any] = {"session_id": session_id}
+    if after is not None:
+        query["timestamp"] = {"$gt": after}
+    cursor = (
+        db[MESSAGES_COLLECTION]
+        .find(query, {"session_id": 0})
+        .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit)
+    )
+    docs = await cursor.to_list(length=limit)
+    docs.reverse()
+    return docs
+
+
+async def delete_session_messages(db, session_id: Any) -> None:
+    await db[MESSAGES_COLLECTION].delete_many({"session_id": session_id})
@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+from ..config import settings
+from .openrouter_service import (
+    Deadline,
+    DeadlineExceededError,
+    OpenRouterError,
+    UpstreamBusyError,
+    UpstreamUsage,
+    fetch_openrouter_chat_completion,
+    stream_openrouter_chat_completion,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Local saturation or an exhausted request budget: another model won't help
+NOT_MODEL_FAULTS = (UpstreamBusyError, DeadlineExceededError)
+
+
+class ModelStats:
+    """Rolling latency/error window and circuit breaker for one model."""
+
+    def __init__(self, window: int, failure_threshold: int, cooldown: float) -> None:
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def available(self) -> bool:
+        state = self.state
+        # Half-open lets a single trial request through to probe recovery
+        return state == "closed" or (state == "half_open" and not self.trial_in_progress)
+
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        self.trial_in_progress = False
+        if self.opened_at is not None or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    def stats(self) -> dict:
+        outcomes = len(self.outcomes)
+        return {
+            "state": self.state,
+            "samples": len(self.latencies),
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+            "error_rate": self.outcomes.count(False) / outcomes if outcomes else 0.0,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class ModelRouter:
+    """
+    Routes completions across candidate models with fallback and optional hedging.
+
+    The first healthy model in configured order is tried first; remaining
+    healthy models follow fastest-first by rolling median latency. Models whose
+    circuit is open are skipped until their cooldown expires; while every
+    circuit is open requests fail at once, until a cooldown lets one trial
+    through. With hedging on, a backup request starts if the primary hasn't
+    answered by its p95 latency, and whichever answers first wins.
+    """
+
+    def __init__(self, candidates: list[str]) -> None:
+        self.candidates = candidates
+        self.model_stats = {
+            model: ModelStats(
+                window=settings.router_latency_window,
+                failure_threshold=settings.router_failure_threshold,
+                cooldown=settings.router_circuit_cooldown,
+            )
+            for model in candidates
+        }
+
+    @property
+    def primary(self) -> str:
+        return self.candidates[0]
+
+    def ordered_candidates(self) -> list[str]:
+        """Models to try, in order; raises while every circuit is open."""
+        healthy = [m for m in self.candidates if self.model_stats[m].available()]
+        if not healthy:
+            raise OpenRouterError("Every model's circuit is open")
+        first, rest = healthy[0], healthy[1:]
+        rest.sort(key=lambda m: self.model_stats[m].percentile(0.5) or float("inf"))
+        return [first] + rest
+
+    def hedge_delay(self, model: str) -> float:
+        stats = self.model_stats[model]
+        if len(stats.latencies) < settings.router_hedge_min_samples:
+            return settings.router_hedge_default_delay
+        return stats.percentile(0.95) or settings.router_hedge_default_delay
+
+    async def _attempt(
+        self,
+        model: str,
+        messages: list[dict[str, str]],
+        deadline: Optional[Deadline],
+        system_prompt: Optional[str],
+        usage: Optional[UpstreamUsage],
+    ) -> str:
+        stats = self.model_stats[model]
+        if stats.state == "half_open":
+            stats.trial_in_progress = True
+        start = time.monotonic()
+        try:
+            reply = await fetch_openrouter_chat_completion(
+                messages, model=model, deadline=deadline, system_prompt=system_prompt, usage=usage
+            )
+        except (asyncio.CancelledError, *NOT_MODEL_FAULTS):
+            # Lost a hedge race or ran out of budget; says nothing about the model's health
+            stats.trial_in_progress = False
+            raise
+        except Exception:
+            stats.record_failure()
+            raise
+        stats.record_success(time.monotonic() - start)
+        if usage is not None:
+            usage.route = model
+        return reply
+
+    async def _hedged(
+        self,
+        primary: str,
+        backup: str,
+        messages: list[dict[str, str]],
+        deadline: Optional[Deadline],
+        system_prompt: Optional[str],
+        usage: Optional[UpstreamUsage],
+    ) -> str:
+        # Each attempt reports into its own usage, so a late loser can't overwrite the winner's
+        attempts: dict[asyncio.Task, tuple[str, UpstreamUsage]] = {}
+
+        def start(model: str) -> asyncio.Task:
+            attempt_usage = UpstreamUsage()
+            task = asyncio.create_task(self._attempt(model, messages, deadline, system_prompt, attempt_usage))
+            attempts[task] = (model, attempt_usage)
+            return task
+
+        def won(task: asyncio.Task) -> str:
+            if usage is not None:
+                usage.update_from(attempts[task][1])
+            return task.result()
+
+        primary_task = start(primary)
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=self.hedge_delay(primary))
+            if done:
+                exc = primary_task.exception()
+                if exc is None:
+                    return won(primary_task)
+                if isinstance(exc, NOT_MODEL_FAULTS):
+                    # Saturated or out of time: a backup request would fare no better
+                    raise exc
+            # Primary is slow (or failed): race the backup against it
+            logger.info(f"Hedging {primary} with {backup}")
+            start(backup)
+            errors = []
+            not_model_fault: Optional[BaseException] = None
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    exc = task.exception()
+                    if exc is None:
+                        return won(task)
+                    if isinstance(exc, NOT_MODEL_FAULTS):
+                        not_model_fault = not_model_fault or exc
+                    errors.append(f"{attempts[task][0]}: {exc}")
+            if not_model_fault is not None:
+                raise not_model_fault
+            raise OpenRouterError("; ".join(errors))
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def complete(
+        self,
+        messages: list[dict[str, str]],
+        deadline: Optional[Deadline] = None,
+        system_prompt: Optional[str] = None,
+        usage: Optional[UpstreamUsage] = None,
+    ) -> str:
+        candidates = self.ordered_candidates()
+        errors: list[str] = []
+        if settings.router_hedge_enabled and len(candidates) > 1:
+            try:
+                return await self._hedged(candidates[0], candidates[1], messages, deadline, system_prompt, usage)
+            except NOT_MODEL_FAULTS:
+                raise
+            except RuntimeError as exc:
+                errors.append(str(exc))
+            candidates = candidates[2:]
+        for model in candidates:
+            try:
+                return await self._attempt(model, messages, deadline, system_prompt, usage)
+            except NOT_MODEL_FAULTS:
+                raise
+            except RuntimeError as exc:
+                logger.warning(f"Model {model} failed, falling back: {str(exc)}")
+                errors.append(f"{model}: {exc}")
+        raise OpenRouterError(f"All models failed: {'; '.join(errors)}")
+
+    async def stream(
+        self,
+        messages: list[dict[str, str]],
+        deadline: Optional[Deadline] = None,
+        system_prompt: Optional[str] = None,
+        usage: Optional[UpstreamUsage] = None,
+    ) -> AsyncIterator[str]:
+        """Stream from the first model that starts answering; fallback is only possible before the first delta."""
+        errors: list[str] = []
+        for model in self.ordered_candidates():
+            stats = self.model_stats[model]
+            if stats.state == "half_open":
+                stats.trial_in_progress = True
+            start = time.monotonic()
+            started = False
+            try:
+                async for delta in stream_openrouter_chat_completion(
+                    messages, model=model, deadline=deadline, system_prompt=system_prompt, usage=usage
+                ):
+                    if not started:
+                        started = True
+                        # Time to first token is what a streaming user waits on
+                        stats.record_success(time.monotonic() - start)
+                        if usage is not None:
+                            usage.route = model
+                    yield delta
+                if not started:
+                    stats.record_success(time.monotonic() - start)
+                    if usage is not None:
+                        usage.route = model
+                return
+            except NOT_MODEL_FAULTS:
+                raise
+            except RuntimeError as exc:
+                stats.record_failure()
+                if started:
+                    raise
+                logger.warning(f"Model {model} failed, falling back: {str(exc)}")
+                errors.append(f"{model}: {exc}")
+            finally:
+                if not started:
+                    # Also on cancellation or the stream being closed before its first delta,
+                    # which say nothing about the model; otherwise a half-open model is never probed again
+                    stats.trial_in_progress = False
+        raise OpenRouterError(f"All models failed: {'; '.join(errors)}")
+
+    def stats(self) -> dict[str, dict]:
+        return {model: stats.stats() for model, stats in self.model_stats.items()}
+
+
+def _candidate_models() -> list[str]:
+    fallbacks = [m.strip() for m in settings.openrouter_fallback_models.split(",") if m.strip()]
+    return [settings.openrouter_model] + [m for m in fallbacks if m != settings.openrouter_model]
+
+
+model_router = ModelRouter(_candidate_models())
@@ -1,33 +1,512 @@
+import asyncio
+import json
+import random
+import time
 import aiohttp
-from typing import Any
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar
 from ..config import settings
+from ..metrics import (
+    OPENROUTER_COMPLETION_TOKENS,
+    OPENROUTER_FIRST_TOKEN_SECONDS,
+    OPENROUTER_PROMPT_TOKENS,
+    OPENROUTER_REQUEST_SECONDS,
+    OPENROUTER_SLOT_WAIT_SECONDS,
+)
 
 
-async def fetch_openrouter_chat_completion(messages: list[dict[str, str]]) -> str:
-    url = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+T = TypeVar("T")
+
+
+# Sent after the system prompt on every call; part of the static, cacheable prefix
+PREFIX_INSTRUCTION = "only generate omega responses"
+
+
+def _json(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _takes_cache_control(model: str) -> bool:
+    prefixes = [p.strip() for p in settings.openrouter_cache_control_models.split(",") if p.strip()]
+    return any(model.startswith(prefix) for prefix in prefixes)
+
+
+@lru_cache(maxsize=256)
+def static_prompt_prefix(model: str, system_prompt: str) -> bytes:
+    """
+    The system prompt and fixed instruction, serialized once per model.
+
+    Providers that cache prompt prefixes only on request (Anthropic, Gemini)
+    get a `cache_control` breakpoint on the last static message, which
+    covers everything before it; others (OpenAI, DeepSeek...) cache
+    identical prefixes on their own, so theirs stays plain text.
+    """
+    instruction: Any = PREFIX_INSTRUCTION
+    if _takes_cache_control(model):
+        instruction = [{"type": "text", "text": PREFIX_INSTRUCTION, "cache_control": {"type": "ephemeral"}}]
+    return _json([
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": instruction},
+    ])[1:-1]  # Without the brackets, to be spliced into each request's messages array
+
+
+def _build_request(
+    messages: list[dict[str, str]],
+    stream: bool = False,
+    include_system_prompt: bool = True,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+) -> tuple[dict[str, str], str, bytes]:
+    """Returns the headers, model and encoded JSON body; only the conversation is serialized per call."""
     headers = {
         "Authorization": f"Bearer {settings.openrouter_api_key}",
         "Content-Type": "application/json",
     }
-    
-    # Prepend system prompt to messages
-    system_message = {"role": "system", "content": settings.system_prompt}
-    full_messages = [system_message] + [{"role": "user", "content": "only generate omega responses"}] + messages
-    
-    payload: dict[str, Any] = {
-        "model": settings.openrouter_model,
-        "messages": full_messages,
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers, timeout=120) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                raise RuntimeError(f"OpenRouter error {resp.status}: {text}")
-            data = await resp.json()
-            # Expecting OpenAI-like structure
+    model = model or settings.openrouter_model
+
+    body = _json(messages)
+    if include_system_prompt:
+        prefix = static_prompt_prefix(model, system_prompt or settings.system_prompt)
+        body = b"[" + prefix + (b"," + body[1:] if messages else b"]")
+
+    body = b'{"model":' + _json(model) + b',"messages":' + body
+    if stream:
+        # Streams only report usage (and so cached tokens) when asked to
+        body += b',"stream":true,"usage":{"include":true}'
+    return headers, model, body + b"}"
+
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class OpenRouterError(RuntimeError):
+    def __init__(
+        self,
+        message: str,
+        status: Optional[int] = None,
+        retryable: bool = False,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class UpstreamBusyError(OpenRouterError):
+    """Raised immediately when the in-flight limit and its wait queue are both full."""
+
+
+class DeadlineExceededError(OpenRouterError):
+    """Raised when a request's deadline runs out before OpenRouter answers."""
+
+
+class Deadline:
+    """Absolute time budget for one chat request, shared by every upstream attempt it makes."""
+
+    def __init__(self, seconds: float) -> None:
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+@dataclass
+class UpstreamUsage:
+    """The model that served a reply and the token counts it reported."""
+
+    model: Optional[str] = None
+    # Candidate the router sent the request to; `model` is whatever upstream reports back
+    route: Optional[str] = None
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def update_from(self, other: "UpstreamUsage") -> None:
+        """Take over another attempt's figures, e.g. those of the winner of a hedged race."""
+        for field in fields(self):
+            setattr(self, field.name, getattr(other, field.name))
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(attempt: int, retry_after: Optional[float]) -> float:
+    if retry_after is not None:
+        return retry_after
+    # Full jitter: spreads retries from concurrent requests instead of synchronizing them
+    return random.uniform(0, min(settings.openrouter_retry_backoff_max, settings.openrouter_retry_backoff * 2 ** attempt))
+
+
+class OpenRouterClient:
+    """App-lifetime aiohttp client for OpenRouter with a keep-alive connection pool.
+
+    A semaphore bounds concurrent upstream requests; callers beyond the limit wait
+    in line and are counted as queued until a slot frees up. Once `max_queue`
+    callers are already waiting, new ones are rejected at once with
+    `UpstreamBusyError` rather than piling up. Retryable failures (429, 5xx,
+    timeouts, connection errors) are retried with jittered exponential backoff,
+    honouring `Retry-After`, within the caller's `Deadline`.
+    """
+
+    def __init__(
+        self,
+        pool_size: int,
+        pool_per_host: int,
+        dns_cache_ttl: int,
+        keepalive_timeout: float,
+        max_concurrency: int,
+        max_queue: int,
+        max_retries: int,
+    ) -> None:
+        self._pool_size = pool_size
+        self._pool_per_host = pool_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+        self._keepalive_timeout = keepalive_timeout
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: aiohttp.ClientSession | None = None
+        self.queued = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self._pool_size,
+            limit_per_host=self._pool_per_host,
+            ttl_dns_cache=self._dns_cache_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self._keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("OpenRouter client is not started")
+        return self._session
+
+    @asynccontextmanager
+    async def _slot(self, deadline: Optional[Deadline]) -> AsyncIterator[None]:
+        if self._semaphore.locked() and self.queued >= self._max_queue:
+            self.rejected += 1
+            raise UpstreamBusyError("Upstream capacity exhausted", status=429, retry_after=1.0)
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=deadline.remaining() if deadline else None)
+        except asyncio.TimeoutError as exc:
+            raise DeadlineExceededError("Deadline exceeded waiting for an upstream slot") from exc
+        finally:
+            self.queued -= 1
+            OPENROUTER_SLOT_WAIT_SECONDS.observe(time.perf_counter() - start)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def _timeout(self, deadline: Optional[Deadline], stream: bool = False) -> aiohttp.ClientTimeout:
+        # Streams are bounded per read, not in total; the deadline only covers getting them started
+        total = None if stream else settings.openrouter_total_timeout
+        connect = settings.openrouter_connect_timeout
+        if deadline is not None:
+            if deadline.expired:
+                raise DeadlineExceededError("Deadline exceeded before calling OpenRouter")
+            connect = min(connect, deadline.remaining())
+            if total is not None:
+                total = min(total, deadline.remaining())
+        return aiohttp.ClientTimeout(total=total, sock_connect=connect, sock_read=settings.openrouter_read_timeout)
+
+    async def _with_retries(self, attempt_fn: Callable[[], Awaitable[T]], deadline: Optional[Deadline]) -> T:
+        attempt = 0
+        while True:
+            try:
+                return await attempt_fn()
+            except (UpstreamBusyError, DeadlineExceededError):
+                raise
+            except OpenRouterError as exc:
+                if not exc.retryable or attempt >= self._max_retries:
+                    raise
+                delay = _retry_delay(attempt, exc.retry_after)
+                if deadline is not None and delay >= deadline.remaining():
+                    raise
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    def _transport_error(self, exc: Exception, deadline: Optional[Deadline]) -> OpenRouterError:
+        if deadline is not None and deadline.expired:
+            return DeadlineExceededError("Deadline exceeded waiting for OpenRouter")
+        if isinstance(exc, asyncio.TimeoutError):
+            return OpenRouterError("OpenRouter request timed out", retryable=True)
+        return OpenRouterError(f"OpenRouter connection error: {exc}", retryable=True)
+
+    @staticmethod
+    async def _status_error(resp: aiohttp.ClientResponse) -> OpenRouterError:
+        text = await resp.text()
+        return OpenRouterError(
+            f"OpenRouter error {resp.status}: {text}",
+            status=resp.status,
+            retryable=resp.status in RETRYABLE_STATUSES,
+            retry_after=_parse_retry_after(resp.headers.get("Retry-After")),
+        )
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "max_concurrency": self._max_concurrency,
+            "max_queue": self._max_queue,
+            "pool_size": self._pool_size,
+            "pool_per_host": self._pool_per_host,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_prompt_ratio": self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
+
+    def _record_usage(
+        self, model: str, usage: Optional[dict], served_by: Optional[str], into: Optional[UpstreamUsage]
+    ) -> None:
+        """Count prompt tokens the provider served from its prefix cache versus processed afresh."""
+        if into is not None:
+            # `openrouter/auto` and the like report the concrete model they routed to
+            into.model = served_by or model
+        if not usage:
+            return
+        prompt = usage.get("prompt_tokens") or 0
+        cached = min((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0, prompt)
+        completion = usage.get("completion_tokens") or 0
+        if into is not None:
+            into.prompt_tokens, into.cached_prompt_tokens, into.completion_tokens = prompt, cached, completion
+        self.prompt_tokens += prompt
+        self.cached_prompt_tokens += cached
+        self.completion_tokens += completion
+        OPENROUTER_PROMPT_TOKENS.labels(model=model, cache="cached").inc(cached)
+        OPENROUTER_PROMPT_TOKENS.labels(model=model, cache="uncached").inc(prompt - cached)
+        OPENROUTER_COMPLETION_TOKENS.labels(model=model).inc(completion)
+
+    async def complete(
+        self,
+        messages: list[dict[str, str]],
+        include_system_prompt: bool = True,
+        model: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+        system_prompt: Optional[str] = None,
+        usage: Optional[UpstreamUsage] = None,
+    ) -> str:
+        headers, model, body = _build_request(
+            messages, include_system_prompt=include_system_prompt, model=model, system_prompt=system_prompt
+        )
+
+        async def attempt() -> dict:
+            async with self._slot(deadline):
+                start = time.perf_counter()
+                status = "error"
+                try:
+                    async with self.session.post(
+                        OPENROUTER_URL, data=body, headers=headers, timeout=self._timeout(deadline)
+                    ) as resp:
+                        status = str(resp.status)
+                        if resp.status != 200:
+                            raise await self._status_error(resp)
+                        return await resp.json()
+                except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+                    raise self._transport_error(exc, deadline) from exc
+                finally:
+                    OPENROUTER_REQUEST_SECONDS.labels(model=model, status=status).observe(
+                        time.perf_counter() - start
+                    )
+
+        data = await self._with_retries(attempt, deadline)
+        # Expecting OpenAI-like structure
+        try:
+            content = data["choices"][0]["message"]["content"].strip()
+        except Exception as exc:  # noqa: BLE001
+            raise OpenRouterError("Unexpected OpenRouter response format") from exc
+        self._record_usage(model, data.get("usage"), data.get("model"), usage)
+        return content
+
+    async def stream(
+        self,
+        messages: list[dict[str, str]],
+        model: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+        system_prompt: Optional[str] = None,
+        usage: Optional[UpstreamUsage] = None,
+    ) -> AsyncIterator[str]:
+        """Yield content deltas from an OpenRouter `stream: true` completion as they arrive.
+
+        Only opening the stream is retried; once deltas flow, a failure ends it.
+        `usage` is filled in as the stream reports it (normally with its last chunk).
+        """
+        headers, model, body = _build_request(messages, stream=True, model=model, system_prompt=system_prompt)
+
+        async def attempt() -> tuple[AsyncExitStack, aiohttp.ClientResponse]:
+            stack = AsyncExitStack()
             try:
-                return data["choices"][0]["message"]["content"].strip()
-            except Exception as exc:  # noqa: BLE001
-                raise RuntimeError("Unexpected OpenRouter response format") from exc
+                await stack.enter_async_context(self._slot(deadline))
+                start = time.perf_counter()
+                try:
+                    resp = await stack.enter_async_context(self.session.post(
+                        OPENROUTER_URL, data=body, headers=headers, timeout=self._timeout(deadline, stream=True)
+                    ))
+                except BaseException:
+                    OPENROUTER_REQUEST_SECONDS.labels(model=model, status="error").observe(
+                        time.perf_counter() - start
+                    )
+                    raise
+                OPENROUTER_REQUEST_SECONDS.labels(model=model, status=str(resp.status)).observe(
+                    time.perf_counter() - start
+                )
+                if resp.status != 200:
+                    raise await self._status_error(resp)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+                await stack.aclose()
+                raise self._transport_error(exc, deadline) from exc
+            except BaseException:
+                await stack.aclose()
+                raise
+            return stack, resp
+
+        stack, resp = await self._with_retries(attempt, deadline)
+        opened_at = time.perf_counter()
+        first_delta = True
+        async with stack:
+            try:
+                # Server-sent events: "data: {...}" lines, ": comment" keep-alives, "data: [DONE]" terminator
+                async for raw_line in resp.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    if "error" in chunk:
+                        raise OpenRouterError(f"OpenRouter stream error: {chunk['error']}")
+                    if first_delta and usage is not None:
+                        # Recorded up front too, in case the stream ends before its usage chunk
+                        usage.model = chunk.get("model") or model
+                    if chunk.get("usage"):
+                        # Sent in the last chunk, usually with no choices
+                        self._record_usage(model, chunk["usage"], chunk.get("model"), usage)
+                        if not chunk.get("choices"):
+                            continue
+                    try:
+                        delta = chunk["choices"][0].get("delta", {}).get("content")
+                    except (KeyError, IndexError) as exc:
+                        raise OpenRouterError("Unexpected OpenRouter response format") from exc
+                    if delta:
+                        if first_delta:
+                            first_delta = False
+                            OPENROUTER_FIRST_TOKEN_SECONDS.labels(model=model).observe(
+                                time.perf_counter() - opened_at
+                            )
+                        yield delta
+            except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+                raise OpenRouterError(f"OpenRouter stream interrupted: {exc}") from exc
+
+
+_client: OpenRouterClient | None = None
+
+
+def get_openrouter_client() -> OpenRouterClient:
+    global _client
+    if _client is None:
+        _client = OpenRouterClient(
+            pool_size=settings.openrouter_pool_size,
+            pool_per_host=settings.openrouter_pool_per_host,
+            dns_cache_ttl=settings.openrouter_dns_cache_ttl,
+            keepalive_timeout=settings.openrouter_keepalive_timeout,
+            max_concurrency=settings.openrouter_max_concurrency,
+            max_queue=settings.openrouter_max_queue,
+            max_retries=settings.openrouter_max_retries,
+        )
+    return _client
+
+
+async def start_openrouter_client() -> None:
+    await get_openrouter_client().start()
+
+
+async def close_openrouter_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+async def fetch_openrouter_chat_completion(
+    messages: list[dict[str, str]],
+    include_system_prompt: bool = True,
+    model: Optional[str] = None,
+    deadline: Optional[Deadline] = None,
+    system_prompt: Optional[str] = None,
+    usage: Optional[UpstreamUsage] = None,
+) -> str:
+    client = get_openrouter_client()
+    await client.start()
+    return await client.complete(
+        messages,
+        include_system_prompt=include_system_prompt,
+        model=model,
+        deadline=deadline,
+        system_prompt=system_prompt,
+        usage=usage,
+    )
 
 
+async def stream_openrouter_chat_completion(
+    messages: list[dict[str, str]],
+    model: Optional[str] = None,
+    deadline: Optional[Deadline] = None,
+    system_prompt: Optional[str] = None,
+    usage: Optional[UpstreamUsage] = None,
+) -> AsyncIterator[str]:
+    client = get_openrouter_client()
+    await client.start()
+    async for delta in client.stream(
+        messages, model=model, deadline=deadline, system_prompt=system_prompt, usage=usage
+    ):
+        yield delta
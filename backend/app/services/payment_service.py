@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+from pymongo import UpdateOne
+from ..auth import invalidate_cached_user
+from ..config import settings
+from ..db import get_db, run_in_transaction
+
+
+logger = logging.getLogger(__name__)
+
+PROCESSED_PAYMENTS_COLLECTION = "processed_payments"
+
+
+@dataclass
+class PaymentGrant:
+    """Credits owed for one succeeded PaymentIntent."""
+
+    payment_intent_id: str
+    user_email: str
+    credits: int
+    source: str  # "webhook" or "confirm"
+    event_id: Optional[str] = None
+
+
+@dataclass
+class GrantResult:
+    first_seen: bool  # False when this PaymentIntent had already been processed
+    user_found: bool
+
+
+async def apply_payment_grants(grants: list[PaymentGrant]) -> list[GrantResult]:
+    """
+    Credit a batch of paid PaymentIntents exactly once each.
+
+    One bulk upsert per PaymentIntent into `processed_payments` (keyed by its
+    id) claims it; only the grants that upsert inserted are credited, so a
+    replayed webhook or a racing /payments/confirm finds the document already
+    there and changes nothing. A grant is `first_seen` only when this call
+    credited it. Grants for unknown users are left unclaimed, so they can be
+    retried once the user exists.
+
+    With MONGODB_TRANSACTIONS the claim and the credit commit together.
+    Without, a crash between the two leaves a payment recorded in
+    `processed_payments` but not credited - never credited twice.
+    """
+    db = get_db()
+    now = datetime.now(timezone.utc)
+    emails = {grant.user_email for grant in grants}
+    found = {
+        user["email"]
+        async for user in db["users"].find({"email": {"$in": list(emails)}}, {"email": 1})
+    }
+    claimable = [i for i, grant in enumerate(grants) if grant.user_email in found]
+    credited: set[int] = set()
+
+    async def write(mongo_session) -> None:
+        credited.clear()
+        if not claimable:
+            return
+        claimed = await db[PROCESSED_PAYMENTS_COLLECTION].bulk_write(
+            [
+                UpdateOne(
+                    {"_id": grants[i].payment_intent_id},
+                    {"$setOnInsert": {
+                        "user_email": grants[i].user_email,
+                        "credits": grants[i].credits,
+                        "source": grants[i].source,
+                        "event_id": grants[i].event_id,
+                        "processed_at": now,
+                    }},
+                    upsert=True,
+                )
+                for i in claimable
+            ],
+            ordered=False,
+            session=mongo_session,
+        )
+        # A PaymentIntent repeated within the batch is inserted once; credit its first grant
+        inserted = set(claimed.upserted_ids.values())
+        for i in claimable:
+            if grants[i].payment_intent_id in inserted:
+                inserted.discard(grants[i].payment_intent_id)
+                credited.add(i)
+        if credited:
+            await db["users"].bulk_write(
+                [
+                    UpdateOne(
+                        {"email": grants[i].user_email},
+                        {"$inc": {"credits_available": grants[i].credits, "total_credits_purchased": grants[i].credits}},
+                    )
+                    for i in sorted(credited)
+                ],
+                ordered=False,
+                session=mongo_session,
+            )
+
+    await run_in_transaction(write)
+
+    for email in {grants[i].user_email for i in credited}:
+        await invalidate_cached_user(email)
+    logger.info(f"Processed {len(grants)} payments, {len(credited)} new")
+    return [GrantResult(first_seen=i in credited, user_found=grant.user_email in found) for i, grant in enumerate(grants)]
+
+
+class PaymentGrantBatcher:
+    """
+    Coalesces concurrent webhook deliveries into one `apply_payment_grants` call.
+
+    Each caller still waits for its own grant to be applied before answering
+    Stripe, so an acknowledged event is always a credited one. A burst, such
+    as Stripe replaying events after an outage, costs a couple of bulk writes
+    per `max_batch` events instead of several round-trips each.
+    """
+
+    def __init__(self, max_batch: int, linger: float) -> None:
+        self._max_batch = max_batch
+        self._linger = linger
+        self._pending: list[tuple[PaymentGrant, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def apply(self, grant: PaymentGrant) -> GrantResult:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((grant, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._linger, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._apply(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _apply(batch: list[tuple[PaymentGrant, asyncio.Future]]) -> None:
+        try:
+            results = await apply_payment_grants([grant for grant, _ in batch])
+        except Exception as exc:  # noqa: BLE001
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+webhook_grant_batcher = PaymentGrantBatcher(
+    max_batch=settings.stripe_webhook_batch_size,
+    linger=settings.stripe_webhook_batch_linger,
+)
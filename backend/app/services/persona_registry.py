@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Optional
+from ..config import settings
+from ..db import get_db
+from .model_router import model_router
+from .openrouter_service import static_prompt_prefix
+
+
+logger = logging.getLogger(__name__)
+
+PERSONAS_COLLECTION = "personas"
+
+
+@dataclass(frozen=True)
+class Persona:
+    name: str
+    version: int
+    system_prompt: str
+
+
+class PersonaRegistry:
+    """
+    In-memory copy of the `personas` collection, so a chat turn never reads it.
+
+    Persona versions are immutable documents (`name`, `version`,
+    `system_prompt`); publishing a change means inserting the next version.
+    Sessions use the latest version of their persona unless they pinned one.
+    SYSTEM_PROMPT is always version 0 of the default persona, so sessions
+    pinned to it keep it after a default persona is published.
+
+    Every version is loaded at startup. New ones arrive through a change
+    stream, or, where the deployment has no replica set, by polling every
+    `persona_poll_interval` seconds for documents not loaded yet. Polling
+    goes by the ids already seen rather than past the highest one, since
+    ids made by other clients need not arrive in order.
+    Each version's message prefix is compiled for the routed models as it
+    arrives, so the first turn to use it doesn't pay for that.
+    """
+
+    def __init__(self, poll_interval: float) -> None:
+        self._poll_interval = poll_interval
+        builtin = self._builtin()
+        self._versions: dict[str, dict[int, Persona]] = {builtin.name: {0: builtin}}
+        self._latest: dict[str, Persona] = {builtin.name: builtin}
+        self._seen_ids: set[Any] = set()
+        self._watcher: asyncio.Task | None = None
+        self.mode = "startup"
+        self.loaded = 0
+
+    def _builtin(self) -> Persona:
+        # SYSTEM_PROMPT stays the default until a later version by that name is published
+        return Persona(name=settings.persona_default, version=0, system_prompt=settings.system_prompt)
+
+    def get(self, name: Optional[str] = None, version: Optional[int] = None) -> Persona:
+        """The persona to use for a session; unknown names fall back to the default persona."""
+        versions = self._versions.get(name or settings.persona_default)
+        if versions is None:
+            return self._latest[settings.persona_default]
+        if version is not None and version in versions:
+            return versions[version]
+        return self._latest[name or settings.persona_default]
+
+    def exists(self, name: str, version: Optional[int] = None) -> bool:
+        versions = self._versions.get(name)
+        return versions is not None and (version is None or version in versions)
+
+    def list(self) -> list[Persona]:
+        """Latest version of every persona, the default first."""
+        latest = dict(self._latest)
+        default = latest.pop(settings.persona_default)
+        return [default] + sorted(latest.values(), key=lambda p: p.name)
+
+    def _add(self, doc: dict) -> None:
+        if doc["_id"] in self._seen_ids:
+            return
+        self._seen_ids.add(doc["_id"])
+        try:
+            persona = Persona(name=doc["name"], version=int(doc["version"]), system_prompt=doc["system_prompt"])
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Ignoring malformed persona document {doc['_id']}")
+            return
+        for model in model_router.candidates:
+            static_prompt_prefix(model, persona.system_prompt)
+        self._versions.setdefault(persona.name, {})[persona.version] = persona
+        latest = self._latest.get(persona.name)
+        # >= so a published version 0 of the default persona replaces the built-in one
+        if latest is None or persona.version >= latest.version:
+            self._latest[persona.name] = persona
+            logger.info(f"Persona {persona.name} is now at version {persona.version}")
+        self.loaded += 1
+
+    async def _load_new(self) -> None:
+        query = {"_id": {"$nin": list(self._seen_ids)}} if self._seen_ids else {}
+        async for doc in get_db()[PERSONAS_COLLECTION].find(query).sort("version", 1):
+            self._add(doc)
+
+    async def start(self) -> None:
+        await self._load_new()
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+
+    async def _watch(self) -> None:
+        collection = get_db()[PERSONAS_COLLECTION]
+        while True:
+            if self.mode != "poll":
+                try:
+                    async with collection.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                        self.mode = "change_stream"
+                        # Versions inserted before the stream opened
+                        await self._load_new()
+                        async for change in stream:
+                            self._add(change["fullDocument"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:  # noqa: BLE001
+                    if self.mode == "change_stream":
+                        logger.warning(f"Persona change stream interrupted, reopening: {str(exc)}")
+                    else:
+                        # Change streams need a replica set; standalone servers keep polling
+                        logger.info(f"Persona change stream unavailable, polling instead: {str(exc)}")
+                        self.mode = "poll"
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await self._load_new()
+            except Exception as exc:  # noqa: BLE001
+                logger.warning(f"Could not reload personas: {str(exc)}")
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "personas": len(self._latest),
+            "versions_loaded": self.loaded,
+        }
+
+
+persona_registry = PersonaRegistry(poll_interval=settings.persona_poll_interval)
+
+
+async def start_persona_registry() -> None:
+    await persona_registry.start()
+
+
+async def stop_persona_registry() -> None:
+    await persona_registry.stop()
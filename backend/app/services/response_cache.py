@@ -0,0 +1,164 @@
+import hashlib
+import json
+import random
+import re
+from typing import AsyncIterator, Optional
+from ..cache import CacheBackend, LocalTTLCache, RedisCache
+from ..config import settings
+from .model_router import model_router
+from .openrouter_service import Deadline, UpstreamUsage
+
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s.!?,~]+$")
+IMAGE_PLACEHOLDER = "[image]"
+
+
+def _normalize(message: dict[str, str]) -> list[str]:
+    content = message.get("content", "")
+    # Image turns all share one key: the reply is generic, and every upload has a distinct URL
+    if content.startswith("[User sent an image at "):
+        content = IMAGE_PLACEHOLDER
+    else:
+        content = _TRAILING_PUNCTUATION.sub("", _WHITESPACE.sub(" ", content.casefold()).strip())
+    return [message.get("role", "user"), content]
+
+
+class ResponseCache:
+    """
+    Opt-in cache of LLM replies for short conversations that many users open the same way.
+
+    Keys hash the model, the system prompt and the normalized context window, so
+    "Hi!" and "hi" share an entry. Each entry samples `variants` upstream
+    replies before it starts serving hits. With `randomize` on, hits pick one of
+    them per session, so different users get different lines while a session
+    sees the same one again if it repeats itself.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float, max_messages: int, variants: int, randomize: bool) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.variants = max(1, variants)
+        self.randomize = randomize
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def eligible(self, messages: list[dict[str, str]]) -> bool:
+        # Only short histories repeat across users; summaries are per-session by definition
+        return len(messages) <= self.max_messages and all(m.get("role") != "system" for m in messages)
+
+    def key(self, model: str, messages: list[dict[str, str]], system_prompt: Optional[str] = None) -> str:
+        normalized = json.dumps([model, system_prompt or settings.system_prompt, [_normalize(m) for m in messages]])
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str, session_id: Optional[str] = None) -> Optional[str]:
+        entry = await self.backend.get(key)
+        if not entry or entry["samples"] < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        replies = entry["replies"]
+        if not self.randomize:
+            return replies[0]
+        # Seeded, so the pick is reproducible for a session and independent of other requests
+        return random.Random(f"{session_id}:{key}").choice(replies)
+
+    async def put(self, key: str, reply: str) -> None:
+        entry = await self.backend.get(key) or {"replies": [], "samples": 0}
+        if entry["samples"] >= self.variants:
+            return
+        replies = entry["replies"] if reply in entry["replies"] else entry["replies"] + [reply]
+        await self.backend.set(key, {"replies": replies, "samples": entry["samples"] + 1}, self.ttl)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": settings.response_cache_enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            # Every hit is an upstream completion that was not paid for
+            "upstream_calls_saved": self.hits,
+        }
+
+
+def _create_response_cache() -> ResponseCache:
+    backend: CacheBackend
+    if settings.response_cache_backend == "redis":
+        if not settings.redis_url:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis requires REDIS_URL")
+        backend = RedisCache(settings.redis_url, prefix="vg:reply:")
+    else:
+        backend = LocalTTLCache(max_entries=settings.response_cache_max_entries)
+    return ResponseCache(
+        backend,
+        ttl=settings.response_cache_ttl,
+        max_messages=settings.response_cache_max_messages,
+        variants=settings.response_cache_variants,
+        randomize=settings.response_cache_randomize,
+    )
+
+
+response_cache = _create_response_cache()
+
+
+def _cache_key(messages: list[dict[str, str]], system_prompt: Optional[str]) -> Optional[str]:
+    if not settings.response_cache_enabled:
+        return None
+    if not response_cache.eligible(messages):
+        response_cache.bypassed += 1
+        return None
+    return response_cache.key(model_router.primary, messages, system_prompt)
+
+
+def _served_by_primary(key: Optional[str], usage: UpstreamUsage) -> bool:
+    # Keys name the primary model; a fallback's reply must not be served as if it came from it
+    return key is not None and usage.route == model_router.primary
+
+
+async def cached_chat_completion(
+    messages: list[dict[str, str]],
+    deadline: Optional[Deadline] = None,
+    system_prompt: Optional[str] = None,
+    usage: Optional[UpstreamUsage] = None,
+    session_id: Optional[str] = None,
+) -> str:
+    """Routed chat completion behind the response cache; `usage` is left empty on a hit."""
+    key = _cache_key(messages, system_prompt)
+    if key is not None:
+        cached = await response_cache.get(key, session_id)
+        if cached is not None:
+            return cached
+    usage = usage if usage is not None else UpstreamUsage()
+    reply = await model_router.complete(messages, deadline=deadline, system_prompt=system_prompt, usage=usage)
+    if _served_by_primary(key, usage):
+        await response_cache.put(key, reply)
+    return reply
+
+
+async def cached_stream_chat_completion(
+    messages: list[dict[str, str]],
+    deadline: Optional[Deadline] = None,
+    system_prompt: Optional[str] = None,
+    usage: Optional[UpstreamUsage] = None,
+    session_id: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """Routed streaming completion behind the response cache; a hit arrives as a single delta."""
+    key = _cache_key(messages, system_prompt)
+    if key is not None:
+        cached = await response_cache.get(key, session_id)
+        if cached is not None:
+            yield cached
+            return
+    usage = usage if usage is not None else UpstreamUsage()
+    parts: list[str] = []
+    async for delta in model_router.stream(
+        messages, deadline=deadline, system_prompt=system_prompt, usage=usage
+    ):
+        parts.append(delta)
+        yield delta
+    if _served_by_primary(key, usage):
+        await response_cache.put(key, "".join(parts).strip())
@@ -1,10 +1,41 @@
+import hashlib
+import json
 import stripe
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from ..config import settings
 
 # Configure Stripe
 stripe.api_key = settings.stripe_secret_key
 
+_client: Optional[stripe.StripeClient] = None
+_http_client: Optional[stripe.AIOHTTPClient] = None
+
+
+def get_stripe_client() -> stripe.StripeClient:
+    """
+    Shared Stripe client making non-blocking calls over one aiohttp
+    connection pool. STRIPE_API_BASE points it at a local stub (e.g.
+    stripe-mock) for testing.
+    """
+    global _client, _http_client
+    if _client is None:
+        _http_client = stripe.AIOHTTPClient(timeout=settings.stripe_timeout)
+        _client = stripe.StripeClient(
+            settings.stripe_secret_key,
+            http_client=_http_client,
+            base_addresses={"api": settings.stripe_api_base} if settings.stripe_api_base else {},
+            max_network_retries=settings.stripe_max_network_retries,
+        )
+    return _client
+
+
+async def close_stripe_client() -> None:
+    global _client, _http_client
+    if _http_client is not None:
+        await _http_client.close_async()
+    _client = None
+    _http_client = None
+
 
 async def create_payment_intent(amount_gbp: float, user_email: str, credits_to_purchase: int) -> Dict[str, Any]:
     """
@@ -22,16 +53,16 @@ async def create_payment_intent(amount_gbp: float, user_email: str, credits_to_p
         # Convert GBP to pence (Stripe expects amounts in smallest currency unit)
         amount_pence = int(amount_gbp * 100)
         
-        intent = stripe.PaymentIntent.create(
-            amount=amount_pence,
-            currency='gbp',
-            metadata={
+        intent = await get_stripe_client().payment_intents.create_async(params={
+            'amount': amount_pence,
+            'currency': 'gbp',
+            'metadata': {
                 'user_email': user_email,
                 'credits_to_purchase': str(credits_to_purchase),
                 'type': 'credit_purchase'
             },
-            description=f'Purchase of {credits_to_purchase} credits for {user_email}'
-        )
+            'description': f'Purchase of {credits_to_purchase} credits for {user_email}'
+        })
         
         return {
             'client_secret': intent.client_secret,
@@ -65,6 +96,14 @@ async def verify_payment_webhook(payload: bytes, signature: str) -> Dict[str, An
         raise RuntimeError("Invalid signature")
 
 
+async def retrieve_payment_intent(payment_intent_id: str) -> stripe.PaymentIntent:
+    """Fetch a PaymentIntent from Stripe."""
+    try:
+        return await get_stripe_client().payment_intents.retrieve_async(payment_intent_id)
+    except stripe.error.StripeError as e:
+        raise RuntimeError(f"Stripe error: {str(e)}")
+
+
 def calculate_credit_price(credits: int) -> float:
     """
     Calculate the price for a given number of credits.
@@ -79,6 +118,18 @@ def calculate_credit_price(credits: int) -> float:
     return credits / 1000.0
 
 
+CREDIT_PACKAGES: list[Dict[str, Any]] = [
+    {"credits": 1000, "price_gbp": 1.0, "popular": False},
+    {"credits": 5000, "price_gbp": 4.5, "popular": True, "discount": "10% off"},
+    {"credits": 10000, "price_gbp": 8.0, "popular": False, "discount": "20% off"},
+    {"credits": 25000, "price_gbp": 18.75, "popular": False, "discount": "25% off"},
+]
+
+# The catalog only changes with a deploy, so it is serialized once and versioned by content
+PACKAGE_CATALOG_BODY = json.dumps(CREDIT_PACKAGES, separators=(",", ":")).encode("utf-8")
+PACKAGE_CATALOG_ETAG = f'"{hashlib.sha256(PACKAGE_CATALOG_BODY).hexdigest()[:16]}"'
+
+
 def get_credit_packages() -> list[Dict[str, Any]]:
     """
     Get available credit packages.
@@ -86,11 +137,4 @@ def get_credit_packages() -> list[Dict[str, Any]]:
     Returns:
         List of credit packages with pricing
     """
-    packages = [
-        {"credits": 1000, "price_gbp": 1.0, "popular": False},
-        {"credits": 5000, "price_gbp": 4.5, "popular": True, "discount": "10% off"},
-        {"credits": 10000, "price_gbp": 8.0, "popular": False, "discount": "20% off"},
-        {"credits": 25000, "price_gbp": 18.75, "popular": False, "discount": "25% off"},
-    ]
-    
-    return packages
+    return CREDIT_PACKAGES
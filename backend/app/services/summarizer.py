@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import Any
+from ..config import settings
+from ..db import get_db
+from .message_service import MESSAGES_COLLECTION
+from .openrouter_service import fetch_openrouter_chat_completion
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a chat between a user and their AI companion. "
+    "Merge the existing summary with the new conversation excerpt into one updated summary. "
+    "Keep names, facts the user shared about themselves, preferences, plans, running jokes and the "
+    "emotional tone. Write in third person, at most 200 words, no preamble."
+)
+
+# Session ids with a summary update in progress in this process, and their tasks
+_pending: dict[Any, asyncio.Task] = {}
+
+
+def _format_excerpt(messages: list[dict]) -> str:
+    lines = []
+    for m in messages:
+        speaker = "User" if m.get("role") == "user" else "AI"
+        content = "[sent an image]" if m.get("type") == "image" else m.get("content", "")
+        lines.append(f"{speaker}: {content}")
+    return "\n".join(lines)
+
+
+async def update_session_summary(session_id: Any) -> None:
+    """
+    Fold messages older than the recent window into the session's running summary.
+
+    Only messages newer than `summary_until` are read, so each update costs one
+    upstream call over at most `summary_batch_messages` messages.
+    """
+    db = get_db()
+    session = await db["chat_sessions"].find_one(
+        {"_id": session_id}, {"summary": 1, "summary_until": 1}
+    )
+    if not session:
+        return
+
+    query: dict[str, Any] = {"session_id": session_id}
+    if session.get("summary_until"):
+        query["timestamp"] = {"$gt": session["summary_until"]}
+    unsummarized = await (
+        db[MESSAGES_COLLECTION]
+        .find(query, {"session_id": 0})
+        .sort("timestamp", 1)
+        .limit(settings.summary_batch_messages + settings.summary_keep_recent)
+        .to_list(length=None)
+    )
+    # The newest messages stay verbatim in the prompt window
+    to_fold = unsummarized[:-settings.summary_keep_recent] if settings.summary_keep_recent else unsummarized
+    if not to_fold:
+        return
+
+    prompt = (
+        f"Existing summary:\n{session.get('summary') or '(none)'}\n\n"
+        f"New conversation excerpt:\n{_format_excerpt(to_fold)}"
+    )
+    summary = await fetch_openrouter_chat_completion(
+        [{"role": "system", "content": SUMMARY_INSTRUCTIONS}, {"role": "user", "content": prompt}],
+        include_system_prompt=False,
+    )
+    await db["chat_sessions"].update_one(
+        {"_id": session_id},
+        {
+            "$set": {
+                "summary": summary,
+                "summary_until": to_fold[-1]["timestamp"],
+                "turns_since_summary": 0,
+            }
+        },
+    )
+    logger.info(f"Summarized {len(to_fold)} messages for session {session_id}")
+
+
+async def _run(session_id: Any) -> None:
+    try:
+        await update_session_summary(session_id)
+    except Exception as e:  # noqa: BLE001
+        logger.error(f"Summary update failed for session {session_id}: {str(e)}")
+    finally:
+        _pending.pop(session_id, None)
+
+
+def schedule_summary(session_id: Any) -> None:
+    """Start a summary update in the background unless one is already running for the session."""
+    if session_id in _pending:
+        return
+    _pending[session_id] = asyncio.create_task(_run(session_id))
+
+
+async def drain_summaries(timeout: float = 10.0) -> None:
+    """Give in-flight summary updates a chance to finish on shutdown."""
+    if _pending:
+        await asyncio.wait(list(_pending.values()), timeout=timeout)
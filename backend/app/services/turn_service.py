@@ -0,0 +1,287 @@
+import logging
+from functools import partial
+from typing import Any, Awaitable, Callable
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from ..auth import invalidate_cached_user
+from ..config import settings
+from ..db import get_db, run_in_transaction, run_writes
+from .credit_ledger import (
+    LEDGER_COLLECTION,
+    CreditReservation,
+    charged_amount,
+    ledger_entries,
+    pending_filter,
+    settlement_update,
+)
+from .job_queue import job_queue
+from .message_service import MESSAGES_COLLECTION, applied_turn_filter, session_metadata_update
+from .usage_service import USAGE_EVENTS_COLLECTION, USAGE_ROLLUPS_COLLECTION, rollup_updates
+
+
+logger = logging.getLogger(__name__)
+
+TURN_JOB = "chat_turn"
+TURN_PARTS = ("messages", "session", "credits", "ledger", "usage_event", "usage_rollups")
+# Outcomes of earlier parts that decide what later ones write
+TURN_FLAGS = ("settled", "usage_inserted")
+DUPLICATE_KEY = 11000
+
+
+def new_turn(
+    session_id: Any, messages: list[dict], reservation: CreditReservation, actual: int, usage_event: dict
+) -> dict:
+    """
+    Everything needed to persist a finished chat turn, as a plain document.
+
+    Ids are assigned up front and `done` records which parts have been
+    written, so a turn can be retried, or stored and replayed by another
+    process, without writing anything twice. The turn is billed at most what
+    was reserved for it, so session totals and the ledger match the balance.
+    """
+    actual = charged_amount(reservation.amount, actual)
+    return {
+        "session_id": session_id,
+        "messages": [{**m, "_id": ObjectId(), "session_id": session_id} for m in messages],
+        "user_email": reservation.user_email,
+        "reservation_id": reservation.id,
+        "reserved": reservation.amount,
+        "actual": actual,
+        "ledger": ledger_entries(reservation, "settle", actual, {"session_id": session_id}),
+        "usage_event": usage_event,
+        "done": [],
+    }
+
+
+def _ledger(turn: dict) -> list[dict]:
+    # A turn whose hold was already released (e.g. by the expiry sweep) moved no credits;
+    # the release wrote its own entries. Turns queued before `settled` existed always settled
+    return turn["ledger"] if turn.get("settled", True) else []
+
+
+async def _settle(db, turns: list[dict], mongo_session) -> None:
+    # One update per turn: whether its own update matched decides if it gets ledger entries
+    for turn in turns:
+        if "settled" in turn:
+            continue
+        result = await db["users"].update_one(
+            pending_filter(turn["user_email"], turn.get("reservation_id")),
+            settlement_update(turn.get("reservation_id"), turn["reserved"], turn["actual"]),
+            session=mongo_session,
+        )
+        turn["settled"] = bool(result.matched_count)
+
+
+def _with_usage_event(turn: dict) -> list[dict]:
+    # Turns queued before usage events existed have none
+    return [turn] if turn.get("usage_event") else []
+
+
+async def _insert_usage_events(db, turns: list[dict], mongo_session) -> None:
+    # Upserts, so the result says which events this write inserted; only those get rolled up
+    events = {turn["usage_event"]["_id"]: turn for turn in turns}
+
+    def mark_inserted(event_ids) -> None:
+        for event_id in event_ids:
+            events[event_id]["usage_inserted"] = True
+
+    try:
+        result = await db[USAGE_EVENTS_COLLECTION].bulk_write(
+            [
+                UpdateOne({"_id": event_id}, {"$setOnInsert": turn["usage_event"]}, upsert=True)
+                for event_id, turn in events.items()
+            ],
+            ordered=False,
+            session=mongo_session,
+        )
+    except BulkWriteError as exc:
+        # The turns that did go through keep their claim to the rollups when the rest are retried
+        mark_inserted(upsert["_id"] for upsert in exc.details.get("upserted", []))
+        raise
+    mark_inserted(result.upserted_ids.values())
+
+
+def _rollups(turn: dict) -> list[UpdateOne]:
+    if not turn.get("usage_inserted"):
+        return []
+    return rollup_updates(turn["usage_event"], settings.usage_global_shards)
+
+
+async def _write_part(
+    part: str,
+    turns: list[dict],
+    items_of: Callable[[dict], list],
+    write: Callable[[list], Awaitable[Any]],
+    ordered: bool,
+    mongo_session,
+    duplicates_done: bool = True,
+) -> None:
+    pending = [turn for turn in turns if part not in turn["done"]]
+    if not pending:
+        return
+    owners, items = [], []
+    for turn in pending:
+        for item in items_of(turn):
+            owners.append(turn)
+            items.append(item)
+
+    failed: set[int] = set()
+    try:
+        if items:
+            await write(items)
+    except BulkWriteError as exc:
+        if mongo_session is not None or exc.details.get("writeConcernErrors"):
+            raise
+        # Duplicate ids were written by an earlier attempt and count as done; for
+        # upserts a duplicate key means a concurrent upsert won the race, so retry
+        errors = [
+            e["index"] for e in exc.details["writeErrors"]
+            if e.get("code") != DUPLICATE_KEY or not duplicates_done
+        ]
+        if errors:
+            # An ordered write stops at its first error
+            failed_items = range(min(errors), len(items)) if ordered else errors
+            failed = {id(owners[i]) for i in failed_items}
+            logger.warning(f"Failed to write {part} for {len(failed)} chat turns")
+    except PyMongoError as exc:
+        if mongo_session is not None:
+            raise
+        logger.warning(f"Failed to write {part} for {len(pending)} chat turns: {str(exc)}")
+        return
+    for turn in pending:
+        if id(turn) not in failed:
+            turn["done"].append(part)
+
+
+async def commit_turns(turns: list[dict]) -> list[dict]:
+    """
+    Persist a batch of chat turns; returns the turns that still need another attempt.
+
+    Each part is one bulk write for the whole batch - the messages, session
+    metadata, ledger entries, usage events and usage rollups - except the
+    balance settlements, one update per turn. They run concurrently, or inside
+    a single transaction with MONGODB_TRANSACTIONS. Session updates keep their
+    order so the latest turn sets the preview.
+
+    Every part is safe to repeat: inserts carry ids assigned up front and
+    the session counters and credit settlement are keyed on the turn's
+    reservation, so an update that already went through changes nothing the
+    second time.
+
+    Ledger entries are written after the settlement, and only for turns whose
+    settlement applied: a hold the expiry sweep gave back first has its
+    release entries instead. Likewise rollups are only added for turns whose
+    usage event upsert inserted it, so a replayed turn isn't counted twice.
+    """
+    db = get_db()
+    state_before = [(list(turn["done"]), {flag: turn[flag] for flag in TURN_FLAGS if flag in turn}) for turn in turns]
+
+    def restore_state() -> None:
+        for turn, (done, flags) in zip(turns, state_before):
+            turn["done"] = list(done)
+            for flag in TURN_FLAGS:
+                turn.pop(flag, None)
+            turn.update(flags)
+
+    async def settle_and_record(mongo_session) -> None:
+        await _write_part(
+            "credits", turns, lambda t: [t],
+            partial(_settle, db, mongo_session=mongo_session),
+            False, mongo_session,
+        )
+        await _write_part(
+            "ledger", [t for t in turns if "credits" in t["done"]], _ledger,
+            partial(db[LEDGER_COLLECTION].insert_many, ordered=False, session=mongo_session),
+            False, mongo_session,
+        )
+
+    async def record_usage(mongo_session) -> None:
+        await _write_part(
+            "usage_event", turns, _with_usage_event,
+            partial(_insert_usage_events, db, mongo_session=mongo_session),
+            False, mongo_session,
+        )
+        await _write_part(
+            "usage_rollups", [t for t in turns if "usage_event" in t["done"]], _rollups,
+            partial(db[USAGE_ROLLUPS_COLLECTION].bulk_write, ordered=False, session=mongo_session),
+            False, mongo_session, False,
+        )
+
+    async def write_all(mongo_session) -> None:
+        if mongo_session is not None:
+            # The driver may run this again after a transient error; nothing from
+            # an aborted attempt was written, so start again from the same parts
+            restore_state()
+        await run_writes(
+            [
+                partial(
+                    _write_part, "messages", turns, lambda t: t["messages"],
+                    partial(db[MESSAGES_COLLECTION].insert_many, ordered=False, session=mongo_session),
+                    False, mongo_session,
+                ),
+                partial(
+                    _write_part, "session", turns,
+                    lambda t: [UpdateOne(
+                        applied_turn_filter(t["session_id"], t.get("reservation_id")),
+                        session_metadata_update(
+                            t["messages"],
+                            {"turns_since_summary": 1, "credits_used": t["actual"]},
+                            turn_id=t.get("reservation_id"),
+                        ),
+                    )],
+                    partial(db["chat_sessions"].bulk_write, ordered=True, session=mongo_session),
+                    True, mongo_session,
+                ),
+                partial(settle_and_record, mongo_session),
+                partial(record_usage, mongo_session),
+            ],
+            mongo_session,
+        )
+
+    if settings.mongodb_transactions:
+        try:
+            await run_in_transaction(write_all)
+        except PyMongoError as exc:
+            logger.warning(f"Chat turn transaction failed for {len(turns)} turns: {str(exc)}")
+            restore_state()
+            return turns
+    else:
+        await write_all(None)
+
+    for email in {turn["user_email"] for turn in turns if turn.get("settled")}:
+        await invalidate_cached_user(email)
+    return [turn for turn in turns if len(turn["done"]) < len(TURN_PARTS)]
+
+
+job_queue.register(TURN_JOB, commit_turns)
+
+
+def submit_turn(turn: dict) -> None:
+    """
+    Persist a turn in the background; readers of the session wait for it via `job_queue.wait_for_key`.
+
+    Queued turns live in memory until written: if the process dies before
+    then, the reply is lost and its credit hold stays until the reservation
+    sweeper gives it back.
+    """
+    job_queue.submit(TURN_JOB, turn, key=turn["session_id"])
+
+
+async def save_turn(turn: dict) -> None:
+    """
+    Persist a turn before returning, for when the job queue is disabled.
+
+    The reply has already been generated by then, so a turn that can't be
+    written is not an error for the caller: what is left of it goes to
+    `pending_jobs` and is retried from there, like a queued turn would be.
+    """
+    try:
+        unfinished = await commit_turns([turn])
+    except Exception as e:  # noqa: BLE001
+        logger.error(f"Saving chat turn for session {turn['session_id']} failed: {str(e)}")
+        unfinished = [turn]
+    if unfinished:
+        missing = [part for part in TURN_PARTS if part not in turn["done"]]
+        logger.warning(f"Chat turn for session {turn['session_id']} not fully saved ({', '.join(missing)}), deferring it")
+        await job_queue.persist(TURN_JOB, turn, key=turn["session_id"])
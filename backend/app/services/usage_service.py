@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+from urllib.parse import quote, unquote
+from bson import ObjectId
+from pymongo import UpdateOne
+from ..config import settings
+from .openrouter_service import UpstreamUsage
+
+
+USAGE_EVENTS_COLLECTION = "usage_events"
+USAGE_ROLLUPS_COLLECTION = "usage_rollups"
+
+GLOBAL_SCOPE = "*"
+GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+COUNTERS = (
+    "turns",
+    "credits",
+    "user_credits",
+    "ai_credits",
+    "prompt_tokens",
+    "cached_prompt_tokens",
+    "completion_tokens",
+)
+# Model recorded for replies served from the response cache, which reach no model
+CACHED_REPLY_MODEL = "cache"
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    """Start of the UTC hour or day `timestamp` falls in; naive datetimes are taken as UTC."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    timestamp = timestamp.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def model_key(model: str) -> str:
+    # Model ids such as "anthropic/claude-3.5-sonnet" can't be field names as-is
+    return quote(model, safe="/:-_").replace(".", "%2E")
+
+
+def model_name(key: str) -> str:
+    return unquote(key)
+
+
+def usage_event(
+    session_id: Any,
+    user_email: str,
+    persona: str,
+    user_credits: int,
+    ai_credits: int,
+    upstream: Optional[UpstreamUsage],
+    timestamp: datetime,
+) -> dict:
+    """One chat turn's usage; the id is assigned up front so a retried write stays idempotent."""
+    served = upstream is not None and upstream.model is not None
+    return {
+        "_id": ObjectId(),
+        "user_id": user_email,
+        "session_id": session_id,
+        "persona": persona,
+        "model": upstream.model if served else CACHED_REPLY_MODEL,
+        "credits": user_credits + ai_credits,
+        "user_credits": user_credits,
+        "ai_credits": ai_credits,
+        "prompt_tokens": upstream.prompt_tokens if served else 0,
+        "cached_prompt_tokens": upstream.cached_prompt_tokens if served else 0,
+        "completion_tokens": upstream.completion_tokens if served else 0,
+        "timestamp": timestamp,
+    }
+
+
+def global_shard(event_id: ObjectId, shards: int) -> str:
+    """The `GLOBAL_SCOPE` bucket an event is counted in; fixed per event, so retries hit the same one."""
+    return f"{GLOBAL_SCOPE}:{int.from_bytes(event_id.binary, 'big') % shards}"
+
+
+def global_shards(shards: int) -> list[str]:
+    # Plain "*" holds buckets written before the global scope was sharded
+    return [GLOBAL_SCOPE] + [f"{GLOBAL_SCOPE}:{shard}" for shard in range(shards)]
+
+
+def rollup_updates(event: dict, shards: int) -> list[UpdateOne]:
+    """
+    Upserts adding one usage event to its hourly and daily buckets, for the
+    user and for everyone (one of `shards` `GLOBAL_SCOPE` buckets, so busy
+    hours don't all update one document).
+
+    The updates are plain increments: callers apply them only for an event
+    whose own write inserted it, so a retried turn isn't counted twice.
+
+    Buckets also count turns and credits per model under `models`, so a
+    dashboard gets its breakdowns from the bucket documents alone.
+    """
+    amounts = {"turns": 1, **{counter: event[counter] for counter in COUNTERS[1:]}}
+    model = model_key(event["model"])
+    amounts[f"models.{model}.turns"] = 1
+    amounts[f"models.{model}.credits"] = event["credits"]
+    return [
+        UpdateOne(
+            {"user_id": scope, "granularity": granularity, "start": bucket_start(event["timestamp"], granularity)},
+            {"$inc": amounts},
+            upsert=True,
+        )
+        for scope in (event["user_id"], global_shard(event["_id"], shards))
+        for granularity in GRANULARITIES
+    ]
+
+
+def _add_bucket(total: dict, bucket: dict) -> None:
+    for counter in COUNTERS:
+        total[counter] = total.get(counter, 0) + bucket.get(counter, 0)
+    for model, counts in bucket.get("models", {}).items():
+        model_total = total.setdefault("models", {}).setdefault(model, {})
+        for name, value in counts.items():
+            model_total[name] = model_total.get(name, 0) + value
+
+
+async def fetch_rollups(db, scope: str, granularity: str, start: datetime, end: datetime) -> list[dict]:
+    """
+    The buckets from the one containing `start` up to `end`, oldest first.
+
+    Served by the (user_id, granularity, start) index; buckets with no
+    turns don't exist, so the result may have gaps. For `GLOBAL_SCOPE` the
+    shards of each bucket are summed.
+    """
+    cursor = (
+        db[USAGE_ROLLUPS_COLLECTION]
+        .find(
+            {
+                "user_id": (
+                    {"$in": global_shards(settings.usage_global_shards)} if scope == GLOBAL_SCOPE else scope
+                ),
+                "granularity": granularity,
+                "start": {"$gte": bucket_start(start, granularity), "$lt": end},
+            },
+            {"_id": 0, "user_id": 0, "granularity": 0},
+        )
+        .sort("start", 1)
+    )
+    buckets: dict[datetime, dict] = {}
+    async for bucket in cursor:
+        starts_at = bucket["start"].replace(tzinfo=timezone.utc)
+        _add_bucket(buckets.setdefault(starts_at, {"start": starts_at}), bucket)
+    for bucket in buckets.values():
+        bucket["models"] = {model_name(key): counts for key, counts in bucket.get("models", {}).items()}
+    return list(buckets.values())
@@ -0,0 +1,106 @@
+from functools import lru_cache
+from ..config import settings
+from ..services.openrouter_service import PREFIX_INSTRUCTION
+
+
+# Rough tokens-per-character ratio for English chat text; avoids a tokenizer dependency
+CHARS_PER_TOKEN = 4
+# Per-message overhead for role/formatting tokens in chat-completion payloads
+MESSAGE_OVERHEAD_TOKENS = 4
+
+IMAGE_PROMPT = "[User sent an image at {content}]. Provide a flirty, friendly response describing what you might say."
+
+
+def estimate_tokens(text: str | None) -> int:
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    return MESSAGE_OVERHEAD_TOKENS + (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@lru_cache(maxsize=64)
+def _prefix_tokens(system_prompt: str) -> int:
+    # System prompt plus the fixed steering message prepended by the OpenRouter service
+    return estimate_tokens(system_prompt) + estimate_tokens(PREFIX_INSTRUCTION)
+
+
+def get_context_budget(model: str) -> int:
+    """Prompt token budget for a model, falling back to the global default."""
+    return settings.context_token_budgets.get(model, settings.context_token_budget)
+
+
+def to_llm_message(message: dict) -> dict[str, str]:
+    content = message.get("content", "")
+    if message.get("type") == "image":
+        content = IMAGE_PROMPT.format(content=content)
+    return {"role": "user" if message.get("role") == "user" else "assistant", "content": content}
+
+
+def build_context(
+    history: list[dict],
+    model: str,
+    summary: str | None = None,
+    system_prompt: str | None = None,
+) -> tuple[list[dict[str, str]], int]:
+    """
+    Keep the most recent turns of `history` that fit the model's prompt budget.
+
+    Args:
+        history: Stored messages in chronological order, newest last
+        model: Model the prompt is sent to, used to pick the token budget
+        summary: Running summary of turns older than `history`, sent ahead of them
+        system_prompt: The session's persona prompt; defaults to `settings.system_prompt`
+
+    Returns:
+        LLM messages in chronological order and the estimated prompt tokens
+        including the static system prefix
+    """
+    used = _prefix_tokens(system_prompt or settings.system_prompt)
+    summary_message = None
+    if summary:
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+        used += estimate_tokens(summary_message["content"])
+    remaining = get_context_budget(model) - used
+
+    selected: list[dict[str, str]] = []
+    for message in reversed(history):
+        llm_message = to_llm_message(message)
+        cost = estimate_tokens(llm_message["content"])
+        # Always send the newest message, even when it alone exceeds the budget
+        if selected and cost > remaining:
+            break
+        selected.append(llm_message)
+        remaining -= cost
+        used += cost
+
+    selected.reverse()
+    if summary_message:
+        selected.insert(0, summary_message)
+    return selected, used
+
+
+class PromptTokenStats:
+    """Running totals of prompt tokens sent upstream per chat request."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+        self.last_tokens = 0
+
+    def record(self, tokens: int) -> None:
+        self.requests += 1
+        self.total_tokens += tokens
+        self.last_tokens = tokens
+        self.max_tokens = max(self.max_tokens, tokens)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "requests": self.requests,
+            "total_prompt_tokens": self.total_tokens,
+            "avg_prompt_tokens": self.total_tokens / self.requests if self.requests else 0,
+            "max_prompt_tokens": self.max_tokens,
+            "last_prompt_tokens": self.last_tokens,
+        }
+
+
+prompt_token_stats = PromptTokenStats()
@@ -0,0 +1,20 @@
+from typing import Any, Optional
+from bson import ObjectId
+from fastapi import HTTPException
+
+
+def parse_cursor_id(before_id: Optional[str]) -> Optional[ObjectId]:
+    """The `_id` half of a (`before`, `before_id`) cursor; 400 when it isn't an ObjectId."""
+    if before_id is None:
+        return None
+    try:
+        return ObjectId(before_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid before_id")
+
+
+def next_cursor(boundary: Optional[dict], field: str) -> dict[str, Any]:
+    """`next_before`/`next_before_id` continuing after `boundary`, the last document of a page; None ends paging."""
+    if boundary is None:
+        return {"next_before": None, "next_before_id": None}
+    return {"next_before": boundary.get(field), "next_before_id": str(boundary["_id"])}
@@ -0,0 +1,22 @@
+from typing import Optional
+
+
+def _opaque_tag(tag: str) -> str:
+    # Weak comparison: W/"x" and "x" name the same representation
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Whether an If-None-Match header lists `etag`, so a 304 may be sent.
+
+    The header may be `*` or a comma-separated list of strong or weak
+    (`W/`-prefixed) entity tags; tags compare weakly, as RFC 9110 asks for
+    If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = _opaque_tag(etag)
+    return any(_opaque_tag(tag.strip()) == wanted for tag in if_none_match.split(","))
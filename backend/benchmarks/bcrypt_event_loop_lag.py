@@ -0,0 +1,68 @@
+"""
+Event-loop lag under a burst of concurrent logins, with bcrypt run inline on
+the loop (the old behaviour) versus on the dedicated hasher pool.
+
+Lag is measured by a ticker that expects to wake every 5 ms; anything beyond
+that is time the loop spent blocked and unable to serve other requests.
+
+Usage (from backend/):
+    python -m benchmarks.bcrypt_event_loop_lag [concurrent_logins]
+"""
+import asyncio
+import os
+import sys
+import time
+
+for name, value in {
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "JWT_SECRET_KEY": "benchmark",
+    "OPENROUTER_API_KEY": "benchmark",
+    "STRIPE_SECRET_KEY": "benchmark",
+    "STRIPE_PUBLISHABLE_KEY": "benchmark",
+    "STRIPE_WEBHOOK_SECRET": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+from app.auth import hash_password, verify_password, verify_password_async  # noqa: E402
+
+TICK = 0.005
+
+
+async def _measure_lag(stop: asyncio.Event) -> list[float]:
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+    return lags
+
+
+async def _inline_login(password: str, password_hash: str) -> bool:
+    return verify_password(password, password_hash)
+
+
+async def _run(login, logins: int, password_hash: str) -> tuple[float, float, float]:
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_measure_lag(stop))
+    await asyncio.sleep(TICK * 2)
+    start = time.perf_counter()
+    await asyncio.gather(*(login("correct horse", password_hash) for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lags = sorted(await ticker)
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    return elapsed, lags[-1] if lags else 0.0, p99
+
+
+async def main(logins: int) -> None:
+    password_hash = hash_password("correct horse")
+    for label, login in (("inline bcrypt", _inline_login), ("hasher pool", verify_password_async)):
+        elapsed, max_lag, p99_lag = await _run(login, logins, password_hash)
+        print(
+            f"{label:>14}: {logins} logins in {elapsed * 1000:8.1f} ms | "
+            f"loop lag max {max_lag * 1000:8.1f} ms, p99 {p99_lag * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
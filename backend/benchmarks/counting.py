@@ -0,0 +1,97 @@
+"""
+Credit counting: the previous `len(re.findall(r"\\b\\w+\\b", text))` against
+`app.utils.counting` (single pass, memoized per text, batch API), and
+tiktoken token counts when tiktoken is installed.
+
+Usage (from backend/):
+    python -m benchmarks.counting [iterations]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+for name, value in {
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "JWT_SECRET_KEY": "benchmark",
+    "OPENROUTER_API_KEY": "benchmark",
+    "STRIPE_SECRET_KEY": "benchmark",
+    "STRIPE_PUBLISHABLE_KEY": "benchmark",
+    "STRIPE_WEBHOOK_SECRET": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+from app.utils import counting  # noqa: E402
+
+LEGACY_PATTERN = re.compile(r"\b\w+\b", re.UNICODE)
+
+WORDS = ["hey", "there,", "gorgeous!", "how's", "your", "day", "going?", "I", "missed", "you", "so-much", "today"]
+
+
+def legacy_count(text: str | None) -> int:
+    if not text:
+        return 0
+    return len(LEGACY_PATTERN.findall(text))
+
+
+def _text(words: int, rng: random.Random, emoji: bool = False) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text + " 😘" if emoji else text
+
+
+def _per_call_us(fn, arg, iterations: int) -> float:
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best / iterations * 1e6
+
+
+def main(iterations: int) -> None:
+    rng = random.Random(0)
+    samples = {
+        "input (8 words)": _text(8, rng),
+        "reply (150 words)": _text(150, rng),
+        "reply, non-ASCII": _text(150, rng, emoji=True),
+        "long (2000 words)": _text(2000, rng),
+    }
+    for label, text in samples.items():
+        assert legacy_count(text) == counting.count_words(text), label
+        legacy = _per_call_us(legacy_count, text, iterations)
+        single = _per_call_us(counting.count_words, text, iterations)
+        memo = _per_call_us(counting.count_credits, text, iterations)
+        print(
+            f"{label:>18}: regex {legacy:8.2f} us, single pass {single:8.2f} us "
+            f"({legacy / single:4.1f}x), memoized {memo:6.2f} us"
+        )
+
+    history = [{"content": _text(rng.randint(5, 150), rng)} for _ in range(10000)]
+    start = time.perf_counter()
+    legacy_total = sum(legacy_count(m["content"]) for m in history)
+    legacy_batch = time.perf_counter() - start
+    start = time.perf_counter()
+    total = counting.count_messages(history, mode="words")
+    batch = time.perf_counter() - start
+    assert legacy_total == total
+    print(f"{'10k msg history':>18}: regex {legacy_batch * 1e3:8.2f} ms, count_messages {batch * 1e3:8.2f} ms")
+
+    try:
+        counting.load_tokenizer()
+    except Exception as exc:  # noqa: BLE001
+        print(f"Skipping token mode: {exc}")
+        return
+    tokens = _per_call_us(counting.count_tokens, samples["reply (150 words)"], iterations)
+    start = time.perf_counter()
+    token_total = counting.count_messages(history, mode="tokens")
+    token_batch = time.perf_counter() - start
+    print(
+        f"{'tokens':>18}: reply {tokens:8.2f} us, 10k msg history {token_batch * 1e3:8.2f} ms "
+        f"({token_total} tokens vs {total} words)"
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
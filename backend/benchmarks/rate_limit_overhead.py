@@ -0,0 +1,76 @@
+"""
+Per-request cost of the rate limiter: rule matching, caller key resolution
+(JWT decode or client IP) and the token-bucket take.
+
+Runs against the in-memory store, and against Redis as well when REDIS_URL
+is set.
+
+Usage (from backend/):
+    python -m benchmarks.rate_limit_overhead [requests]
+"""
+import asyncio
+import os
+import sys
+import time
+
+for name, value in {
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "JWT_SECRET_KEY": "benchmark",
+    "OPENROUTER_API_KEY": "benchmark",
+    "STRIPE_SECRET_KEY": "benchmark",
+    "STRIPE_PUBLISHABLE_KEY": "benchmark",
+    "STRIPE_WEBHOOK_SECRET": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+from app.auth import create_access_token  # noqa: E402
+from app.config import settings  # noqa: E402
+from app.rate_limit import (  # noqa: E402
+    LocalTokenBucketStore,
+    RateLimiter,
+    RedisTokenBucketStore,
+    _caller_key,
+    default_rules,
+)
+
+
+def _scope(path: str, user: int | None) -> dict:
+    headers = []
+    if user is not None:
+        headers.append((b"authorization", f"Bearer {create_access_token(f'user{user}@example.com')}".encode()))
+    return {"type": "http", "method": "POST", "path": path, "headers": headers, "client": (f"10.0.{user or 0}.1", 5000)}
+
+
+async def _run(limiter: RateLimiter, scopes: list[dict], requests: int) -> list[float]:
+    timings = []
+    for i in range(requests):
+        scope = scopes[i % len(scopes)]
+        start = time.perf_counter()
+        rule = limiter.match(scope["method"], scope["path"])
+        await limiter.check(rule, _caller_key(scope, rule.by_user))
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)
+
+
+async def main(requests: int) -> None:
+    stores = [("local", LocalTokenBucketStore(max_keys=100000))]
+    if settings.redis_url:
+        stores.append(("redis", RedisTokenBucketStore(settings.redis_url, prefix="vg:rl:bench:")))
+    workloads = {
+        "chat (JWT)": [_scope("/api/chat", user) for user in range(1000)],
+        "login (IP)": [_scope("/api/login", None) for _ in range(1)],
+    }
+    for store_name, store in stores:
+        limiter = RateLimiter(store, default_rules())
+        for label, scopes in workloads.items():
+            timings = await _run(limiter, scopes, requests)
+            p50 = timings[len(timings) // 2]
+            p99 = timings[int(len(timings) * 0.99) - 1]
+            print(
+                f"{store_name:>5} {label:>10}: p50 {p50 * 1e6:7.1f} us, "
+                f"p99 {p99 * 1e6:7.1f} us, max {timings[-1] * 1e6:8.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
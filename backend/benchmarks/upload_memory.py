@@ -0,0 +1,75 @@
+"""
+Peak Python memory while handling concurrent large uploads, comparing the old
+read-everything handler with the chunked streaming handler.
+
+Each upload is backed by a spooled temp file, as Starlette's multipart parser
+provides, so the numbers reflect what the handler itself allocates.
+
+Usage (from backend/):
+    python -m benchmarks.upload_memory [concurrent_uploads] [size_mb]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+for name, value in {
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "JWT_SECRET_KEY": "benchmark",
+    "OPENROUTER_API_KEY": "benchmark",
+    "STRIPE_SECRET_KEY": "benchmark",
+    "STRIPE_PUBLISHABLE_KEY": "benchmark",
+    "STRIPE_WEBHOOK_SECRET": "benchmark",
+    "UPLOAD_MAX_BYTES": str(1024 * 1024 * 1024),
+}.items():
+    os.environ.setdefault(name, value)
+
+from starlette.datastructures import UploadFile  # noqa: E402
+from app.routes import upload  # noqa: E402
+
+
+async def _read_all_upload(file: UploadFile):
+    # The previous handler: whole body in memory, blocking write on the loop
+    filename = f"{uuid.uuid4().hex}.bin"
+    content = await file.read()
+    with open(upload.UPLOAD_DIR / filename, "wb") as f:
+        f.write(content)
+    return {"url": f"/uploads/{filename}"}
+
+
+def _make_upload(payload: bytes) -> UploadFile:
+    spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    spool.write(payload)
+    spool.seek(0)
+    return UploadFile(file=spool, filename="photo.bin")
+
+
+async def _run(handler, uploads: int, size: int) -> tuple[float, float]:
+    # Distinct content per upload so dedup doesn't hide the write path
+    payloads = [os.urandom(1024) * (size // 1024) for _ in range(uploads)]
+    files = [_make_upload(p) for p in payloads]
+    del payloads
+    tracemalloc.start()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(handler(f) for f in files))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for result in results:
+        (upload.UPLOAD_DIR / result["url"].rsplit("/", 1)[1]).unlink(missing_ok=True)
+    return peak / (1024 * 1024), elapsed
+
+
+async def main(uploads: int, size_mb: int) -> None:
+    size = size_mb * 1024 * 1024
+    for label, handler in (("read-all", _read_all_upload), ("streaming", upload.upload_image)):
+        peak_mb, elapsed = await _run(handler, uploads, size)
+        print(f"{label:>10}: {uploads} x {size_mb} MB uploads, peak {peak_mb:8.1f} MB, {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(main(int(args[0]) if args else 8, int(args[1]) if len(args) > 1 else 20))
@@ -0,0 +1,34 @@
+"""
+Tests run against local fakes (an OpenRouter stand-in, a Stripe stand-in,
+an in-memory MongoDB),
+never the real services. Run from backend/: `python -m pytest -q`.
+"""
+import os
+import sys
+from pathlib import Path
+import pytest
+
+for name, value in {
+    "MONGODB_URI": "mongodb://localhost:27017",
+    "JWT_SECRET_KEY": "test-secret-key-that-is-long-enough",
+    "OPENROUTER_API_KEY": "test",
+    "STRIPE_SECRET_KEY": "sk_test_123",
+    "STRIPE_PUBLISHABLE_KEY": "pk_test_123",
+    "STRIPE_WEBHOOK_SECRET": "whsec_test",
+    # Failures should reach the router at once rather than be retried by the client
+    "OPENROUTER_MAX_RETRIES": "0",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh in-memory database standing in for MongoDB, returned by `get_db()` too."""
+    from mongomock_motor import AsyncMongoMockClient
+    from app import db as db_module
+
+    client = AsyncMongoMockClient()
+    monkeypatch.setattr(db_module, "_client", client)
+    return db_module.get_db()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from aiohttp import web
+
+
+@asynccontextmanager
+async def serve(app: web.Application) -> AsyncIterator[str]:
+    """Run `app` on a free local port for the duration of the block; yields its base URL."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        await runner.cleanup()
+
+
+class FakeOpenRouter:
+    """
+    Chat completions endpoint whose behaviour is set per model.
+
+    `behaviours[model]` is "ok", "error" (HTTP 500) or "slow" (answers after
+    `slow_delay` seconds, before sending anything when streaming). Every
+    request's model is appended to `calls`.
+    """
+
+    def __init__(self, behaviours: dict[str, str], slow_delay: float = 1.0) -> None:
+        self.behaviours = behaviours
+        self.slow_delay = slow_delay
+        self.calls: list[str] = []
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body["model"]
+        self.calls.append(model)
+        behaviour = self.behaviours.get(model, "ok")
+        if behaviour == "error":
+            return web.json_response({"error": {"message": "upstream failure"}}, status=500)
+        if behaviour == "slow":
+            await asyncio.sleep(self.slow_delay)
+        reply = f"reply from {model}"
+        if not body.get("stream"):
+            return web.json_response({"model": model, "choices": [{"message": {"content": reply}}]})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for word in reply.split(" "):
+            chunk = {"model": model, "choices": [{"delta": {"content": word + " "}}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/v1/chat/completions", self.completions)
+        return app
+
+
+class FakeStripe:
+    """
+    The PaymentIntents endpoints of the Stripe API, kept in memory.
+
+    Created intents are stored in `intents` by id; every request's method and
+    path is appended to `calls`.
+    """
+
+    def __init__(self) -> None:
+        self.intents: dict[str, dict] = {}
+        self.calls: list[tuple[str, str]] = []
+
+    async def create_intent(self, request: web.Request) -> web.Response:
+        self.calls.append((request.method, request.path))
+        form = await request.post()
+        intent_id = f"pi_{len(self.intents) + 1}"
+        intent = {
+            "id": intent_id,
+            "object": "payment_intent",
+            "amount": int(form["amount"]),
+            "currency": form["currency"],
+            "description": form.get("description"),
+            "client_secret": f"{intent_id}_secret",
+            "status": "requires_payment_method",
+            "metadata": {
+                key[len("metadata["):-1]: value for key, value in form.items() if key.startswith("metadata[")
+            },
+        }
+        self.intents[intent_id] = intent
+        return web.json_response(intent)
+
+    async def retrieve_intent(self, request: web.Request) -> web.Response:
+        self.calls.append((request.method, request.path))
+        intent = self.intents.get(request.match_info["intent_id"])
+        if intent is None:
+            error = {"type": "invalid_request_error", "code": "resource_missing", "message": "No such payment_intent"}
+            return web.json_response({"error": error}, status=404)
+        return web.json_response(intent)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/payment_intents", self.create_intent)
+        app.router.add_get("/v1/payment_intents/{intent_id}", self.retrieve_intent)
+        return app
@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from app import cache
+from app.auth import UserCache
+from app.cache import LocalTTLCache
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def test_local_cache_hit_and_miss():
+    async def scenario():
+        backend = LocalTTLCache(max_entries=10)
+        assert await backend.get("a") is None
+        await backend.set("a", {"email": "a"}, ttl=60)
+        assert await backend.get("a") == {"email": "a"}
+
+    asyncio.run(scenario())
+
+
+def test_local_cache_entries_expire(clock):
+    async def scenario():
+        backend = LocalTTLCache(max_entries=10)
+        await backend.set("a", 1, ttl=30)
+        clock.now += 29
+        assert await backend.get("a") == 1
+        clock.now += 2
+        assert await backend.get("a") is None
+        assert len(backend) == 0
+
+    asyncio.run(scenario())
+
+
+def test_local_cache_evicts_least_recently_used():
+    async def scenario():
+        backend = LocalTTLCache(max_entries=2)
+        await backend.set("a", 1, ttl=60)
+        await backend.set("b", 2, ttl=60)
+        await backend.get("a")
+        await backend.set("c", 3, ttl=60)
+        assert await backend.get("b") is None
+        assert await backend.get("a") == 1
+        assert await backend.get("c") == 3
+
+    asyncio.run(scenario())
+
+
+def test_user_cache_counts_hits_and_misses_and_invalidates():
+    async def scenario():
+        users = UserCache(LocalTTLCache(max_entries=10), ttl=60)
+        assert await users.get("a@example.com") is None
+        await users.set("a@example.com", {"email": "a@example.com", "credits_available": 5})
+        assert (await users.get("a@example.com"))["credits_available"] == 5
+        await users.invalidate("a@example.com")
+        assert await users.get("a@example.com") is None
+        assert (users.hits, users.misses) == (1, 2)
+
+    asyncio.run(scenario())
+
+
+def test_user_cache_hands_out_copies():
+    async def scenario():
+        users = UserCache(LocalTTLCache(max_entries=10), ttl=60)
+        user = {"email": "a@example.com"}
+        await users.set("a@example.com", user)
+        user["id"] = "changed by the caller"
+        cached = await users.get("a@example.com")
+        cached["id"] = "annotated"
+        assert await users.get("a@example.com") == {"email": "a@example.com"}
+
+    asyncio.run(scenario())
+
+
+def test_user_cache_entries_expire(clock):
+    async def scenario():
+        users = UserCache(LocalTTLCache(max_entries=10), ttl=5)
+        await users.set("a@example.com", {"email": "a@example.com"})
+        clock.now += 6
+        assert await users.get("a@example.com") is None
+
+    asyncio.run(scenario())
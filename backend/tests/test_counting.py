@@ -0,0 +1,49 @@
+import re
+import pytest
+from app.utils.counting import count_batch, count_credits, count_messages, count_words
+
+LEGACY_PATTERN = re.compile(r"\b\w+\b", re.UNICODE)
+
+
+def legacy_count(text):
+    return len(LEGACY_PATTERN.findall(text)) if text else 0
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "hey there, gorgeous!",
+        "how's your day going?",
+        "so-much_fun 42 times",
+        "trailing punctuation...!!!",
+        "   leading and   repeated   spaces   ",
+        "tabs\tand\nnewlines\r\nmixed",
+        "\t\n  ",
+        "!@#$%^&*()",
+        "a",
+        "under_score __ _",
+        "café naïve résumé",
+        "emoji 😘 between 💕 words",
+        "日本語のテキスト と 漢字",
+        "Привет, как дела?",
+        "non breaking thin　ideographic spaces",
+        "combining é accents",
+        "digits ٣٤٥ and ²³",
+    ],
+)
+def test_count_words_matches_the_old_regex(text):
+    assert count_words(text) == legacy_count(text)
+
+
+def test_empty_text_costs_nothing():
+    assert count_words("") == 0
+    assert count_words(None) == 0
+    assert count_credits("") == 0
+    assert count_credits(None) == 0
+
+
+def test_batch_and_messages_agree_with_single_counts():
+    texts = ["hi there", None, "", "café au lait", "one"]
+
+    assert count_batch(texts, mode="words") == [2, 0, 0, 3, 1]
+    assert count_messages([{"content": t} for t in texts] + [{}], mode="words") == 6
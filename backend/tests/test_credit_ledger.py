@@ -0,0 +1,201 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+from app.config import settings
+from app.services import turn_service
+from app.services.credit_ledger import (
+    LEDGER_COLLECTION,
+    credits_available,
+    release_credits,
+    release_expired_reservations,
+    reserve_credits,
+)
+from app.services.turn_service import TURN_PARTS, commit_turns, new_turn
+
+EMAIL = "a@example.com"
+
+
+async def add_user(db, credits: int = 1000) -> None:
+    await db["users"].insert_one({"email": EMAIL, "credits_available": credits, "credits_used": 0})
+
+
+async def balance(db) -> tuple[int, int, int, list]:
+    user = await db["users"].find_one({"email": EMAIL})
+    return (
+        user["credits_available"],
+        user.get("credits_reserved", 0),
+        user["credits_used"],
+        user.get("pending_reservations", []),
+    )
+
+
+async def ledger(db, reservation_id) -> list[str]:
+    entries = await db[LEDGER_COLLECTION].find({"reservation_id": reservation_id}).to_list(None)
+    return sorted(entry["type"] for entry in entries)
+
+
+def settle_only_turn(reservation, actual: int) -> dict:
+    """A turn with everything but its settlement and ledger entries already written."""
+    turn = new_turn(None, [], reservation, actual, None)
+    turn["done"] = [part for part in TURN_PARTS if part not in ("credits", "ledger")]
+    return turn
+
+
+def test_reserve_holds_credits_until_the_balance_runs_out(db):
+    async def scenario():
+        await add_user(db, credits=100)
+        first = await reserve_credits(db, EMAIL, 60)
+        second = await reserve_credits(db, EMAIL, 60)
+        available, reserved, _, pending = await balance(db)
+        return first, second, available, reserved, pending
+
+    first, second, available, reserved, pending = asyncio.run(scenario())
+
+    assert first is not None and first.amount == 60
+    assert second is None
+    assert (available, reserved) == (40, 60)
+    assert [hold["id"] for hold in pending] == [first.id]
+
+
+def test_settle_refunds_the_unused_part_of_the_hold(db):
+    async def scenario():
+        await add_user(db)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        assert await commit_turns([settle_only_turn(reservation, 30)]) == []
+        return await balance(db), await ledger(db, reservation.id)
+
+    (available, reserved, used, pending), entries = asyncio.run(scenario())
+
+    assert (available, reserved, used, pending) == (970, 0, 30, [])
+    assert entries == ["reserve", "settle"]
+
+
+def test_overrun_is_charged_no_more_than_the_hold(db):
+    async def scenario():
+        await add_user(db, credits=100)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        await commit_turns([settle_only_turn(reservation, 5000)])
+        settle = await db[LEDGER_COLLECTION].find_one({"reservation_id": reservation.id, "type": "settle"})
+        return await balance(db), settle["amount"]
+
+    (available, reserved, used, _), charged = asyncio.run(scenario())
+
+    assert (available, reserved, used, charged) == (0, 0, 100, 100)
+
+
+def test_settling_twice_charges_once(db):
+    async def scenario():
+        await add_user(db)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        turn = settle_only_turn(reservation, 30)
+        await commit_turns([turn])
+        turn["done"].remove("credits")
+        turn.pop("settled")
+        await commit_turns([turn])
+        return await balance(db)
+
+    available, reserved, used, _ = asyncio.run(scenario())
+
+    assert (available, reserved, used) == (970, 0, 30)
+
+
+def test_release_returns_the_hold_once(db):
+    async def scenario():
+        await add_user(db)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        first = await release_credits(db, reservation, "upstream_error")
+        second = await release_credits(db, reservation, "upstream_error")
+        return first, second, await balance(db), await ledger(db, reservation.id)
+
+    first, second, (available, reserved, used, pending), entries = asyncio.run(scenario())
+
+    assert (first, second) == (True, False)
+    assert (available, reserved, used, pending) == (1000, 0, 0, [])
+    assert entries == ["release", "reserve"]
+
+
+def test_sweeper_releases_only_expired_holds(db):
+    async def scenario():
+        await add_user(db)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        now = datetime.now(timezone.utc)
+        early = await release_expired_reservations(db, now)
+        late = await release_expired_reservations(db, now + timedelta(days=1))
+        again = await release_expired_reservations(db, now + timedelta(days=1))
+        return early, late, again, await balance(db), await ledger(db, reservation.id)
+
+    early, late, again, (available, reserved, _, pending), entries = asyncio.run(scenario())
+
+    assert (early, late, again) == (0, 1, 0)
+    assert (available, reserved, pending) == (1000, 0, [])
+    assert entries == ["release", "reserve"]
+
+
+def test_turn_settled_after_the_sweeper_leaves_balance_and_ledger_alone(db):
+    async def scenario():
+        await add_user(db)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        await release_expired_reservations(db, datetime.now(timezone.utc) + timedelta(days=1))
+        turn = settle_only_turn(reservation, 30)
+        left = await commit_turns([turn])
+        return left, turn, await balance(db), await ledger(db, reservation.id)
+
+    left, turn, (available, reserved, used, _), entries = asyncio.run(scenario())
+
+    assert left == []
+    assert turn["settled"] is False
+    assert (available, reserved, used) == (1000, 0, 0)
+    assert entries == ["release", "reserve"]
+
+
+def test_turns_queued_before_holds_were_recorded_still_settle(db):
+    async def scenario():
+        await add_user(db, credits=900)
+        turn = {
+            "session_id": None, "messages": [], "user_email": EMAIL, "reserved": 100, "actual": 30,
+            "ledger": [{"_id": ObjectId(), "reservation_id": None, "type": "settle", "amount": 30}],
+            "done": [part for part in TURN_PARTS if part not in ("credits", "ledger")],
+        }
+        await commit_turns([turn])
+        return await balance(db), await db[LEDGER_COLLECTION].count_documents({})
+
+    (available, _, used, _), entries = asyncio.run(scenario())
+
+    assert (available, used, entries) == (970, 30, 1)
+
+
+def test_refused_reservation_reports_the_stored_balance(db):
+    async def scenario():
+        await add_user(db, credits=100)
+        await reserve_credits(db, EMAIL, 80)
+        refused = await reserve_credits(db, EMAIL, 50)
+        return refused, await credits_available(db, EMAIL), await credits_available(db, "nobody@example.com")
+
+    refused, available, unknown = asyncio.run(scenario())
+
+    assert refused is None
+    assert (available, unknown) == (20, 0)
+
+
+def test_failed_transaction_leaves_the_turn_to_retry(db, monkeypatch):
+    async def fail_at_commit(fn):
+        # The writes run, then the commit fails and none of them count
+        await fn(None)
+        raise PyMongoError("transaction aborted")
+
+    monkeypatch.setattr(settings, "mongodb_transactions", True)
+    monkeypatch.setattr(turn_service, "run_in_transaction", fail_at_commit)
+
+    async def scenario():
+        await add_user(db)
+        reservation = await reserve_credits(db, EMAIL, 100)
+        turn = settle_only_turn(reservation, 30)
+        before = list(turn["done"])
+        assert await commit_turns([turn]) == [turn]
+        return turn, before
+
+    turn, before = asyncio.run(scenario())
+
+    assert turn["done"] == before
+    assert "settled" not in turn
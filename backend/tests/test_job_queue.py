@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from app.config import settings
+from app.services import turn_service
+from app.services.credit_ledger import LEDGER_COLLECTION, release_expired_reservations, reserve_credits
+from app.services.job_queue import PENDING_JOBS_COLLECTION, JobQueue
+from app.services.turn_service import TURN_JOB, TURN_PARTS, commit_turns, new_turn, save_turn
+
+EMAIL = "a@example.com"
+
+
+def make_queue(recover_interval: float = 3600.0) -> JobQueue:
+    return JobQueue(
+        max_size=100, batch_size=10, linger=0.0, max_attempts=3, retry_delay=0.0, recover_interval=recover_interval
+    )
+
+
+def test_unsaved_turn_is_deferred_instead_of_raised(db, monkeypatch):
+    async def leave_unfinished(turns):
+        return turns
+
+    monkeypatch.setattr(turn_service, "commit_turns", leave_unfinished)
+
+    async def scenario():
+        await save_turn({"session_id": "s1", "done": ["messages"]})
+        return await db[PENDING_JOBS_COLLECTION].find().to_list(None)
+
+    jobs = asyncio.run(scenario())
+
+    assert [(job["kind"], job["key"], job["payload"]["done"]) for job in jobs] == [(TURN_JOB, "s1", ["messages"])]
+
+
+def test_persisted_job_is_recovered_and_run_at_start(db):
+    seen = []
+
+    async def handler(payloads):
+        seen.extend(payload["n"] for payload in payloads)
+        return []
+
+    async def scenario():
+        queue = make_queue()
+        queue.register("work", handler)
+        await queue.persist("work", {"n": 1}, key="k")
+        await queue.start()
+        await queue.wait_for_key("k")
+        await queue.drain(timeout=1)
+        return await db[PENDING_JOBS_COLLECTION].count_documents({})
+
+    assert asyncio.run(scenario()) == 0
+    assert seen == [1]
+
+
+def test_jobs_persisted_while_running_are_recovered_periodically(db):
+    seen = []
+
+    async def handler(payloads):
+        seen.extend(payload["n"] for payload in payloads)
+        return []
+
+    async def scenario():
+        queue = make_queue(recover_interval=0.01)
+        queue.register("work", handler)
+        await queue.start()
+        await queue.persist("work", {"n": 2})
+        for _ in range(100):
+            if seen:
+                break
+            await asyncio.sleep(0.01)
+        await queue.drain(timeout=1)
+
+    asyncio.run(scenario())
+    assert seen == [2]
+
+
+def test_deferred_turn_keeps_its_hold_through_the_sweep_and_settles_on_recovery(db):
+    async def scenario():
+        await db["users"].insert_one({"email": EMAIL, "credits_available": 1000, "credits_used": 0})
+        reservation = await reserve_credits(db, EMAIL, 100)
+        turn = new_turn(None, [], reservation, 30, None)
+        turn["done"] = [part for part in TURN_PARTS if part not in ("credits", "ledger")]
+        queue = make_queue()
+        queue.register(TURN_JOB, commit_turns)
+        await queue.persist(TURN_JOB, turn)
+
+        later = datetime.now(timezone.utc) + timedelta(seconds=settings.credit_reservation_ttl + 60)
+        released = await release_expired_reservations(db, now=later)
+
+        await queue.start()
+        for _ in range(100):
+            if queue.processed:
+                break
+            await asyncio.sleep(0.01)
+        await queue.drain(timeout=1)
+        user = await db["users"].find_one({"email": EMAIL})
+        entries = await db[LEDGER_COLLECTION].find({"reservation_id": reservation.id}).to_list(None)
+        return released, user, sorted(entry["type"] for entry in entries)
+
+    released, user, entries = asyncio.run(scenario())
+
+    assert released == 0
+    assert (user["credits_available"], user["credits_used"], user["pending_reservations"]) == (970, 30, [])
+    assert entries == ["reserve", "settle"]
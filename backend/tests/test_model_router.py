@@ -0,0 +1,243 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+import pytest
+from app.config import settings
+from app.services import openrouter_service
+from app.services import model_router as model_router_module
+from app.services.model_router import ModelRouter
+from app.services.openrouter_service import (
+    Deadline,
+    DeadlineExceededError,
+    OpenRouterError,
+    UpstreamBusyError,
+    UpstreamUsage,
+)
+from .fakes import FakeOpenRouter, serve
+
+PRIMARY = "test/primary"
+BACKUP = "test/backup"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@asynccontextmanager
+async def fake_openrouter(behaviours: dict[str, str], slow_delay: float = 1.0):
+    fake = FakeOpenRouter(behaviours, slow_delay=slow_delay)
+    url = openrouter_service.OPENROUTER_URL
+    async with serve(fake.app()) as base:
+        openrouter_service.OPENROUTER_URL = f"{base}/api/v1/chat/completions"
+        try:
+            yield fake
+        finally:
+            openrouter_service.OPENROUTER_URL = url
+            await openrouter_service.close_openrouter_client()
+
+
+@pytest.fixture(autouse=True)
+def router_settings(monkeypatch):
+    monkeypatch.setattr(settings, "router_failure_threshold", 2)
+    monkeypatch.setattr(settings, "router_circuit_cooldown", 30.0)
+    monkeypatch.setattr(settings, "router_hedge_enabled", False)
+
+
+def _half_open(router: ModelRouter, model: str) -> None:
+    stats = router.model_stats[model]
+    stats.consecutive_failures = settings.router_failure_threshold
+    stats.opened_at = time.monotonic() - stats.cooldown
+
+
+async def _collect(stream) -> str:
+    return "".join([delta async for delta in stream]).strip()
+
+
+def test_complete_falls_back_when_primary_fails():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({PRIMARY: "error"}) as fake:
+            assert await router.complete(MESSAGES) == f"reply from {BACKUP}"
+        assert fake.calls == [PRIMARY, BACKUP]
+        assert router.model_stats[PRIMARY].consecutive_failures == 1
+        assert router.model_stats[PRIMARY].state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_after_threshold_and_skips_the_model():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({PRIMARY: "error"}) as fake:
+            for _ in range(settings.router_failure_threshold):
+                await router.complete(MESSAGES)
+            assert router.model_stats[PRIMARY].state == "open"
+            fake.calls.clear()
+            assert await router.complete(MESSAGES) == f"reply from {BACKUP}"
+            assert fake.calls == [BACKUP]
+
+    asyncio.run(scenario())
+
+
+def test_half_open_model_gets_one_trial_and_closes_on_success():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        _half_open(router, PRIMARY)
+        assert router.model_stats[PRIMARY].state == "half_open"
+        async with fake_openrouter({}) as fake:
+            assert await router.complete(MESSAGES) == f"reply from {PRIMARY}"
+        assert fake.calls == [PRIMARY]
+        assert router.model_stats[PRIMARY].state == "closed"
+        assert not router.model_stats[PRIMARY].trial_in_progress
+
+    asyncio.run(scenario())
+
+
+def test_failed_half_open_trial_reopens_the_breaker():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        _half_open(router, PRIMARY)
+        async with fake_openrouter({PRIMARY: "error"}):
+            assert await router.complete(MESSAGES) == f"reply from {BACKUP}"
+        assert router.model_stats[PRIMARY].state == "open"
+
+    asyncio.run(scenario())
+
+
+def test_stream_falls_back_before_the_first_delta():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({PRIMARY: "error"}) as fake:
+            assert await _collect(router.stream(MESSAGES)) == f"reply from {BACKUP}"
+        assert fake.calls == [PRIMARY, BACKUP]
+
+    asyncio.run(scenario())
+
+
+def test_stream_cancelled_before_first_delta_frees_the_half_open_trial():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        _half_open(router, PRIMARY)
+        async with fake_openrouter({PRIMARY: "slow"}, slow_delay=5.0) as fake:
+            task = asyncio.create_task(_collect(router.stream(MESSAGES)))
+            while not fake.calls:
+                await asyncio.sleep(0.01)
+            assert router.model_stats[PRIMARY].trial_in_progress
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        stats = router.model_stats[PRIMARY]
+        assert not stats.trial_in_progress
+        assert stats.available()
+
+    asyncio.run(scenario())
+
+
+def test_hedge_returns_the_backup_when_the_primary_is_slow(monkeypatch):
+    monkeypatch.setattr(settings, "router_hedge_enabled", True)
+    monkeypatch.setattr(settings, "router_hedge_default_delay", 0.05)
+
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({PRIMARY: "slow"}, slow_delay=5.0) as fake:
+            started = time.monotonic()
+            assert await router.complete(MESSAGES) == f"reply from {BACKUP}"
+            assert time.monotonic() - started < 2.0
+        assert fake.calls == [PRIMARY, BACKUP]
+        # Losing the race is not held against the primary
+        assert router.model_stats[PRIMARY].consecutive_failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_hedge_not_started_when_the_primary_is_fast(monkeypatch):
+    monkeypatch.setattr(settings, "router_hedge_enabled", True)
+    monkeypatch.setattr(settings, "router_hedge_default_delay", 2.0)
+
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({}) as fake:
+            assert await router.complete(MESSAGES) == f"reply from {PRIMARY}"
+        assert fake.calls == [PRIMARY]
+
+    asyncio.run(scenario())
+
+
+def test_deadline_is_not_a_model_fault():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({PRIMARY: "slow"}, slow_delay=2.0) as fake:
+            with pytest.raises(DeadlineExceededError):
+                await router.complete(MESSAGES, deadline=Deadline(0.2))
+        assert fake.calls == [PRIMARY]
+        assert router.model_stats[PRIMARY].consecutive_failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_all_models_failing_raises():
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        async with fake_openrouter({PRIMARY: "error", BACKUP: "error"}):
+            with pytest.raises(OpenRouterError, match="All models failed"):
+                await router.complete(MESSAGES)
+
+    asyncio.run(scenario())
+
+
+def test_open_circuits_fail_fast_without_calling_upstream():
+    async def scenario():
+        router = ModelRouter([PRIMARY])
+        stats = router.model_stats[PRIMARY]
+        stats.consecutive_failures = settings.router_failure_threshold
+        stats.opened_at = time.monotonic()
+        async with fake_openrouter({}) as fake:
+            with pytest.raises(OpenRouterError, match="circuit is open"):
+                await router.complete(MESSAGES)
+            with pytest.raises(OpenRouterError, match="circuit is open"):
+                await _collect(router.stream(MESSAGES))
+        assert fake.calls == []
+
+    asyncio.run(scenario())
+
+
+def test_busy_primary_is_not_hedged(monkeypatch):
+    monkeypatch.setattr(settings, "router_hedge_enabled", True)
+    calls = []
+
+    async def busy(messages, model, **kwargs):
+        calls.append(model)
+        raise UpstreamBusyError("Too many requests in flight", retry_after=1.0)
+
+    monkeypatch.setattr(model_router_module, "fetch_openrouter_chat_completion", busy)
+
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        with pytest.raises(UpstreamBusyError):
+            await router.complete(MESSAGES)
+
+    asyncio.run(scenario())
+    assert calls == [PRIMARY]
+
+
+def test_hedge_reports_only_the_winners_usage(monkeypatch):
+    monkeypatch.setattr(settings, "router_hedge_enabled", True)
+    monkeypatch.setattr(settings, "router_hedge_default_delay", 0.05)
+
+    async def fetch(messages, model, usage=None, **kwargs):
+        usage.model = model
+        if model == PRIMARY:
+            # The loser's partial figures must not leak into the reported usage
+            usage.completion_tokens = 999
+            await asyncio.sleep(5)
+        usage.prompt_tokens = 10
+        return f"reply from {model}"
+
+    monkeypatch.setattr(model_router_module, "fetch_openrouter_chat_completion", fetch)
+
+    async def scenario():
+        router = ModelRouter([PRIMARY, BACKUP])
+        usage = UpstreamUsage()
+        reply = await router.complete(MESSAGES, usage=usage)
+        return reply, usage
+
+    reply, usage = asyncio.run(scenario())
+    assert reply == f"reply from {BACKUP}"
+    assert (usage.model, usage.prompt_tokens, usage.completion_tokens) == (BACKUP, 10, 0)
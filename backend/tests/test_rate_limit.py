@@ -0,0 +1,39 @@
+import asyncio
+from app.rate_limit import LocalTokenBucketStore, RateLimiter, RateLimitRule
+
+RULE = RateLimitRule(
+    group="chat",
+    paths=("/api/chat",),
+    methods=frozenset({"POST"}),
+    rate=0.001,
+    burst=2,
+    global_rate=0.001,
+    global_burst=1,
+)
+
+
+def test_global_denial_does_not_spend_the_callers_tokens():
+    async def scenario():
+        limiter = RateLimiter(LocalTokenBucketStore(max_keys=100), [RULE])
+        assert await limiter.check(RULE, "user:a") == 0
+        # The shared bucket is empty now: b is refused without losing a token of its own
+        for _ in range(5):
+            assert await limiter.check(RULE, "user:b") > 0
+        assert limiter.store._buckets["chat:user:b"][0] == RULE.burst
+
+    asyncio.run(scenario())
+
+
+def test_callers_own_limit_does_not_touch_the_shared_bucket():
+    async def scenario():
+        rule = RateLimitRule(
+            group="chat", paths=("/api/chat",), methods=frozenset({"POST"}),
+            rate=0.001, burst=1, global_rate=0.001, global_burst=2,
+        )
+        limiter = RateLimiter(LocalTokenBucketStore(max_keys=100), [rule])
+        assert await limiter.check(rule, "user:a") == 0
+        for _ in range(5):
+            assert await limiter.check(rule, "user:a") > 0
+        assert await limiter.check(rule, "user:b") == 0
+
+    asyncio.run(scenario())
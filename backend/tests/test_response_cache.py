@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from app.cache import LocalTTLCache
+from app.config import settings
+from app.services import model_router as model_router_module
+from app.services import response_cache as response_cache_module
+from app.services.model_router import ModelRouter
+from app.services.openrouter_service import UpstreamUsage
+from app.services.response_cache import ResponseCache, cached_chat_completion, cached_stream_chat_completion
+
+PRIMARY = "test/primary"
+BACKUP = "test/backup"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def failing():
+    return set()
+
+
+@pytest.fixture(autouse=True)
+def cache_setup(monkeypatch, failing):
+    monkeypatch.setattr(settings, "response_cache_enabled", True)
+    monkeypatch.setattr(settings, "router_hedge_enabled", False)
+    monkeypatch.setattr(response_cache_module, "model_router", ModelRouter([PRIMARY, BACKUP]))
+    monkeypatch.setattr(
+        response_cache_module,
+        "response_cache",
+        ResponseCache(LocalTTLCache(max_entries=10), ttl=60, max_messages=1, variants=1, randomize=True),
+    )
+
+    async def fetch(messages, model, usage=None, **kwargs):
+        if model in failing:
+            raise RuntimeError(f"{model} is down")
+        usage.model = model
+        return f"reply from {model}"
+
+    async def stream(messages, model, usage=None, **kwargs):
+        if model in failing:
+            raise RuntimeError(f"{model} is down")
+        usage.model = model
+        yield f"reply from {model}"
+
+    monkeypatch.setattr(model_router_module, "fetch_openrouter_chat_completion", fetch)
+    monkeypatch.setattr(model_router_module, "stream_openrouter_chat_completion", stream)
+
+
+def _cached() -> ResponseCache:
+    return response_cache_module.response_cache
+
+
+def test_primary_reply_is_cached_and_served():
+    async def scenario():
+        usage = UpstreamUsage()
+        assert await cached_chat_completion(MESSAGES, usage=usage) == f"reply from {PRIMARY}"
+        assert usage.route == PRIMARY
+        assert await cached_chat_completion(MESSAGES) == f"reply from {PRIMARY}"
+        assert _cached().hits == 1
+
+    asyncio.run(scenario())
+
+
+def test_fallback_reply_is_not_cached_under_the_primary_key(failing):
+    failing.add(PRIMARY)
+
+    async def scenario():
+        usage = UpstreamUsage()
+        assert await cached_chat_completion(MESSAGES, usage=usage) == f"reply from {BACKUP}"
+        assert usage.route == BACKUP
+        streamed = [delta async for delta in cached_stream_chat_completion(MESSAGES)]
+        assert streamed == [f"reply from {BACKUP}"]
+        failing.clear()
+        assert await cached_chat_completion(MESSAGES) == f"reply from {PRIMARY}"
+        assert _cached().hits == 0
+
+    asyncio.run(scenario())
+
+
+def test_variant_choice_is_stable_per_session():
+    async def scenario():
+        cache = ResponseCache(LocalTTLCache(max_entries=10), ttl=60, max_messages=1, variants=3, randomize=True)
+        for reply in ("a", "b", "c"):
+            await cache.put("key", reply)
+        picks = {session: await cache.get("key", session) for session in map(str, range(20))}
+        for session, pick in picks.items():
+            assert await cache.get("key", session) == pick
+        assert len(set(picks.values())) > 1
+
+    asyncio.run(scenario())
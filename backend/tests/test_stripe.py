@@ -0,0 +1,183 @@
+import asyncio
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.config import settings
+from app.routes import payments
+from app.services import stripe_service
+from app.services.payment_service import PROCESSED_PAYMENTS_COLLECTION, PaymentGrant, apply_payment_grants
+from app.services.stripe_service import (
+    PACKAGE_CATALOG_ETAG,
+    close_stripe_client,
+    create_payment_intent,
+    retrieve_payment_intent,
+)
+from app.utils.http import etag_matches
+from tests.fakes import FakeStripe, serve
+
+
+def run_against(fake: FakeStripe, scenario):
+    """Run `scenario()` with the Stripe client pointed at `fake`."""
+
+    async def run():
+        async with serve(fake.app()) as base_url:
+            previous = settings.stripe_api_base
+            settings.stripe_api_base = base_url
+            await close_stripe_client()
+            try:
+                return await scenario()
+            finally:
+                await close_stripe_client()
+                settings.stripe_api_base = previous
+
+    return asyncio.run(run())
+
+
+def test_create_and_retrieve_payment_intent():
+    fake = FakeStripe()
+
+    async def scenario():
+        created = await create_payment_intent(2.5, "a@example.com", 2500)
+        retrieved = await retrieve_payment_intent(created["payment_intent_id"])
+        return created, retrieved
+
+    created, retrieved = run_against(fake, scenario)
+
+    assert created == {
+        "client_secret": "pi_1_secret",
+        "payment_intent_id": "pi_1",
+        "amount": 250,
+        "currency": "gbp",
+    }
+    assert retrieved.id == "pi_1"
+    assert retrieved.metadata["user_email"] == "a@example.com"
+    assert retrieved.metadata["credits_to_purchase"] == "2500"
+    assert fake.calls == [("POST", "/v1/payment_intents"), ("GET", "/v1/payment_intents/pi_1")]
+
+
+def test_stripe_errors_become_runtime_errors():
+    fake = FakeStripe()
+
+    with pytest.raises(RuntimeError, match="Stripe error"):
+        run_against(fake, lambda: retrieve_payment_intent("pi_missing"))
+
+
+def test_client_is_shared_between_calls():
+    fake = FakeStripe()
+
+    async def scenario():
+        first = stripe_service.get_stripe_client()
+        await create_payment_intent(1.0, "a@example.com", 1000)
+        return first is stripe_service.get_stripe_client()
+
+    assert run_against(fake, scenario)
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(payments.router, prefix="/api")
+    return TestClient(app)
+
+
+def test_packages_served_with_etag(client):
+    response = client.get("/api/payments/packages")
+
+    assert response.status_code == 200
+    assert response.headers["etag"] == PACKAGE_CATALOG_ETAG
+    assert response.json() == json.loads(stripe_service.PACKAGE_CATALOG_BODY)
+
+
+@pytest.mark.parametrize(
+    "if_none_match",
+    [
+        PACKAGE_CATALOG_ETAG,
+        f"W/{PACKAGE_CATALOG_ETAG}",
+        f'"stale", {PACKAGE_CATALOG_ETAG}',
+        "*",
+    ],
+)
+def test_packages_revalidate_to_304(client, if_none_match):
+    response = client.get("/api/payments/packages", headers={"If-None-Match": if_none_match})
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == PACKAGE_CATALOG_ETAG
+    assert response.content == b""
+
+
+def test_packages_resent_for_a_stale_etag(client):
+    response = client.get("/api/payments/packages", headers={"If-None-Match": '"stale", W/"older"'})
+
+    assert response.status_code == 200
+    assert response.headers["etag"] == PACKAGE_CATALOG_ETAG
+
+
+def test_etag_matches():
+    assert etag_matches('"a"', '"a"')
+    assert etag_matches('W/"a"', '"a"')
+    assert etag_matches('"b" ,W/"a"', '"a"')
+    assert etag_matches(" * ", '"a"')
+    assert not etag_matches(None, '"a"')
+    assert not etag_matches("", '"a"')
+    assert not etag_matches('"ab"', '"a"')
+
+
+async def _add_buyer(db, credits: int = 0) -> None:
+    await db["users"].insert_one({"email": "a@example.com", "credits_available": credits, "total_credits_purchased": 0})
+
+
+def _grant(payment_intent_id: str = "pi_1", source: str = "webhook") -> PaymentGrant:
+    return PaymentGrant(payment_intent_id=payment_intent_id, user_email="a@example.com", credits=500, source=source)
+
+
+def test_replayed_grants_credit_once(db):
+    async def scenario():
+        await _add_buyer(db)
+        first = await apply_payment_grants([_grant(), _grant(source="confirm"), _grant("pi_2")])
+        replay = await apply_payment_grants([_grant(), _grant("pi_2")])
+        user = await db["users"].find_one({"email": "a@example.com"})
+        return first, replay, user, await db[PROCESSED_PAYMENTS_COLLECTION].count_documents({})
+
+    first, replay, user, processed = asyncio.run(scenario())
+
+    assert [result.first_seen for result in first] == [True, False, True]
+    assert [result.first_seen for result in replay] == [False, False]
+    assert (user["credits_available"], user["total_credits_purchased"]) == (1000, 1000)
+    assert processed == 2
+
+
+def test_grant_for_unknown_user_stays_unclaimed(db):
+    async def scenario():
+        [missing] = await apply_payment_grants([_grant()])
+        await _add_buyer(db)
+        [retried] = await apply_payment_grants([_grant()])
+        return missing, retried, await db["users"].find_one({"email": "a@example.com"})
+
+    missing, retried, user = asyncio.run(scenario())
+
+    assert (missing.user_found, missing.first_seen) == (False, False)
+    assert (retried.user_found, retried.first_seen) == (True, True)
+    assert user["credits_available"] == 500
+
+
+def test_replayed_webhook_credits_once(db, client, monkeypatch):
+    async def verify(payload, signature):
+        return json.loads(payload)
+
+    monkeypatch.setattr(payments, "verify_payment_webhook", verify)
+    asyncio.run(_add_buyer(db))
+    event = {
+        "id": "evt_1",
+        "type": "payment_intent.succeeded",
+        "data": {"object": {"id": "pi_1", "metadata": {"user_email": "a@example.com", "credits_to_purchase": "500"}}},
+    }
+
+    for event_id in ("evt_1", "evt_1", "evt_2"):
+        response = client.post(
+            "/api/payments/webhook", json={**event, "id": event_id}, headers={"stripe-signature": "sig"}
+        )
+        assert response.status_code == 200
+
+    user = asyncio.run(db["users"].find_one({"email": "a@example.com"}))
+    assert user["credits_available"] == 500
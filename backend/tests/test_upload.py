@@ -0,0 +1,101 @@
+import io
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+from app.config import settings
+from app.routes import upload
+
+BOUNDARY = "testboundary"
+
+
+def png_bytes() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), "red").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def multipart_body(field: str, content: bytes, filename: str = "picture.png") -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + content + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload, "UPLOAD_DIR", tmp_path)
+    monkeypatch.setattr(upload, "VARIANTS_DIR", tmp_path / "variants")
+    (tmp_path / "variants").mkdir()
+    monkeypatch.setattr(settings, "upload_max_bytes", 4096)
+    return tmp_path
+
+
+@pytest.fixture
+def client(uploads):
+    app = FastAPI()
+    app.include_router(upload.router, prefix="/api")
+    return TestClient(app)
+
+
+def post(client, body: bytes, content_type: str = f"multipart/form-data; boundary={BOUNDARY}", **headers):
+    return client.post("/api/upload", content=body, headers={"Content-Type": content_type, **headers})
+
+
+def leftovers(uploads) -> list[str]:
+    return sorted(p.name for p in uploads.iterdir() if p.is_file())
+
+
+def test_image_stored_under_its_hash_and_detected_extension(client, uploads):
+    image = png_bytes()
+
+    first = post(client, multipart_body("file", image, filename="photo.jpg"))
+    second = post(client, multipart_body("file", image))
+
+    assert first.status_code == 200
+    assert first.json()["url"].endswith(".png")
+    assert first.json() == second.json()
+    assert leftovers(uploads) == [first.json()["url"].rsplit("/", 1)[1]]
+
+
+def test_oversized_content_length_is_refused_up_front(client, uploads):
+    body = multipart_body("file", png_bytes())
+
+    response = post(client, body, **{"Content-Length": str(settings.upload_max_bytes + upload.MULTIPART_OVERHEAD + 1)})
+
+    assert response.status_code == 413
+
+
+def test_file_over_the_limit_is_refused_while_streaming(client, uploads):
+    response = post(client, multipart_body("file", b"\x89PNG\r\n\x1a\n" + b"x" * settings.upload_max_bytes))
+
+    assert response.status_code == 413
+    assert leftovers(uploads) == []
+
+
+def test_non_image_is_unsupported(client, uploads):
+    response = post(client, multipart_body("file", b"just some text"))
+
+    assert response.status_code == 415
+    assert leftovers(uploads) == []
+
+
+def test_body_that_is_not_multipart_is_rejected(client, uploads):
+    assert post(client, b"{}", content_type="application/json").status_code == 400
+    assert post(client, b"", content_type="multipart/form-data").status_code == 400
+
+
+def test_upload_without_a_file_field_is_rejected(client, uploads):
+    response = post(client, multipart_body("avatar", png_bytes()))
+
+    assert response.status_code == 400
+    assert leftovers(uploads) == []
+
+
+def test_malformed_multipart_body_is_rejected(client, uploads):
+    response = post(client, b"this is not a multipart body at all", content_type="multipart/form-data; boundary=zz")
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Malformed multipart body"
+    assert leftovers(uploads) == []
@@ -0,0 +1,79 @@
+import asyncio
+import copy
+from datetime import datetime, timezone
+from pymongo.errors import AutoReconnect
+from app.services import turn_service
+from app.services.credit_ledger import reserve_credits
+from app.services.openrouter_service import UpstreamUsage
+from app.services.turn_service import TURN_PARTS, commit_turns, new_turn
+from app.services.usage_service import (
+    GLOBAL_SCOPE,
+    USAGE_EVENTS_COLLECTION,
+    USAGE_ROLLUPS_COLLECTION,
+    fetch_rollups,
+    usage_event,
+)
+
+EMAIL = "a@example.com"
+NOW = datetime(2024, 1, 1, 13, 30, tzinfo=timezone.utc)
+
+
+async def usage_only_turn(db) -> dict:
+    """A turn with everything but its usage event and rollups already written."""
+    await db["users"].insert_one({"email": EMAIL, "credits_available": 1000, "credits_used": 0})
+    reservation = await reserve_credits(db, EMAIL, 100)
+    event = usage_event("s1", EMAIL, "default", 5, 25, UpstreamUsage(model="test/model", prompt_tokens=40), NOW)
+    turn = new_turn("s1", [], reservation, 30, event)
+    turn["done"] = [part for part in TURN_PARTS if part not in ("usage_event", "usage_rollups")]
+    return turn
+
+
+async def hourly(db, scope: str) -> list[dict]:
+    return await fetch_rollups(db, scope, "hour", NOW, NOW.replace(hour=14))
+
+
+def test_replayed_turn_is_counted_once(db):
+    async def scenario():
+        turn = await usage_only_turn(db)
+        replay = copy.deepcopy(turn)
+        assert await commit_turns([turn]) == []
+        # Another process replaying the same turn from pending_jobs, from scratch
+        assert await commit_turns([replay]) == []
+        events = await db[USAGE_EVENTS_COLLECTION].count_documents({})
+        return await hourly(db, EMAIL), await hourly(db, GLOBAL_SCOPE), events
+
+    [mine], [everyone], events = asyncio.run(scenario())
+
+    assert (mine["turns"], mine["credits"], mine["prompt_tokens"]) == (1, 30, 40)
+    assert (everyone["turns"], everyone["credits"]) == (1, 30)
+    assert mine["models"] == {"test/model": {"turns": 1, "credits": 30}}
+    assert events == 1
+
+
+class RollupsDown:
+    """A database whose usage_rollups collection is unreachable."""
+
+    def __init__(self, db) -> None:
+        self.db = db
+
+    def __getitem__(self, name: str):
+        if name == USAGE_ROLLUPS_COLLECTION:
+            return self
+        return self.db[name]
+
+    async def bulk_write(self, *args, **kwargs):
+        raise AutoReconnect("primary stepped down")
+
+
+def test_rollups_retried_after_the_event_was_written(db, monkeypatch):
+    async def scenario():
+        turn = await usage_only_turn(db)
+        monkeypatch.setattr(turn_service, "get_db", lambda: RollupsDown(db))
+        assert await commit_turns([turn]) == [turn]
+        monkeypatch.setattr(turn_service, "get_db", lambda: db)
+        assert await commit_turns([turn]) == []
+        return await hourly(db, EMAIL)
+
+    [mine] = asyncio.run(scenario())
+
+    assert mine["turns"] == 1
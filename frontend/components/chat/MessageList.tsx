@@ -1,7 +1,7 @@
 "use client"
 import { motion, AnimatePresence } from 'framer-motion'
 import Image from 'next/image'
-import { toApiAbsoluteUrl } from '@/lib/api'
+import { toImageVariantUrl } from '@/lib/api'
 import { FormattedMessage } from './FormattedMessage'
 
 type Message = {
@@ -31,7 +31,7 @@ export function MessageList({ messages }: { messages: Message[] }) {
               {m.type === 'image' ? (
                 <div className="space-y-2">
                   <Image 
-                    src={toApiAbsoluteUrl(m.content)} 
+                    src={toImageVariantUrl(m.content, 'chat')} 
                     alt="uploaded" 
                     width={280} 
                     height={280} 
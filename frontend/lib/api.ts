@@ -76,4 +76,10 @@ export function toApiAbsoluteUrl(pathOrUrl: string): string {
   }
 }
 
-
+export function toImageVariantUrl(pathOrUrl: string, variant: 'thumb' | 'chat'): string {
+  const url = new URL(toApiAbsoluteUrl(pathOrUrl))
+  if (url.origin === API_BASE_ORIGIN && url.pathname.startsWith('/uploads/')) {
+    url.searchParams.set('variant', variant)
+  }
+  return url.toString()
+}